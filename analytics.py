@@ -0,0 +1,384 @@
+"""Vectorized (NumPy) PnL and slippage analytics over large fill histories.
+
+Applies the same average-price rules as app.PositionBook (scale-ins average
+the entry, opposite fills realize PnL on the closed part, oversized opposite
+fills flip at the fill price) but over whole arrays instead of one fill at a
+time, so months of fills for every symbol can be re-analysed in one pass.
+
+    python analytics.py --journal journal.db --days 30
+    python analytics.py --bench 200000
+
+NumPy is only needed here; app.py does not import this module.
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# ================== LOADING ==================
+def contract_root(contract_id):
+    # "CON.F.US.MNQ.H26" -> "MNQ"
+    parts = str(contract_id).upper().split(".")
+    return parts[3] if len(parts) >= 5 else ""
+
+def make_fills(ts, symbol, side, qty, price):
+    """Column arrays for fills already in time order (side 0 buy / 1 sell)."""
+    return {
+        "ts": np.asarray(ts, dtype=np.float64),
+        "symbol": np.asarray(symbol, dtype=str),
+        "side": np.asarray(side, dtype=np.int8),
+        "qty": np.asarray(qty, dtype=np.int64),
+        "price": np.asarray(price, dtype=np.float64),
+    }
+
+def fills_from_records(records):
+    """app.OrderRecord list (sorted, as returned by ingest_orders) -> fill arrays."""
+    rows = [r for r in records if r.filled]
+    return make_fills(
+        [r.updated if r.updated is not None else -np.inf for r in rows],
+        [r.symbol for r in rows],
+        [r.side for r in rows],
+        [r.size for r in rows],
+        [r.filled_price for r in rows],
+    )
+
+def load_journal_fills(path, start_epoch=None, end_epoch=None, account_id=None):
+    """Filled orders from the app's journal database, oldest first."""
+    sql = ("SELECT update_epoch, contract_id, side, size, filled_price FROM order_records"
+           " WHERE fill_volume > 0 AND filled_price IS NOT NULL")
+    args = []
+    if account_id is not None:
+        sql += " AND account_id = ?"
+        args.append(account_id)
+    if start_epoch is not None:
+        sql += " AND update_epoch >= ?"
+        args.append(start_epoch)
+    if end_epoch is not None:
+        sql += " AND update_epoch <= ?"
+        args.append(end_epoch)
+    sql += " ORDER BY update_epoch, id"
+    with sqlite3.connect(path) as db:
+        rows = db.execute(sql, args).fetchall()
+    return make_fills(
+        [r[0] for r in rows],
+        [contract_root(r[1]) for r in rows],
+        [r[2] for r in rows],
+        [r[3] for r in rows],
+        [r[4] for r in rows],
+    )
+
+def load_journal_executions(path, start_epoch=None, end_epoch=None):
+    """Our own executions (planned vs fill) from the journal database."""
+    sql = ("SELECT exec_epoch, symbol, side, qty, planned_entry, fill_price, time_to_fill_ms"
+           " FROM executions WHERE fill_price IS NOT NULL")
+    args = []
+    if start_epoch is not None:
+        sql += " AND exec_epoch >= ?"
+        args.append(start_epoch)
+    if end_epoch is not None:
+        sql += " AND exec_epoch <= ?"
+        args.append(end_epoch)
+    sql += " ORDER BY exec_epoch"
+    with sqlite3.connect(path) as db:
+        rows = db.execute(sql, args).fetchall()
+    return {
+        "ts": np.array([r[0] for r in rows], dtype=np.float64),
+        "symbol": np.array([r[1] or "" for r in rows], dtype=str),
+        "side": np.array([r[2] for r in rows], dtype=np.int8),
+        "qty": np.array([r[3] for r in rows], dtype=np.int64),
+        "planned": np.array([r[4] for r in rows], dtype=np.float64),
+        "fill": np.array([r[5] for r in rows], dtype=np.float64),
+        "time_to_fill_ms": np.array([np.nan if r[6] is None else r[6] for r in rows], dtype=np.float64),
+    }
+
+# ================== PNL ==================
+def _affine_scan(a, b):
+    """Inclusive scan of x_k = a_k * x_(k-1) + b_k (x_(-1) = 0) by recursive doubling."""
+    a = a.copy()
+    b = b.copy()
+    step = 1
+    while step < len(a) and a[step:].any():
+        b[step:] = a[step:] * b[:-step] + b[step:]
+        a[step:] = a[step:] * a[:-step]
+        step *= 2
+    return b
+
+def _symbol_pnl(side, qty, price, pv):
+    """Per-fill realized PnL for one symbol.
+
+    Returns (pnl, close_qty, entry, final_pos, final_avg), where entry is the
+    average price the closed portion was realized against.
+    """
+    n = len(qty)
+    q = np.where(side == 0, qty, -qty)
+    p_after = np.cumsum(q)
+    p_before = p_after - q
+    sb = np.sign(p_before)
+    abs_q = np.abs(q)
+    abs_b = np.abs(p_before)
+    abs_a = np.abs(p_after)
+
+    opening = p_before == 0
+    against = (np.sign(q) == -sb) & ~opening
+    flip = against & (abs_q > abs_b)
+    reduce = against & ~flip
+    close_qty = np.where(reduce, abs_q, np.where(flip, abs_b, 0))
+
+    # "basis events": fills after which the average price changes
+    event = ~reduce
+    start = opening | flip
+    ev = np.flatnonzero(event)
+    e_start = start[ev]
+    e_pa = abs_a[ev].astype(np.float64)
+    e_add = np.where(flip[ev], abs_a[ev], abs_q[ev]).astype(np.float64)
+
+    # avg_k = (avg_(k-1) * |pos before k| + price_k * add_k) / |pos after k|, i.e. the
+    # affine recurrence avg_k = a_k * avg_(k-1) + b_k with a_k = 0 at segment starts
+    # (open from flat or flip). Solved as a prefix scan; a_k <= 1 keeps it stable.
+    a = np.where(e_start, 0.0, abs_b[ev] / e_pa)
+    b = price[ev] * e_add / e_pa
+    e_avg = _affine_scan(a, b)
+
+    # average price in force before each fill = after the latest earlier event
+    last_ev = np.maximum.accumulate(np.where(event, np.arange(n), -1))
+    prev_ev = np.full(n, -1)
+    prev_ev[1:] = last_ev[:-1]
+    avg_after = np.zeros(n)
+    avg_after[ev] = e_avg
+    entry = np.where(prev_ev >= 0, avg_after[np.maximum(prev_ev, 0)], 0.0)
+
+    pnl = np.where(close_qty > 0, (price - entry) * sb * pv * close_qty, 0.0)
+
+    final_pos = int(p_after[-1]) if n else 0
+    final_avg = float(avg_after[last_ev[-1]]) if n and final_pos != 0 else 0.0
+    return pnl, close_qty, entry, final_pos, final_avg
+
+def realized_pnl(fills, point_values):
+    """Per-fill realized PnL across all symbols, in the fills' (time) order."""
+    n = len(fills["qty"])
+    pnl = np.zeros(n)
+    close_qty = np.zeros(n, dtype=np.int64)
+    entry = np.zeros(n)
+    positions = {}
+    if not n:
+        return {"pnl": pnl, "close_qty": close_qty, "entry": entry, "positions": positions, "symbol_code": None}
+    # group once by symbol code instead of comparing the object column per symbol
+    symbols, code = np.unique(fills["symbol"], return_inverse=True)
+    code = np.where(fills["qty"] > 0, code, -1)
+    order = np.argsort(code, kind="stable")
+    bounds = np.searchsorted(code[order], np.arange(len(symbols) + 1))
+    for i, sym in enumerate(symbols):
+        pv = point_values.get(sym)
+        idx = order[bounds[i]:bounds[i + 1]]
+        if not pv or not len(idx):
+            continue
+        p, c, e, pos, avg = _symbol_pnl(fills["side"][idx], fills["qty"][idx], fills["price"][idx], pv)
+        pnl[idx] = p
+        close_qty[idx] = c
+        entry[idx] = e
+        positions[sym] = {"pos_qty": pos, "avg_price": avg}
+    return {"pnl": pnl, "close_qty": close_qty, "entry": entry, "positions": positions,
+            "symbol_code": (symbols, code)}
+
+def equity_curve(pnl):
+    return np.cumsum(pnl)
+
+def max_drawdown(equity):
+    if not len(equity):
+        return 0.0
+    peak = np.maximum.accumulate(np.concatenate(([0.0], equity)))[1:]
+    return float(np.max(peak - equity))
+
+def analyze(fills, point_values):
+    res = realized_pnl(fills, point_values)
+    closed = res["close_qty"] > 0
+    pnl = res["pnl"]
+    equity = equity_curve(pnl[closed])
+    wins = int(np.count_nonzero(pnl[closed] > 0))
+    trades = int(np.count_nonzero(closed))
+    per_symbol = {}
+    for sym in res["positions"]:
+        symbols, code = res["symbol_code"]
+        m = closed & (code == np.searchsorted(symbols, sym))
+        per_symbol[sym] = {
+            "realized": float(pnl[m].sum()),
+            "trades": int(np.count_nonzero(m)),
+            "wins": int(np.count_nonzero(pnl[m] > 0)),
+            **res["positions"][sym],
+        }
+    return {
+        "fills": int(len(fills["qty"])),
+        "realized_events": trades,
+        "total_pnl": float(pnl[closed].sum()),
+        "win_rate": wins / trades if trades else None,
+        "max_drawdown": max_drawdown(equity),
+        "equity": equity,
+        "per_symbol": per_symbol,
+        "_detail": res,
+    }
+
+# ================== SLIPPAGE ==================
+def slippage_stats(execs, point_values):
+    """Per-symbol slippage distributions.
+
+    slippage_pts = fill - planned (as shown in Telegram); adverse_pts is side
+    adjusted (positive = worse than planned) and adverse_usd is per contract.
+    """
+    out = {}
+    for sym in np.unique(execs["symbol"]) if len(execs["symbol"]) else []:
+        m = execs["symbol"] == sym
+        raw = execs["fill"][m] - execs["planned"][m]
+        adverse = np.where(execs["side"][m] == 0, raw, -raw)
+        pv = point_values.get(sym) or 0.0
+
+        def _dist(a):
+            return {
+                "mean": float(a.mean()),
+                "std": float(a.std(ddof=1)) if len(a) > 1 else 0.0,
+                "p50": float(np.percentile(a, 50)),
+                "p90": float(np.percentile(a, 90)),
+                "p99": float(np.percentile(a, 99)),
+                "min": float(a.min()),
+                "max": float(a.max()),
+            }
+
+        out[sym] = {
+            "count": int(m.sum()),
+            "slippage_pts": _dist(raw),
+            "adverse_pts": _dist(adverse),
+            "adverse_usd": _dist(adverse * pv),
+        }
+        ttf = execs["time_to_fill_ms"][m]
+        ttf = ttf[~np.isnan(ttf)]
+        if len(ttf):
+            out[sym]["time_to_fill_ms"] = _dist(ttf)
+    return out
+
+# ================== SCALAR REFERENCE / BENCH ==================
+def import_app():
+    # app.py starts background threads on import; keep them away from real endpoints
+    # (no startup login / Telegram getMe, no background token refresh)
+    os.environ.setdefault("WARMUP_ON_START", "0")
+    os.environ.setdefault("TOKEN_BACKGROUND_REFRESH", "0")
+    os.environ.setdefault("JOURNAL_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="analytics-"), "journal.db"))
+    import app
+    return app
+
+def scalar_analyze(app, fills):
+    """The existing per-fill PositionBook plus plain-Python equity/drawdown/win rate."""
+    book = app.PositionBook()
+    for sym, side, qty, price in zip(fills["symbol"].tolist(), fills["side"].tolist(),
+                                     fills["qty"].tolist(), fills["price"].tolist()):
+        if sym in book.state:
+            book.apply(sym, side, qty, price)
+    equity, peak, dd, wins = 0.0, 0.0, 0.0, 0
+    for ev in book.realized_events:
+        equity += ev["pnl"]
+        peak = max(peak, equity)
+        dd = max(dd, peak - equity)
+        wins += ev["pnl"] > 0
+    n = len(book.realized_events)
+    return book, {"total_pnl": book.total_pnl, "max_drawdown": dd,
+                  "win_rate": wins / n if n else None, "realized_events": n}
+
+def compare(book, scalar, vec, rtol=1e-9):
+    """Raise AssertionError unless the vectorized result matches the scalar book."""
+    det = vec["_detail"]
+    closed = np.flatnonzero(det["close_qty"] > 0)
+    assert len(closed) == len(book.realized_events), "realized event count differs"
+    s_pnl = np.array([ev["pnl"] for ev in book.realized_events])
+    s_qty = np.array([ev["qty"] for ev in book.realized_events])
+    s_entry = np.array([ev["entry"] for ev in book.realized_events])
+    assert np.array_equal(s_qty, det["close_qty"][closed]), "closed quantities differ"
+    assert np.allclose(s_entry, det["entry"][closed], rtol=rtol, atol=1e-9), "entry prices differ"
+    assert np.allclose(s_pnl, det["pnl"][closed], rtol=rtol, atol=1e-6), "per-event PnL differs"
+    assert round(scalar["total_pnl"], 2) == round(vec["total_pnl"], 2), "total PnL differs"
+    assert round(scalar["max_drawdown"], 2) == round(vec["max_drawdown"], 2), "max drawdown differs"
+    assert scalar["win_rate"] == vec["win_rate"], "win rate differs"
+    for sym, st in book.state.items():
+        v = vec["per_symbol"].get(sym, {"pos_qty": 0, "avg_price": 0.0})
+        assert st["pos_qty"] == v["pos_qty"], f"{sym} position differs"
+        assert abs(st["avg_price"] - v["avg_price"]) <= 1e-9 * max(1.0, abs(st["avg_price"])), \
+            f"{sym} average price differs"
+    diff = float(np.max(np.abs(s_pnl - det["pnl"][closed]))) if len(closed) else 0.0
+    return diff
+
+def synthetic_fills(n, symbols=("MNQ", "MGC"), seed=7):
+    rng = np.random.default_rng(seed)
+    sym = rng.choice(np.array(symbols, dtype=str), size=n)
+    base = {"MNQ": 21000.0, "MGC": 2650.0, "ES": 6000.0, "NQ": 21000.0, "GC": 2650.0, "CL": 70.0}
+    price = np.empty(n)
+    for s in symbols:
+        m = sym == s
+        # quarter-point tick random walk
+        price[m] = base.get(s, 100.0) + np.cumsum(rng.integers(-8, 9, size=int(m.sum()))) * 0.25
+    return make_fills(
+        np.arange(n, dtype=np.float64),
+        sym,
+        rng.integers(0, 2, size=n),
+        rng.integers(1, 4, size=n),
+        price,
+    )
+
+def bench(n, repeat=3):
+    app = import_app()
+    pv = {s: app.registry.point_value(s) for s in app.registry.roots}
+    fills = synthetic_fills(n, symbols=tuple(app.registry.roots))
+
+    t_scalar = min(_timed(lambda: scalar_analyze(app, fills)) for _ in range(repeat))
+    t_vec = min(_timed(lambda: analyze(fills, pv)) for _ in range(repeat))
+
+    book, scalar = scalar_analyze(app, fills)
+    vec = analyze(fills, pv)
+    diff = compare(book, scalar, vec)
+    print(f"fills: {n}  realized events: {scalar['realized_events']}")
+    print(f"scalar PositionBook: {t_scalar * 1000:.1f} ms")
+    print(f"numpy vectorized:    {t_vec * 1000:.1f} ms  ({t_scalar / t_vec:.1f}x)")
+    print(f"total PnL: scalar {scalar['total_pnl']:.2f}  numpy {vec['total_pnl']:.2f}  "
+          f"max |per-event diff| {diff:.2e}")
+    print(f"max drawdown {vec['max_drawdown']:.2f}  win rate {vec['win_rate']:.4f}  -> results match")
+
+def _timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+def print_report(rep, slip):
+    print(f"fills: {rep['fills']}  realized trades: {rep['realized_events']}")
+    print(f"total realized PnL: {rep['total_pnl']:,.2f}")
+    wr = rep["win_rate"]
+    print(f"win rate: {wr * 100:.1f}%" if wr is not None else "win rate: N/A")
+    print(f"max drawdown: {rep['max_drawdown']:,.2f}")
+    for sym, st in rep["per_symbol"].items():
+        print(f"  {sym}: realized {st['realized']:,.2f} over {st['trades']} trades, "
+              f"open {st['pos_qty']} @ {round(st['avg_price'], 4)}")
+    for sym, st in slip.items():
+        a = st["adverse_pts"]
+        print(f"  {sym} slippage (n={st['count']}, adverse pts): mean {a['mean']:.4f} "
+              f"p50 {a['p50']:.4f} p90 {a['p90']:.4f} p99 {a['p99']:.4f}")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--journal", help="path to the app's journal.db")
+    p.add_argument("--days", type=float, default=30, help="look-back window for --journal")
+    p.add_argument("--bench", type=int, metavar="N", help="benchmark against PositionBook on N synthetic fills")
+    args = p.parse_args()
+
+    if args.bench:
+        bench(args.bench)
+    elif args.journal:
+        app = import_app()
+        pv = {s: app.registry.point_value(s) for s in app.registry.roots}
+        start = (datetime.datetime.utcnow() - datetime.timedelta(days=args.days) -
+                 datetime.datetime(1970, 1, 1)).total_seconds()
+        report = analyze(load_journal_fills(args.journal, start_epoch=start), pv)
+        slip = slippage_stats(load_journal_executions(args.journal, start_epoch=start), pv)
+        print_report(report, slip)
+    else:
+        p.print_help()
+        sys.exit(1)
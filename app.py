@@ -1,8 +1,24 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import atexit
+import base64
+import contextlib
 import datetime
+import email.utils
+import hashlib
+import heapq
+import json
 import logging
+import math
+import queue
+import re
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 import time
 from zoneinfo import ZoneInfo  # Python 3.9+
 
@@ -51,6 +67,18 @@ def ny_today_start_utc():
     )
     return ny_start.astimezone(datetime.timezone.utc)
 
+def ny_week_start_utc():
+    # Monday 00:00 NY
+    now_ny = datetime.datetime.now(NY_TZ)
+    monday = now_ny.date() - datetime.timedelta(days=now_ny.weekday())
+    ny_start = datetime.datetime(monday.year, monday.month, monday.day, 0, 0, 0, tzinfo=NY_TZ)
+    return ny_start.astimezone(datetime.timezone.utc)
+
+def ny_month_start_utc():
+    now_ny = datetime.datetime.now(NY_TZ)
+    ny_start = datetime.datetime(now_ny.year, now_ny.month, 1, 0, 0, 0, tzinfo=NY_TZ)
+    return ny_start.astimezone(datetime.timezone.utc)
+
 def parse_ts(ts: str):
     # Topstep timestamps usually like "2026-01-02T15:04:05.123Z"
     if not ts:
@@ -64,327 +92,4099 @@ def parse_ts(ts: str):
     except Exception:
         return None
 
-# ================== ENV ==================
-USERNAME = os.getenv("TOPSTEP_USER")
-API_KEY = os.getenv("TOPSTEP_KEY")
-TARGET_ACCOUNT_NAME = os.getenv("TARGET_ACCOUNT")
+# ================== ENV ==================
+USERNAME = os.getenv("TOPSTEP_USER")
+API_KEY = os.getenv("TOPSTEP_KEY")
+TARGET_ACCOUNT_NAME = os.getenv("TARGET_ACCOUNT")
+
+TG_BOT_TOKEN = os.getenv("TG_BOT_TOKEN")
+TG_CHAT_ID = os.getenv("TG_CHAT_ID")
+
+TG_QUEUE_MAX = int(os.getenv("TG_QUEUE_MAX", 1000))
+TG_WORKERS = int(os.getenv("TG_WORKERS", 1))
+# how long a worker waits to collect a burst before sending
+TG_BATCH_WINDOW_MS = int(os.getenv("TG_BATCH_WINDOW_MS", 200))
+# Telegram allows ~1 message/sec per chat
+TG_CHAT_MIN_INTERVAL_SEC = float(os.getenv("TG_CHAT_MIN_INTERVAL_SEC", 1.0))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 4))
+TG_MAX_TEXT = 4096
+
+BASE_URL = os.getenv("TOPSTEP_BASE_URL", "https://api.topstepx.com")
+TG_API_URL = os.getenv("TG_API_URL", "https://api.telegram.org")
+
+BROKER_POOL_SIZE = int(os.getenv("BROKER_POOL_SIZE", 10))
+
+# client-side budget shared by every broker call: at most "count/seconds" in any sliding window
+# (empty = unlimited). TopstepX allows roughly 200 requests/min; a little is left for clock drift.
+# Orders queue first, and other calls leave the last BROKER_ORDER_RESERVE of the window to them,
+# so a bar-close cluster of entries goes out at once
+BROKER_RATE_WINDOW = os.getenv("BROKER_RATE_WINDOW", "190/60")
+BROKER_ORDER_RESERVE = int(os.getenv("BROKER_ORDER_RESERVE", 40))
+# optional token buckets per endpoint family on top: "family:per_sec/burst,..." (empty or 0 = unlimited)
+BROKER_RATE_LIMITS = os.getenv("BROKER_RATE_LIMITS", "auth:0.2/4")
+# HTTP 429 handling: retries, and the base of the exponential backoff when no Retry-After
+BROKER_429_RETRIES = int(os.getenv("BROKER_429_RETRIES", 3))
+BROKER_429_BACKOFF_SEC = float(os.getenv("BROKER_429_BACKOFF_SEC", 1.0))
+
+# token lifetime used when the JWT carries no "exp" claim
+TOKEN_TTL_SEC = int(os.getenv("TOKEN_TTL_SEC", 24 * 3600))
+# refresh this long before expiry
+TOKEN_REFRESH_MARGIN_SEC = int(os.getenv("TOKEN_REFRESH_MARGIN_SEC", 30 * 60))
+TOKEN_BACKGROUND_REFRESH = os.getenv("TOKEN_BACKGROUND_REFRESH", "1") == "1"
+
+# fill confirmation: fast first checks, then back off (seconds between polls)
+FILL_POLL_SCHEDULE = [
+    float(x) for x in os.getenv("FILL_POLL_SCHEDULE", "0.05,0.1,0.15,0.25,0.4,0.6,1.0").split(",")
+]
+FILL_TIMEOUT_SEC = float(os.getenv("FILL_TIMEOUT_SEC", 6.0))
+
+# async ack mode: /webhook answers 202 and a worker pool executes from a durable queue
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+SIGNAL_DB_PATH = os.getenv("SIGNAL_DB_PATH", "signals.db")
+SIGNAL_WORKERS = int(os.getenv("SIGNAL_WORKERS", 4))
+# queued signals older than this are not replayed after a restart
+SIGNAL_REPLAY_MAX_AGE_SEC = int(os.getenv("SIGNAL_REPLAY_MAX_AGE_SEC", 60))
+
+# background check of local net positions against /api/Position/searchOpen
+POSITION_RECONCILE_SEC = int(os.getenv("POSITION_RECONCILE_SEC", 30))
+# contracts touched locally within this window are not compared (fills may still be settling)
+POSITION_RECONCILE_GRACE_SEC = float(os.getenv("POSITION_RECONCILE_GRACE_SEC", 5))
+
+# concurrent bulk broker operations (cancel-all, flatten-all, ...)
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", 8))
+BULK_RETRIES = int(os.getenv("BULK_RETRIES", 1))
+
+# long history ranges are fetched as concurrent slices
+HISTORY_SLICE_HOURS = float(os.getenv("HISTORY_SLICE_HOURS", 24))
+HISTORY_WORKERS = int(os.getenv("HISTORY_WORKERS", 4))
+
+# local order/fill journal serving Trade History and Today Stats
+JOURNAL_DB_PATH = os.getenv("JOURNAL_DB_PATH", "journal.db")
+JOURNAL_SYNC_SEC = int(os.getenv("JOURNAL_SYNC_SEC", 60))
+# how far back the first sync reaches
+JOURNAL_BACKFILL_HOURS = int(os.getenv("JOURNAL_BACKFILL_HOURS", 48))
+
+# Balance / Open Orders / account metadata answered from a snapshot this fresh
+SNAPSHOT_TTL_SEC = float(os.getenv("SNAPSHOT_TTL_SEC", 5))
+
+# log in, resolve account/contracts and open connections at startup; /readyz waits for it
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "1") == "1"
+
+# re-delivered alerts (same alert_id, or same symbol/action/qty/entry/bar time) within
+# this window get the original response instead of a second order
+IDEMPOTENCY_TTL_SEC = int(os.getenv("IDEMPOTENCY_TTL_SEC", 600))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", 10000))
+# also claim keys in the shared state backend (catches duplicates across workers/restarts)
+IDEMPOTENCY_PERSIST = os.getenv("IDEMPOTENCY_PERSIST", "0") == "1"
+# how long a duplicate waits for the original delivery to finish
+IDEMPOTENCY_WAIT_SEC = float(os.getenv("IDEMPOTENCY_WAIT_SEC", 10))
+
+# "sync": Flask, one blocking thread per request. "async": aiohttp event loop (async_server.py)
+SERVER_MODE = os.getenv("SERVER_MODE", "sync")
+# broker sockets opened up front so simultaneous first signals skip the TLS handshake
+WARMUP_BROKER_CONNECTIONS = int(os.getenv("WARMUP_BROKER_CONNECTIONS", 2))
+
+# shared runtime state (token, account, last signal/exec, start time):
+# memory:// (one process), sqlite:///path/state.db (workers on one host), redis://host:6379/0
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "memory://")
+# with a shared backend other workers trade too: net positions here only see this process's fills
+SHARED_WORKERS = not STATE_BACKEND_URL.startswith("memory://")
+STATE_KEY_PREFIX = os.getenv("STATE_KEY_PREFIX", "topstepx:")
+# the shared start time survives while any worker heartbeats within this window
+STATE_HEARTBEAT_SEC = int(os.getenv("STATE_HEARTBEAT_SEC", 15))
+# a login lock held longer than this (crashed worker) is taken over
+LOGIN_LOCK_LEASE_SEC = int(os.getenv("LOGIN_LOCK_LEASE_SEC", 90))
+
+# copy trading: more accounts (by name) that take every signal, "Name:multiplier,...".
+# Sizes are qty * multiplier rounded down; a leg that rounds to 0 is skipped
+COPY_ACCOUNTS = [
+    (name.strip(), float(mult or 1))
+    for name, _, mult in (part.rpartition(":") if ":" in part else (part, "", "1")
+                          for part in os.getenv("COPY_ACCOUNTS", "").split(","))
+    if name.strip()
+]
+COPY_WORKERS = int(os.getenv("COPY_WORKERS", 8))
+
+# buy/sell signals for one symbol arriving within this many ms are netted into one order
+# (or none when they cancel out); 0 = off. CLOSE signals are never held back
+NETTING_WINDOW_MS = float(os.getenv("NETTING_WINDOW_MS", 0))
+
+# open stop/target brackets are checked this often for a filled leg (OCO): one order search
+# per account holding brackets, at fill priority, out of the shared broker budget
+BRACKET_POLL_SEC = float(os.getenv("BRACKET_POLL_SEC", 3))
+
+# streaming slippage / time-to-fill stats per symbol, side and NY hour, checkpointed to disk
+EXEC_STATS_PATH = os.getenv("EXEC_STATS_PATH", "exec_stats.json")
+EXEC_STATS_CHECKPOINT_SEC = int(os.getenv("EXEC_STATS_CHECKPOINT_SEC", 60))
+# quantile sketch: relative accuracy and max buckets per sign (memory per stat is bounded by this).
+# Buckets cover a max/min ratio of ((1+alpha)/(1-alpha)) ** bins: 2048 at 1% spans ~6e17,
+# so fill times (ms..s) and slippage (ticks..points) never reach the cap
+EXEC_STATS_ALPHA = float(os.getenv("EXEC_STATS_ALPHA", 0.01))
+EXEC_STATS_MAX_BINS = int(os.getenv("EXEC_STATS_MAX_BINS", 2048))
+
+cached_account_id = None  # local mirror of the shared "account_id"
+copy_accounts = []        # [{"id", "name", "multiplier"}] resolved from COPY_ACCOUNTS
+
+# ================== SYMBOL MAP ==================
+# root symbols the webhook accepts; each is resolved to its front month at runtime
+SYMBOLS = [x.strip().upper() for x in os.getenv("SYMBOLS", "MNQ,MGC").split(",") if x.strip()]
+
+# fallback contract ids, used until the contract registry has resolved a root
+SYMBOL_MAP = {
+    "MGC": "CON.F.US.MGC.G26",
+    "MNQ": "CON.F.US.MNQ.H26",
+}
+
+# $ per 1.0 point (not tick); the registry prefers the broker's tickValue / tickSize
+POINT_VALUE = {
+    "MNQ": 2.0,   # Micro Nasdaq: $2 per point
+    "MGC": 10.0,  # Micro Gold: $10 per point
+    "NQ": 20.0,
+    "ES": 50.0,
+    "MES": 5.0,
+    "GC": 100.0,
+    "CL": 1000.0,
+    "MCL": 100.0,
+}
+
+# minimum price increment, for bracket distances given in ticks; the registry prefers the broker's tickSize
+TICK_SIZE = {
+    "MNQ": 0.25,
+    "MGC": 0.1,
+    "NQ": 0.25,
+    "ES": 0.25,
+    "MES": 0.25,
+    "GC": 0.1,
+    "CL": 0.01,
+    "MCL": 0.01,
+}
+
+# re-resolve the front month at least this often
+CONTRACT_REFRESH_HOURS = float(os.getenv("CONTRACT_REFRESH_HOURS", 12))
+# start checking for the next contract this many days before the estimated expiry
+CONTRACT_ROLL_LEAD_DAYS = int(os.getenv("CONTRACT_ROLL_LEAD_DAYS", 10))
+
+def contract_to_symbol(contract_id: str):
+    if not contract_id:
+        return ""
+    return registry.symbol_for(str(contract_id))
+
+# ================== STATE BACKEND ==================
+class MemoryState:
+    """Process-local state: the default for a single worker."""
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.data = {}   # key -> (value, expires monotonic or None)
+        self.locks = {}  # name -> threading.Lock
+
+    def _live(self, key):
+        item = self.data.get(key)
+        if item and item[1] is not None and item[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return item
+
+    def get(self, key, default=None):
+        with self.mutex:
+            item = self._live(key)
+        return item[0] if item else default
+
+    def set(self, key, value, ttl=None):
+        with self.mutex:
+            self.data[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    def setnx(self, key, value, ttl=None):
+        with self.mutex:
+            if self._live(key):
+                return False
+            self.data[key] = (value, time.monotonic() + ttl if ttl else None)
+            return True
+
+    def expire(self, key, ttl):
+        with self.mutex:
+            item = self._live(key)
+            if item:
+                self.data[key] = (item[0], time.monotonic() + ttl)
+
+    def delete(self, key):
+        with self.mutex:
+            self.data.pop(key, None)
+
+    @contextlib.contextmanager
+    def lock(self, name, lease=LOGIN_LOCK_LEASE_SEC, timeout=None):
+        with self.mutex:
+            lk = self.locks.setdefault(name, threading.Lock())
+        if not lk.acquire(timeout=lease if timeout is None else timeout):
+            raise TimeoutError(f"state lock {name} busy")
+        try:
+            yield
+        finally:
+            lk.release()
+
+class SQLiteState:
+    """State in a local SQLite file shared by the workers on one host.
+
+    Values are JSON. Locks are leased rows taken inside BEGIN IMMEDIATE,
+    so they serialize threads and processes alike.
+    """
+
+    POLL_SEC = 0.05
+
+    def __init__(self, path):
+        self.mutex = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+
+    def get(self, key, default=None):
+        with self.mutex:
+            row = self.db.execute(
+                "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value, ttl=None):
+        with self.mutex:
+            self.db.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value, default=str), time.time() + ttl if ttl else None),
+            )
+
+    def setnx(self, key, value, ttl=None):
+        now = time.time()
+        with self.mutex:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("DELETE FROM kv WHERE key = ? AND expires IS NOT NULL AND expires <= ?", (key, now))
+                cur = self.db.execute(
+                    "INSERT OR IGNORE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, default=str), now + ttl if ttl else None),
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return cur.rowcount == 1
+
+    def expire(self, key, ttl):
+        with self.mutex:
+            self.db.execute("UPDATE kv SET expires = ? WHERE key = ?", (time.time() + ttl, key))
+
+    def delete(self, key):
+        with self.mutex:
+            self.db.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def _try_lock(self, name, owner, lease):
+        now = time.time()
+        with self.mutex:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("DELETE FROM locks WHERE name = ? AND expires <= ?", (name, now))
+                cur = self.db.execute(
+                    "INSERT OR IGNORE INTO locks (name, owner, expires) VALUES (?, ?, ?)", (name, owner, now + lease)
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return cur.rowcount == 1
+
+    @contextlib.contextmanager
+    def lock(self, name, lease=LOGIN_LOCK_LEASE_SEC, timeout=None):
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + (lease if timeout is None else timeout)
+        while not self._try_lock(name, owner, lease):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"state lock {name} busy")
+            time.sleep(self.POLL_SEC)
+        try:
+            yield
+        finally:
+            with self.mutex:
+                self.db.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+class RedisState:
+    """State in Redis (or any server speaking its protocol) for workers on many hosts.
+
+    Needs the redis package. Locks are SET NX PX leases released only by
+    their owner.
+    """
+
+    POLL_SEC = 0.05
+    RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url, prefix=STATE_KEY_PREFIX):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND_URL=redis://... needs the redis package (pip install redis)")
+        self.r = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.release = self.r.register_script(self.RELEASE)
+
+    def get(self, key, default=None):
+        raw = self.r.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else default
+
+    def set(self, key, value, ttl=None):
+        self.r.set(self.prefix + key, json.dumps(value, default=str), ex=int(ttl) if ttl else None)
+
+    def setnx(self, key, value, ttl=None):
+        return bool(self.r.set(self.prefix + key, json.dumps(value, default=str), nx=True,
+                               ex=int(ttl) if ttl else None))
+
+    def expire(self, key, ttl):
+        self.r.expire(self.prefix + key, int(ttl))
+
+    def delete(self, key):
+        self.r.delete(self.prefix + key)
+
+    @contextlib.contextmanager
+    def lock(self, name, lease=LOGIN_LOCK_LEASE_SEC, timeout=None):
+        key = f"{self.prefix}lock:{name}"
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + (lease if timeout is None else timeout)
+        while not self.r.set(key, owner, nx=True, px=int(lease * 1000)):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"state lock {name} busy")
+            time.sleep(self.POLL_SEC)
+        try:
+            yield
+        finally:
+            self.release(keys=[key], args=[owner])
+
+def make_state(url):
+    if url.startswith("sqlite:///"):
+        return SQLiteState(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisState(url)
+    if url in ("", "memory://"):
+        return MemoryState()
+    raise ValueError(f"Unknown STATE_BACKEND_URL: {url}")
+
+state = make_state(STATE_BACKEND_URL)
+
+# ================== RUNTIME STATE (Telegram utilities) ==================
+# first worker up sets the start time; later workers (and restarts while any
+# worker is alive) share it
+state.setnx("server_start_utc", utc_now().isoformat(), ttl=STATE_HEARTBEAT_SEC * 4)
+SERVER_START_UTC = parse_ts(state.get("server_start_utc")) or utc_now()
+
+def state_heartbeat():
+    while True:
+        time.sleep(STATE_HEARTBEAT_SEC)
+        try:
+            if not state.setnx("server_start_utc", SERVER_START_UTC.isoformat(), ttl=STATE_HEARTBEAT_SEC * 4):
+                state.expire("server_start_utc", STATE_HEARTBEAT_SEC * 4)
+        except Exception as e:
+            logging.warning(f"State heartbeat failed: {e}")
+
+def set_last(key, data, when=None):
+    state.set(key, {"utc": (when or utc_now()).isoformat(), "data": data})
+
+def get_last(key):
+    """(utc, dict) for "last_signal" / "last_exec", or (None, None)."""
+    item = state.get(key)
+    if not item:
+        return None, None
+    return parse_ts(item.get("utc")), item.get("data")
+
+# ================== TELEGRAM ==================
+class TelegramOutbox:
+    """Bounded background queue for Telegram sends.
+
+    Bursts to the same chat are merged into one message, each chat is paced to
+    TG_CHAT_MIN_INTERVAL_SEC, and failures are retried with backoff (honouring
+    429 retry_after). Callers only pay for an enqueue.
+    """
+
+    def __init__(self, workers=1, maxsize=1000):
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(max(1, workers))]
+        self.next_allowed = {}  # chat_id -> monotonic time
+        self.lock = threading.Lock()
+        self.threads = []
+        self.enqueued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self.retries = 0
+        self.send_ms_total = 0.0
+        self.send_ms_max = 0.0
+
+    def start(self):
+        if self.threads:
+            return
+        for i, q in enumerate(self.queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"tg-outbox-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def put(self, chat_id, text, keyboard=None):
+        # same chat always lands on the same worker, so per-chat order is kept
+        q = self.queues[hash(str(chat_id)) % len(self.queues)]
+        try:
+            q.put_nowait((chat_id, text, keyboard))
+            with self.lock:
+                self.enqueued += 1
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            logging.error(f"Telegram outbox full, dropped message to {chat_id}")
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def _run(self, q):
+        while True:
+            batch = [q.get()]
+            deadline = time.monotonic() + TG_BATCH_WINDOW_MS / 1000.0
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            for chat_id, text, keyboard in self._merge(batch):
+                self._pace(chat_id)
+                self._deliver(chat_id, text, keyboard)
+            for _ in batch:
+                q.task_done()
+
+    def _merge(self, batch):
+        # join consecutive plain messages per chat; keyboard messages stay separate
+        out = []
+        last_plain = {}  # chat_id -> index in out
+        for chat_id, text, keyboard in batch:
+            i = last_plain.get(chat_id)
+            if keyboard is None and i is not None and len(out[i][1]) + len(text) + 2 <= TG_MAX_TEXT:
+                out[i] = (chat_id, out[i][1] + "\n\n" + text, None)
+                with self.lock:
+                    self.merged += 1
+                continue
+            out.append((chat_id, text, keyboard))
+            if keyboard is None:
+                last_plain[chat_id] = len(out) - 1
+            else:
+                last_plain.pop(chat_id, None)
+        return out
+
+    def _pace(self, chat_id):
+        wait = self.next_allowed.get(chat_id, 0) - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self.next_allowed[chat_id] = time.monotonic() + TG_CHAT_MIN_INTERVAL_SEC
+
+    def _deliver(self, chat_id, text, keyboard):
+        payload = {"chat_id": chat_id, "text": text[:TG_MAX_TEXT]}
+        if keyboard:
+            payload["reply_markup"] = keyboard
+        delay = 0.5
+        for attempt in range(TG_MAX_RETRIES + 1):
+            t0 = time.perf_counter()
+            try:
+                r = tg_http.post(
+                    f"/bot{TG_BOT_TOKEN}/sendMessage", label="sendMessage", json=payload, timeout=8
+                )
+                ms = (time.perf_counter() - t0) * 1000
+                metrics.observe("telegram_send_seconds", ms / 1000)
+                if r.status_code == 200:
+                    with self.lock:
+                        self.sent += 1
+                        self.send_ms_total += ms
+                        self.send_ms_max = max(self.send_ms_max, ms)
+                    return
+                if r.status_code == 429:
+                    retry_after = (r.json().get("parameters") or {}).get("retry_after", delay)
+                    delay = max(delay, float(retry_after))
+                elif r.status_code < 500:
+                    logging.error(f"Telegram error {r.status_code}: {r.text[:200]}")
+                    break
+            except Exception as e:
+                logging.error(f"Telegram error: {e}")
+            if attempt < TG_MAX_RETRIES:
+                with self.lock:
+                    self.retries += 1
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+        with self.lock:
+            self.failed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": self.depth(),
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "sent": self.sent,
+                "merged": self.merged,
+                "failed": self.failed,
+                "retries": self.retries,
+                "avg_send_ms": round(self.send_ms_total / self.sent, 1) if self.sent else None,
+                "max_send_ms": round(self.send_ms_max, 1),
+            }
+
+tg_outbox = TelegramOutbox(workers=TG_WORKERS, maxsize=TG_QUEUE_MAX)
+
+def tg_send(chat_id, text, keyboard=None):
+    if not TG_BOT_TOKEN or not chat_id:
+        return
+    tg_outbox.put(chat_id, text, keyboard)
+
+def tg_menu(chat_id):
+    tg_send(
+        chat_id,
+        "🎛️ Trading Control Panel v2.0",
+        {
+            "keyboard": [
+                ["💰 Balance", "🟢 Status"],
+                ["📊 Open Orders", "📈 Trade History"],
+                ["📌 Last Trade", "💥 Last Slippage"],
+                ["📊 Today Stats", "⏱️ Uptime / Last Signal"],
+                ["🚫 Cancel ALL Open Orders", "🔄 Refresh Menu"],
+                ["📅 Week Stats", "🗓️ Month Stats"],
+                ["⏱️ Latency", "📉 Fill Quality"],
+            ],
+            "resize_keyboard": True
+        }
+    )
+
+# ================== UTILS ==================
+def normalize_symbol(raw: str) -> str:
+    return registry.root_for(raw)
+
+# ================== METRICS ==================
+# seconds; covers sub-ms in-process stages up to slow broker calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    """In-process histograms/counters rendered in Prometheus text format.
+
+    Each histogram name (and name.stage / name.priority when labelled so)
+    also keeps a bounded window of recent samples for p50/p95/p99 in Telegram.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, window=2048):
+        self.buckets = buckets
+        self.window = window
+        self.lock = threading.Lock()
+        self.hists = {}     # (name, labels) -> [bucket counts..., sum, count]
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}    # name -> callable returning a number
+        self.recent = {}    # name -> deque of seconds
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.hists.get(key)
+            if h is None:
+                h = self.hists[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if seconds <= b:
+                    h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+            self.recent.setdefault(name, deque(maxlen=self.window)).append(seconds)
+            for label in ("stage", "priority"):
+                if label in labels:
+                    self.recent.setdefault(f"{name}.{labels[label]}", deque(maxlen=self.window)).append(seconds)
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def percentiles(self, name, qs=(50, 95, 99)):
+        with self.lock:
+            data = sorted(self.recent.get(name, ()))
+        if not data:
+            return {q: None for q in qs}
+        return {q: data[min(len(data) - 1, int(round(q / 100 * (len(data) - 1))))] for q in qs}
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        body = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                        for k, v in items)
+        return "{" + body + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            hists = sorted(self.hists.items())
+            counters = sorted(self.counters.items())
+        seen = set()
+        for (name, labels), h in hists:
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+            for i, b in enumerate(self.buckets):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', b)])} {h[i]}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {h[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h[-2]:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {h[-1]}")
+        for (name, labels), v in counters:
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._labels(labels)} {v}")
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                value = float(fn())
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("webhook_stage_seconds", "Time spent in each /webhook stage")
+metrics.describe("signal_to_ack_seconds", "Webhook receipt to HTTP response")
+metrics.describe("signal_to_fill_seconds", "Webhook receipt to confirmed broker fill")
+metrics.describe("http_request_seconds", "Outbound HTTP call latency")
+metrics.describe("broker_errors_total", "Broker calls that raised or returned HTTP >= 400")
+metrics.describe("broker_retries_total", "Broker calls retried")
+
+class StageTimer:
+    """Collects named stage durations for one signal, flushed with its labels."""
+
+    def __init__(self):
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - t0))
+
+    def flush(self, symbol="unknown", action="unknown"):
+        for name, seconds in self.stages:
+            metrics.observe("webhook_stage_seconds", seconds, stage=name, symbol=symbol, action=action)
+        self.stages = []
+
+# ================== RATE LIMITER ==================
+PRIORITY_ORDER, PRIORITY_FILL, PRIORITY_REPORT = 0, 1, 2
+PRIORITY_NAMES = ("order", "fill", "report")
+
+# endpoint -> family; anything else is "query"
+RATE_FAMILIES = {
+    "/api/Order/place": "order",
+    "/api/Order/cancel": "order",
+    "/api/Order/modify": "order",
+    "/api/Auth/loginKey": "auth",
+    "/api/Auth/validate": "auth",
+}
+
+def parse_rate_limits(spec):
+    limits = {}
+    for part in spec.split(","):
+        if ":" not in part:
+            continue
+        family, rate = part.split(":", 1)
+        per_sec, _, burst = rate.partition("/")
+        limits[family.strip()] = (float(per_sec), max(1.0, float(burst or per_sec or 1)))
+    return limits
+
+def parse_rate_window(spec):
+    """"count/seconds" -> (count, seconds), or None when empty or zero."""
+    count, _, seconds = spec.partition("/")
+    if not count.strip() or int(count) <= 0:
+        return None
+    return int(count), float(seconds or 60)
+
+def retry_after_sec(r):
+    """Seconds from a Retry-After header (delta or HTTP date), else None."""
+    value = r.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class RateLimiter:
+    """Client-side rate limits with priority queueing.
+
+    Every call counts against one sliding window shared by all endpoints
+    (window=(count, seconds)); families may add a token bucket on top. Each
+    limit queues its callers by (priority, arrival) and only the head may go,
+    so a burst of reporting calls waits behind queued orders and fill polls.
+    Non-order calls also stop reserve calls short of the window, which keeps
+    room for orders. A 429 blocks the family and the window until Retry-After.
+    """
+
+    def __init__(self, limits, families=RATE_FAMILIES, window=None, reserve=0):
+        self.families = families
+        self.cond = threading.Condition()
+        self.seq = 0
+        now = time.monotonic()
+        self.buckets = {
+            name: {"rate": rate, "burst": burst, "tokens": burst, "stamp": now,
+                   "blocked_until": 0.0, "queue": [], "throttled": 0}
+            for name, (rate, burst) in limits.items() if rate > 0
+        }
+        self.window = None
+        if window:
+            count, seconds = window
+            self.window = {"count": count, "seconds": seconds, "reserve": min(reserve, count - 1),
+                           "sent": deque(), "blocked_until": 0.0, "queue": [], "throttled": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.buckets or self.window)
+
+    def family(self, path):
+        return self.families.get(path, "query")
+
+    def _refill(self, b, now):
+        b["tokens"] = min(b["burst"], b["tokens"] + (now - b["stamp"]) * b["rate"])
+        b["stamp"] = now
+
+    def enqueue(self, path, priority=None):
+        """Join the queues; a ticket for take(), or None if nothing limits this call."""
+        family = self.family(path)
+        if priority is None:
+            priority = PRIORITY_ORDER if family == "order" else PRIORITY_REPORT
+        b = self.buckets.get(family)
+        if b is None and self.window is None:
+            return None
+        with self.cond:
+            entry = (priority, self.seq)
+            self.seq += 1
+            # the family bucket first; the window queue is joined once a token is in hand
+            heapq.heappush(b["queue"] if b is not None else self.window["queue"], entry)
+        return {"family": family, "bucket": b, "entry": entry, "t0": time.monotonic()}
+
+    def _take_token(self, ticket, now):
+        b = ticket["bucket"]
+        self._refill(b, now)
+        if b["queue"][0] != ticket["entry"] or now < b["blocked_until"] or b["tokens"] < 1:
+            return max(b["blocked_until"] - now, (1 - b["tokens"]) / b["rate"], 0.001)
+        heapq.heappop(b["queue"])
+        b["tokens"] -= 1
+        ticket["bucket"] = None
+        if self.window is not None:
+            heapq.heappush(self.window["queue"], ticket["entry"])
+        return 0.0
+
+    def _take_slot(self, ticket, now):
+        w = self.window
+        sent = w["sent"]
+        while sent and sent[0] <= now - w["seconds"]:
+            sent.popleft()
+        allowed = w["count"] - (0 if ticket["family"] == "order" else w["reserve"])
+        wait = w["blocked_until"] - now
+        if len(sent) >= allowed:
+            wait = max(wait, sent[len(sent) - allowed] + w["seconds"] - now)
+        if w["queue"][0] != ticket["entry"] or wait > 0:
+            return max(wait, 0.001)
+        heapq.heappop(w["queue"])
+        sent.append(now)
+        return 0.0
+
+    def take(self, ticket):
+        """Claim the call's place: 0.0 once it may go out, else seconds until it is worth retrying.
+
+        Never blocks, so the asyncio server can wait with asyncio.sleep.
+        """
+        with self.cond:
+            now = time.monotonic()
+            if ticket["bucket"] is not None:
+                delay = self._take_token(ticket, now)
+                if delay:
+                    return delay
+            if self.window is not None:
+                delay = self._take_slot(ticket, now)
+                if delay:
+                    return delay
+            self.cond.notify_all()
+        priority = PRIORITY_NAMES[ticket["entry"][0]]
+        metrics.observe("broker_queue_wait_seconds", now - ticket["t0"], family=ticket["family"], priority=priority)
+        return 0.0
+
+    def abandon(self, ticket):
+        """Leave the queues without going out (the waiter was cancelled)."""
+        queues = [ticket["bucket"]["queue"]] if ticket["bucket"] is not None else []
+        if self.window is not None:
+            queues.append(self.window["queue"])
+        with self.cond:
+            for q in queues:
+                if ticket["entry"] in q:
+                    q.remove(ticket["entry"])
+                    heapq.heapify(q)
+            self.cond.notify_all()
+
+    def acquire(self, path, priority=None):
+        """Block until the call may go out; returns seconds spent queued."""
+        ticket = self.enqueue(path, priority)
+        if ticket is None:
+            return 0.0
+        with self.cond:
+            while True:
+                delay = self.take(ticket)
+                if not delay:
+                    break
+                self.cond.wait(delay)
+        return time.monotonic() - ticket["t0"]
+
+    def backoff(self, path, delay):
+        """The broker answered 429: hold the family (and the shared window) for delay seconds."""
+        with self.cond:
+            until = time.monotonic() + delay
+            b = self.buckets.get(self.family(path))
+            if b is not None:
+                b["blocked_until"] = max(b["blocked_until"], until)
+                b["tokens"] = 0.0
+                b["throttled"] += 1
+            if self.window is not None:
+                self.window["blocked_until"] = max(self.window["blocked_until"], until)
+                self.window["throttled"] += 1
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            now = time.monotonic()
+            out = {}
+            if self.window is not None:
+                w = self.window
+                out["window"] = {
+                    "sent": sum(1 for t in w["sent"] if t > now - w["seconds"]),
+                    "limit": w["count"],
+                    "queued": len(w["queue"]),
+                    "blockedForSec": round(max(0.0, w["blocked_until"] - now), 2),
+                    "throttled": w["throttled"],
+                }
+            for name, b in self.buckets.items():
+                self._refill(b, now)
+                out[name] = {
+                    "tokens": round(b["tokens"], 2),
+                    "queued": len(b["queue"]),
+                    "blockedForSec": round(max(0.0, b["blocked_until"] - now), 2),
+                    "throttled": b["throttled"],
+                }
+            return out
+
+metrics.describe("broker_queue_wait_seconds", "Time a broker call waited for a rate-limit token")
+
+# ================== BROKER CLIENT ==================
+class PooledClient:
+    """Keep-alive HTTP client: one connection pool, shared headers, per-call stats."""
+
+    def __init__(self, base_url, pool_size=10, headers=None, name="broker", limiter=None):
+        self.base_url = base_url
+        self.name = name
+        self.limiter = limiter
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.local = threading.local()  # .connected: this thread's current call opened a socket
+        classes = self.adapter.poolmanager.pool_classes_by_scheme
+        self.adapter.poolmanager.pool_classes_by_scheme = {
+            scheme: self._tracked(pool_cls) for scheme, pool_cls in classes.items()
+        }
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+        if headers:
+            self.session.headers.update(headers)
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def set_header(self, name, value):
+        if value is None:
+            self.session.headers.pop(name, None)
+        else:
+            self.session.headers[name] = value
+
+    def post(self, path, label=None, priority=None, **kwargs):
+        # label: stats key when the path carries secrets or ids
+        label = label or path
+        url = path if path.startswith("http") else f"{self.base_url}{path}"
+        if self.limiter is None:
+            return self._send(url, label, **kwargs)
+        for attempt in range(BROKER_429_RETRIES + 1):
+            self.limiter.acquire(label, priority)
+            r = self._send(url, label, **kwargs)
+            if r.status_code != 429 or attempt == BROKER_429_RETRIES:
+                return r
+            delay = retry_after_sec(r)
+            if delay is None:
+                delay = BROKER_429_BACKOFF_SEC * 2 ** attempt
+            logging.warning(f"429 on {label}, backing off {delay:.1f}s")
+            metrics.inc(f"{self.name}_retries_total", endpoint=label, reason="429")
+            self.limiter.backoff(label, delay)
+
+    def _tracked(self, pool_cls):
+        """pool_cls whose connections flag self.local when they open a socket (TCP+TLS handshake)."""
+        local = self.local
+
+        class Connection(pool_cls.ConnectionCls):
+            def connect(self):
+                local.connected = True
+                return super().connect()
+
+        return type(pool_cls.__name__, (pool_cls,), {"ConnectionCls": Connection})
+
+    def _send(self, url, label, **kwargs):
+        self.local.connected = False
+        t0 = time.perf_counter()
+        try:
+            r = self.session.post(url, **kwargs)
+        except Exception:
+            self._record(label, (time.perf_counter() - t0) * 1000, None)
+            metrics.inc(f"{self.name}_errors_total", endpoint=label, reason="exception")
+            raise
+        ms = (time.perf_counter() - t0) * 1000
+        metrics.observe("http_request_seconds", ms / 1000, client=self.name, endpoint=label)
+        if r.status_code >= 400:
+            metrics.inc(f"{self.name}_errors_total", endpoint=label, reason=str(r.status_code))
+        # this call opened a socket -> pool miss (TCP+TLS handshake paid); per thread, so
+        # concurrent calls don't count each other's connects
+        reused = not self.local.connected
+        self._record(label, ms, reused)
+        logging.debug(f"HTTP {label} {ms:.1f}ms pool={'hit' if reused else 'miss'} status={r.status_code}")
+        return r
+
+    def _record(self, path, ms, reused):
+        with self.lock:
+            st = self.stats.setdefault(path, {
+                "calls": 0, "errors": 0, "hits": 0, "misses": 0,
+                "hit_ms": 0.0, "miss_ms": 0.0, "last_ms": 0.0, "max_ms": 0.0,
+            })
+            st["calls"] += 1
+            st["last_ms"] = ms
+            st["max_ms"] = max(st["max_ms"], ms)
+            if reused is None:
+                st["errors"] += 1
+            elif reused:
+                st["hits"] += 1
+                st["hit_ms"] += ms
+            else:
+                st["misses"] += 1
+                st["miss_ms"] += ms
+
+    def snapshot(self):
+        with self.lock:
+            out = {}
+            for path, st in self.stats.items():
+                out[path] = dict(st)
+                out[path]["avg_hit_ms"] = round(st["hit_ms"] / st["hits"], 1) if st["hits"] else None
+                out[path]["avg_miss_ms"] = round(st["miss_ms"] / st["misses"], 1) if st["misses"] else None
+            return out
+
+    def summary(self):
+        hits = misses = 0
+        hit_ms = miss_ms = 0.0
+        for st in self.snapshot().values():
+            hits += st["hits"]
+            misses += st["misses"]
+            hit_ms += st["hit_ms"]
+            miss_ms += st["miss_ms"]
+        avg_hit = f"{hit_ms / hits:.0f}ms" if hits else "N/A"
+        avg_miss = f"{miss_ms / misses:.0f}ms" if misses else "N/A"
+        return f"Pool hits: {hits} (avg {avg_hit}) | misses: {misses} (avg {avg_miss})"
+
+broker = PooledClient(
+    BASE_URL,
+    pool_size=BROKER_POOL_SIZE,
+    headers={"Accept": "application/json", "Content-Type": "application/json"},
+    limiter=RateLimiter(parse_rate_limits(BROKER_RATE_LIMITS), window=parse_rate_window(BROKER_RATE_WINDOW),
+                        reserve=BROKER_ORDER_RESERVE),
+)
+
+tg_http = PooledClient(TG_API_URL, pool_size=max(2, TG_WORKERS), name="telegram")
+
+# ================== SNAPSHOT CACHE ==================
+class SnapshotCache:
+    """Short-lived broker read snapshots with single-flight fetches.
+
+    A fresh entry is served from memory; concurrent misses for the same key
+    share one upstream call. invalidate() drops entries and bumps a
+    generation so a fetch already in flight is returned to its waiters but
+    not stored.
+    """
+
+    def __init__(self, ttl=SNAPSHOT_TTL_SEC):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}   # key -> (value, monotonic fetched)
+        self.inflight = {}  # key -> {"done", "gen", "value", "error"}
+        self.gen = {}
+        self.stats = {"hits": 0, "shared": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, key, fetch, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[1] < ttl:
+                self.stats["hits"] += 1
+                metrics.inc("snapshot_requests_total", key=key, result="hit")
+                return entry[0]
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {"done": threading.Event(), "gen": self.gen.get(key, 0), "value": None, "error": None}
+                self.inflight[key] = flight
+                self.stats["misses"] += 1
+            else:
+                self.stats["shared"] += 1
+        metrics.inc("snapshot_requests_total", key=key, result="miss" if leader else "shared")
+
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["value"]
+
+        try:
+            flight["value"] = fetch()
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self.lock:
+                if self.inflight.get(key) is flight:
+                    del self.inflight[key]
+                if flight["error"] is None and self.gen.get(key, 0) == flight["gen"]:
+                    self.entries[key] = (flight["value"], time.monotonic())
+            flight["done"].set()
+        return flight["value"]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+
+    def invalidate(self, *keys):
+        """Drop the given keys (all when none given); later reads refetch."""
+        with self.lock:
+            for key in keys or set(self.entries) | set(self.inflight):
+                self.entries.pop(key, None)
+                # waiters keep their flight, new readers start a fresh one
+                self.inflight.pop(key, None)
+                self.gen[key] = self.gen.get(key, 0) + 1
+            self.stats["invalidations"] += 1
+
+    def summary(self):
+        with self.lock:
+            s = dict(self.stats)
+        return f"Snapshots: hits {s['hits']} | shared {s['shared']} | misses {s['misses']} | invalidated {s['invalidations']}"
+
+snapshots = SnapshotCache()
+metrics.describe("snapshot_requests_total", "Balance/Open Orders/account reads by cache outcome")
+
+# ================== TOPSTEP ==================
+def connect_topstep():
+    """Full login: loginKey -> validate -> resolve TARGET_ACCOUNT."""
+    global cached_account_id
+
+    login = broker.post(
+        "/api/Auth/loginKey",
+        json={"userName": USERNAME, "apiKey": API_KEY},
+        timeout=15
+    ).json()
+
+    if not login.get("success"):
+        raise Exception("Login failed")
+
+    validate = broker.post(
+        "/api/Auth/validate",
+        headers={"Authorization": f"Bearer {login['token']}"},
+        timeout=15
+    ).json()
+
+    tokens.set(validate["newToken"])
+
+    accounts = broker.post(
+        "/api/Account/search",
+        json={"onlyActiveAccounts": True},
+        timeout=15
+    ).json().get("accounts", [])
+
+    match = next(
+        (a for a in accounts if a["name"].strip().lower() == TARGET_ACCOUNT_NAME.strip().lower()),
+        None
+    )
+
+    if not match:
+        raise Exception("Target account not found")
+
+    cached_account_id = match["id"]
+    state.set("account_id", cached_account_id)
+    resolve_copy_accounts(accounts)
+    snapshots.put("accounts", accounts)
+
+def resolve_copy_accounts(accounts):
+    """Match COPY_ACCOUNTS names to account ids; missing ones are reported, not fatal."""
+    global copy_accounts
+    by_name = {a["name"].strip().lower(): a for a in accounts}
+    resolved, missing = [], []
+    for name, mult in COPY_ACCOUNTS:
+        acc = by_name.get(name.lower())
+        if acc is None:
+            missing.append(name)
+        elif acc["id"] != cached_account_id:
+            resolved.append({"id": acc["id"], "name": acc["name"], "multiplier": mult})
+    if missing:
+        logging.error(f"Copy accounts not found: {missing}")
+        tg_send(TG_CHAT_ID, "⚠️ COPY ACCOUNTS NOT FOUND\n" + "\n".join(missing))
+    copy_accounts = resolved
+    state.set("copy_accounts", resolved)
+
+def trading_accounts():
+    """Every account a signal is placed on; the TARGET_ACCOUNT first, multiplier 1."""
+    primary = {"id": cached_account_id, "name": TARGET_ACCOUNT_NAME, "multiplier": 1.0}
+    return [primary] + copy_accounts
+
+def account_name(account_id):
+    for acc in trading_accounts():
+        if acc["id"] == account_id:
+            return acc["name"]
+    return str(account_id)
+
+def jwt_expiry(token: str):
+    # read the "exp" claim without verifying the signature
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return datetime.datetime.utcfromtimestamp(int(exp)) if exp else None
+    except Exception:
+        return None
+
+# ================== TOKEN MANAGER ==================
+class TokenManager:
+    """Owns the session token: expiry tracking, background refresh, 401 recovery.
+
+    The token and account id are published to the shared state so other
+    workers adopt them instead of logging in; logins and refreshes run under
+    the cross-process "login" lock.
+    """
+
+    def __init__(self):
+        self.token = None
+        self.issued_utc = None
+        self.expires_utc = None
+        self.last_refresh_utc = None
+        self.last_error = None
+        self.refreshes = 0
+        self.logins = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def set(self, token, issued_utc=None, expires_utc=None, publish=True):
+        self.token = token
+        self.issued_utc = issued_utc or utc_now()
+        self.expires_utc = expires_utc or jwt_expiry(token) or (
+            self.issued_utc + datetime.timedelta(seconds=TOKEN_TTL_SEC)
+        )
+        self.last_error = None
+        broker.set_header("Authorization", f"Bearer {token}")
+        if publish:
+            state.set("token", {
+                "token": token,
+                "issued_utc": self.issued_utc.isoformat(),
+                "expires_utc": self.expires_utc.isoformat(),
+            })
+        self.wake.set()
+
+    def adopt(self):
+        """Take over a token/account another worker published. True if the token changed."""
+        global cached_account_id, copy_accounts
+        account_id = state.get("account_id")
+        if account_id:
+            cached_account_id = account_id
+            copy_accounts = state.get("copy_accounts") or []
+        shared = state.get("token")
+        if not shared or shared.get("token") == self.token:
+            return False
+        self.set(shared["token"], parse_ts(shared.get("issued_utc")), parse_ts(shared.get("expires_utc")),
+                 publish=False)
+        return self.valid()
+
+    def refresh_due(self):
+        return not self.valid() or (
+            self.expires_utc - utc_now() <= datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN_SEC)
+        )
+
+    def valid(self):
+        return bool(self.token) and self.expires_utc is not None and utc_now() < self.expires_utc
+
+    def ensure(self):
+        """Make sure a valid token and account id exist (logs in only when needed)."""
+        if self.valid() and cached_account_id:
+            return
+        with self.lock:
+            if self.valid() and cached_account_id:
+                return
+            if self.adopt() and cached_account_id:
+                return
+            with state.lock("login"):
+                if (self.adopt() or self.valid()) and cached_account_id:
+                    return
+                self._login()
+
+    def refresh(self, stale_token=None):
+        """Renew via /api/Auth/validate, falling back to a full login."""
+        with self.lock, state.lock("login"):
+            # another thread or worker already replaced the token that got rejected / is due
+            self.adopt()
+            if stale_token is not None and self.token != stale_token and self.valid():
+                return
+            if stale_token is None and not self.refresh_due():
+                return
+            if self.token and cached_account_id:
+                try:
+                    r = broker.post("/api/Auth/validate", timeout=15)
+                    new_token = r.json().get("newToken") if r.status_code == 200 else None
+                    if new_token:
+                        self.set(new_token)
+                        self.refreshes += 1
+                        self.last_refresh_utc = utc_now()
+                        return
+                except Exception as e:
+                    logging.warning(f"Token validate failed: {e}")
+            self._login()
+
+    def _login(self):
+        try:
+            connect_topstep()
+            self.logins += 1
+            self.last_refresh_utc = utc_now()
+        except Exception as e:
+            self.last_error = str(e)
+            raise
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="token-refresh", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if not self.valid() or not cached_account_id:
+                    self.ensure()
+                else:
+                    due = self.expires_utc - datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN_SEC)
+                    wait = (due - utc_now()).total_seconds()
+                    if wait > 0:
+                        self.wake.clear()
+                        self.wake.wait(min(wait, 300))
+                        continue
+                    self.refresh()
+                    logging.info(f"Token refreshed, expires {fmt_date_time_ny(self.expires_utc)} NY")
+            except Exception as e:
+                self.last_error = str(e)
+                logging.error(f"Token refresh error: {e}")
+                time.sleep(30)
+
+    def state(self):
+        return {
+            "tokenValid": self.valid(),
+            "issuedUtc": self.issued_utc.isoformat() + "Z" if self.issued_utc else None,
+            "expiresUtc": self.expires_utc.isoformat() + "Z" if self.expires_utc else None,
+            "lastRefreshUtc": self.last_refresh_utc.isoformat() + "Z" if self.last_refresh_utc else None,
+            "logins": self.logins,
+            "refreshes": self.refreshes,
+            "lastError": self.last_error,
+        }
+
+tokens = TokenManager()
+
+def ts_post(path, **kwargs):
+    """Authenticated broker call; on 401 refreshes the token and retries once.
+
+    Pass priority=PRIORITY_* to queue ahead of / behind other calls in the
+    same rate-limit family (default: order for place/cancel, else report).
+    """
+    tokens.ensure()
+    sent_token = tokens.token
+    r = broker.post(path, **kwargs)
+    if r.status_code == 401:
+        logging.warning(f"401 on {path}, refreshing token and retrying")
+        metrics.inc("broker_retries_total", endpoint=path, reason="401")
+        tokens.refresh(stale_token=sent_token)
+        r = broker.post(path, **kwargs)
+    return r
+
+def orders_window(start_utc: datetime.datetime, end_utc: datetime.datetime, account_id=None):
+    """/api/Order/search payload for one account and time window."""
+    return {
+        "accountId": account_id or cached_account_id,
+        "startTimestamp": start_utc.isoformat() + "Z",
+        "endTimestamp": end_utc.isoformat() + "Z"
+    }
+
+def search_orders_window(start_utc: datetime.datetime, end_utc: datetime.datetime, priority=PRIORITY_REPORT,
+                         account_id=None):
+    return ts_post(
+        "/api/Order/search",
+        json=orders_window(start_utc, end_utc, account_id),
+        timeout=20,
+        priority=priority,
+    ).json()
+
+def search_open_orders(account_id=None):
+    return ts_post(
+        "/api/Order/searchOpen",
+        json={"accountId": account_id or cached_account_id},
+        timeout=20
+    ).json()
+
+def search_open_positions(account_id=None):
+    return ts_post(
+        "/api/Position/searchOpen",
+        json={"accountId": account_id or cached_account_id},
+        timeout=20
+    ).json()
+
+def cancel_order(order_id: int, account_id=None):
+    try:
+        return ts_post(
+            "/api/Order/cancel",
+            json={"accountId": account_id or cached_account_id, "orderId": order_id},
+            timeout=20
+        ).json()
+    finally:
+        snapshots.invalidate()
+
+def search_accounts():
+    return ts_post(
+        "/api/Account/search",
+        json={"onlyActiveAccounts": True},
+        timeout=20
+    ).json().get("accounts", [])
+
+def account_snapshot(account_id=None):
+    """An account's metadata (balance, name, canTrade, ...) from the snapshot cache."""
+    account_id = account_id or cached_account_id
+    accs = snapshots.get("accounts", search_accounts)
+    return next((a for a in accs if a.get("id") == account_id), None)
+
+def open_orders_snapshot():
+    return snapshots.get("open_orders", search_open_orders)
+
+# ================== FLOWS ==================
+# The execution path (webhook -> netting -> copies -> place -> fill wait -> brackets)
+# is written once, as generators that yield the effects below instead of doing I/O.
+# run_flow() performs them on the calling thread for the Flask server; the asyncio
+# server (async_server.py) drives the same generators on its event loop.
+Call = namedtuple("Call", "path payload priority timeout", defaults=(None, 20))  # -> decoded JSON body
+Sleep = namedtuple("Sleep", "seconds waker", defaults=(None,))  # a set() on waker ends it early
+NewWaker = namedtuple("NewWaker", "")  # -> an Event-like object fill_watcher.notify() can set()
+Blocking = namedtuple("Blocking", "fn args", defaults=((),))  # -> fn(*args), off the event loop
+Gather = namedtuple("Gather", "flows pool")  # -> list of results; pool runs them in Flask mode
+Await = namedtuple("Await", "future")  # -> the concurrent Future's exception, or None
+
+def run_flow(flow):
+    """Drive a flow on the calling thread and return its result."""
+    value, error = None, None
+    while True:
+        try:
+            effect = flow.send(value) if error is None else flow.throw(error)
+        except StopIteration as done:
+            return done.value
+        value, error = None, None
+        try:
+            value = _perform(effect)
+        except Exception as e:
+            error = e
+
+def _perform(effect):
+    if isinstance(effect, Call):
+        return ts_post(effect.path, json=effect.payload, priority=effect.priority, timeout=effect.timeout).json()
+    if isinstance(effect, Sleep):
+        if effect.waker is None:
+            time.sleep(effect.seconds)
+        else:
+            effect.waker.wait(effect.seconds)
+            effect.waker.clear()
+        return None
+    if isinstance(effect, NewWaker):
+        return threading.Event()
+    if isinstance(effect, Blocking):
+        return effect.fn(*effect.args)
+    if isinstance(effect, Gather):
+        if not effect.flows:
+            return []
+        # the first flow runs here (it carries the request's timer), the rest in the pool
+        futures = [effect.pool.submit(run_flow, f) for f in effect.flows[1:]]
+        return [run_flow(effect.flows[0])] + [f.result() for f in futures]
+    if isinstance(effect, Await):
+        return effect.future.exception()
+    raise TypeError(f"Unknown effect {effect!r}")
+
+# ================== CONTRACT REGISTRY ==================
+MONTH_CODES = {c: i + 1 for i, c in enumerate("FGHJKMNQUVXZ")}
+
+# TradingView tickers: "MNQ1!", "MNQH2026", "CME_MINI:MNQ1!", "MGCZ26"
+TV_TICKER_RE = re.compile(r"^([A-Z0-9]+?)(\d!|[FGHJKMNQUVXZ]\d{1,4})?$")
+
+def contract_root(contract_id: str):
+    # "CON.F.US.MNQ.H26" -> "MNQ"
+    parts = contract_id.upper().split(".")
+    return parts[3] if len(parts) >= 5 else ""
+
+def estimate_expiry(contract_id: str):
+    # month code + year from the id ("H26" -> 2026-03-15); mid-month is early
+    # enough for index and metals expiries
+    parts = contract_id.upper().split(".")
+    if len(parts) < 5 or len(parts[4]) < 2:
+        return None
+    month = MONTH_CODES.get(parts[4][0])
+    try:
+        year = int(parts[4][1:])
+    except ValueError:
+        return None
+    if not month:
+        return None
+    if year < 100:
+        year += 2000
+    return datetime.datetime(year, month, 15)
+
+class ContractRegistry:
+    """Root symbol <-> active contract, resolved through /api/Contract/search.
+
+    Lookups on the order path are plain dict hits. Entries are refreshed in
+    the background every CONTRACT_REFRESH_HOURS, and more eagerly once within
+    CONTRACT_ROLL_LEAD_DAYS of the contract's estimated expiry.
+    """
+
+    def __init__(self, roots):
+        self.roots = list(roots)
+        self.lock = threading.Lock()
+        self.contracts = {}    # root -> {"id", "name", "point_value", "tick_size", "refresh_at", "resolved"}
+        self.by_contract = {}  # contract id -> root
+        self.point_values = {r: POINT_VALUE[r] for r in self.roots if r in POINT_VALUE}
+        self.raw_cache = {}    # raw TradingView ticker -> root ("" if unsupported)
+        self.thread = None
+        for root in self.roots:
+            if root in SYMBOL_MAP:
+                self._install(root, {"id": SYMBOL_MAP[root], "name": SYMBOL_MAP[root],
+                                     "point_value": POINT_VALUE.get(root), "tick_size": None,
+                                     "refresh_at": utc_now(), "resolved": False})
+
+    def _install(self, root, info):
+        self.contracts[root] = info
+        self.by_contract[info["id"].upper()] = root
+        if info.get("point_value"):
+            self.point_values[root] = info["point_value"]
+
+    def root_for(self, raw: str) -> str:
+        key = raw.upper()
+        hit = self.raw_cache.get(key)
+        if hit is not None:
+            return hit
+        ticker = key.split(":")[-1].strip()
+        m = TV_TICKER_RE.match(ticker)
+        root = m.group(1) if m and m.group(1) in self.roots else ""
+        if not root:
+            # longest configured root the ticker starts with
+            for r in sorted(self.roots, key=len, reverse=True):
+                if ticker.startswith(r):
+                    root = r
+                    break
+        if root not in self.roots:
+            root = ""
+        if len(self.raw_cache) < 10000:
+            self.raw_cache[key] = root
+        return root
+
+    def symbol_for(self, contract_id: str) -> str:
+        c = contract_id.upper()
+        root = self.by_contract.get(c)
+        if root is None:
+            root = contract_root(c)
+            root = root if root in self.roots else ""
+            self.by_contract[c] = root
+        return root
+
+    def contract_id(self, root: str) -> str:
+        info = self.contracts.get(root)
+        if info is None:
+            info = self.resolve(root)
+        return info["id"]
+
+    def point_value(self, root: str):
+        return self.point_values.get(root)
+
+    def tick_size(self, root: str):
+        info = self.contracts.get(root) or {}
+        return info.get("tick_size") or TICK_SIZE.get(root)
+
+    def resolve(self, root: str):
+        """Ask the broker for the active contract of one root symbol."""
+        resp = ts_post(
+            "/api/Contract/search",
+            json={"searchText": root, "live": False},
+            timeout=15
+        ).json()
+        candidates = [c for c in resp.get("contracts", []) or [] if contract_root(str(c.get("id", ""))) == root]
+        if not candidates:
+            raise Exception(f"No contract found for {root}")
+        active = [c for c in candidates if c.get("activeContract")] or candidates
+        # nearest expiry among active contracts is the front month
+        best = min(active, key=lambda c: estimate_expiry(c["id"]) or datetime.datetime.max)
+        pv = POINT_VALUE.get(root)
+        if best.get("tickSize") and best.get("tickValue"):
+            pv = float(best["tickValue"]) / float(best["tickSize"])
+        now = utc_now()
+        refresh_at = now + datetime.timedelta(hours=CONTRACT_REFRESH_HOURS)
+        expiry = estimate_expiry(best["id"])
+        if expiry:
+            roll_check = expiry - datetime.timedelta(days=CONTRACT_ROLL_LEAD_DAYS)
+            if roll_check <= now:
+                refresh_at = min(refresh_at, now + datetime.timedelta(hours=1))
+            else:
+                refresh_at = min(refresh_at, roll_check)
+        info = {"id": best["id"], "name": best.get("name", best["id"]), "point_value": pv,
+                "tick_size": best.get("tickSize"), "refresh_at": refresh_at, "resolved": True}
+        with self.lock:
+            old = self.contracts.get(root)
+            self._install(root, info)
+        # the SYMBOL_MAP fallback is only a placeholder until the first lookup, not a contract we traded
+        if old and old["resolved"] and old["id"] != info["id"]:
+            logging.info(f"Contract roll {root}: {old['id']} -> {info['id']}")
+            tg_send(TG_CHAT_ID, f"🔁 CONTRACT ROLL\n{root}: {old['id']} → {info['id']}")
+        return info
+
+    def refresh_due(self):
+        now = utc_now()
+        for root in self.roots:
+            info = self.contracts.get(root)
+            if info is None or info["refresh_at"] <= now:
+                try:
+                    self.resolve(root)
+                except Exception as e:
+                    logging.error(f"Contract resolve failed for {root}: {e}")
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="contract-registry", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            if tokens.valid():
+                self.refresh_due()
+            time.sleep(60)
+
+registry = ContractRegistry(SYMBOLS)
+
+# ================== ORDER RECORDS ==================
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_epoch(dt):
+    return (dt - EPOCH).total_seconds() if dt else None
+
+def from_epoch(sec):
+    return EPOCH + datetime.timedelta(seconds=sec) if sec is not None else None
+
+# contract ids interned to small ints shared by every OrderRecord
+CONTRACT_IDS = []
+CONTRACT_INDEX = {}
+_contract_lock = threading.Lock()
+
+def intern_contract(contract_id):
+    i = CONTRACT_INDEX.get(contract_id)
+    if i is None:
+        with _contract_lock:
+            i = CONTRACT_INDEX.get(contract_id)
+            if i is None:
+                i = len(CONTRACT_IDS)
+                CONTRACT_IDS.append(contract_id)
+                CONTRACT_INDEX[contract_id] = i
+    return i
+
+class OrderRecord:
+    """Compact, pre-parsed broker order.
+
+    Timestamps are parsed once into epoch seconds, side is 0 buy / 1 sell
+    (-1 unknown) and the contract is an interned small int.
+    """
+
+    __slots__ = ("id", "account_id", "contract", "side", "size", "fill_volume", "filled_price",
+                 "status", "type", "limit_price", "stop_price", "created", "updated")
+
+    def __init__(self, id, account_id, contract, side, size, fill_volume, filled_price,
+                 status, type, limit_price, stop_price, created, updated):
+        self.id = id
+        self.account_id = account_id
+        self.contract = contract
+        self.side = side
+        self.size = size
+        self.fill_volume = fill_volume
+        self.filled_price = filled_price
+        self.status = status
+        self.type = type
+        self.limit_price = limit_price
+        self.stop_price = stop_price
+        self.created = created
+        self.updated = updated
+
+    @classmethod
+    def from_raw(cls, o):
+        side = o.get("side")
+        filled_price = o.get("filledPrice")
+        return cls(
+            o.get("id"),
+            o.get("accountId", cached_account_id),
+            intern_contract(o.get("contractId") or ""),
+            side if side in (0, 1) else -1,
+            int(o.get("size", 0) or 0),
+            int(o.get("fillVolume", 0) or 0),
+            float(filled_price) if filled_price is not None else None,
+            o.get("status"),
+            o.get("type"),
+            o.get("limitPrice"),
+            o.get("stopPrice"),
+            to_epoch(parse_ts(o.get("creationTimestamp", ""))),
+            to_epoch(parse_ts(o.get("updateTimestamp", ""))),
+        )
+
+    @property
+    def contract_id(self):
+        return CONTRACT_IDS[self.contract]
+
+    @property
+    def symbol(self):
+        return contract_to_symbol(CONTRACT_IDS[self.contract])
+
+    @property
+    def filled(self):
+        return bool(self.fill_volume) and self.filled_price is not None
+
+    @property
+    def updated_dt(self):
+        return from_epoch(self.updated)
+
+    def to_dict(self):
+        """Broker-shaped dict (for JSON responses and logs)."""
+        return {
+            "id": self.id, "accountId": self.account_id, "contractId": self.contract_id,
+            "side": self.side, "size": self.size, "fillVolume": self.fill_volume,
+            "filledPrice": self.filled_price, "status": self.status, "type": self.type,
+            "limitPrice": self.limit_price, "stopPrice": self.stop_price,
+            "creationTimestamp": from_epoch(self.created).isoformat() + "Z" if self.created is not None else None,
+            "updateTimestamp": from_epoch(self.updated).isoformat() + "Z" if self.updated is not None else None,
+        }
+
+def record_sort_key(r):
+    return (r.updated if r.updated is not None else float("-inf"), r.id or 0)
+
+def ingest_orders(raw_orders):
+    """Broker order dicts -> OrderRecords sorted by update time (the one ingestion stage)."""
+    records = [OrderRecord.from_raw(o) for o in raw_orders or [] if o.get("id") is not None]
+    records.sort(key=record_sort_key)
+    return records
+
+# ================== FILL WATCHER ==================
+# Topstep order status codes
+ORDER_STATUS_FILLED = 2
+ORDER_STATUS_CANCELLED = 3
+ORDER_STATUS_EXPIRED = 4
+ORDER_STATUS_REJECTED = 5
+ORDER_TERMINAL = (ORDER_STATUS_FILLED, ORDER_STATUS_CANCELLED, ORDER_STATUS_EXPIRED, ORDER_STATUS_REJECTED)
+
+class PollingFillSource:
+    """An account's orders from /api/Order/search, from a placement time until now."""
+
+    # allowance for clock skew between us and the broker
+    SKEW = datetime.timedelta(seconds=30)
+
+    def orders_flow(self, placed_utc, account_id=None):
+        now = utc_now()
+        resp = yield Call("/api/Order/search", orders_window(placed_utc - self.SKEW, now + self.SKEW, account_id),
+                          PRIORITY_FILL)
+        return ingest_orders(resp.get("orders", []))
+
+def fill_progress(result, order, qty):
+    """Fold one OrderRecord into a fill-wait result; True once the order is done."""
+    result["order"] = order
+    filled = order.fill_volume
+    if order.filled:
+        result["fill_price"] = order.filled_price
+        result["filled_qty"] = filled
+    status = order.status
+    if filled >= qty > 0 or status == ORDER_STATUS_FILLED:
+        result["status"] = "filled"
+        return True
+    if status in ORDER_TERMINAL:
+        result["status"] = "partial" if filled else "cancelled"
+        return True
+    if filled:
+        result["status"] = "partial"
+    return False
+
+class FillWatcher:
+    """Waits for a specific order id to fill (wait_flow, run inside the execution flow).
+
+    Polls the source on FILL_POLL_SCHEDULE. A push feed can call notify() with
+    order updates; waiters wake immediately and skip the next poll. A poll
+    returns the whole window, so it wakes the other waiters it covers the
+    same way: a burst of orders shares searches instead of each spending
+    its own from the "query" rate limit.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.lock = threading.Lock()
+        self.pushed = {}   # order_id -> latest OrderRecord from a push feed
+        self.events = {}   # order_id -> threading.Event
+        self.recent = deque(maxlen=200)  # (order_id, symbol, status, time_to_fill_ms)
+
+    def notify(self, order):
+        if isinstance(order, dict):
+            order = OrderRecord.from_raw(order)
+        oid = order.id
+        if oid is None:
+            return
+        with self.lock:
+            self.pushed[oid] = order
+            ev = self.events.get(oid)
+        if ev:
+            ev.set()
+
+    def share(self, order_id, orders):
+        """Hand a poll's records to the other waiters; returns order_id's own record (or None)."""
+        mine, woken = None, []
+        with self.lock:
+            for order in orders:
+                if order.id == order_id:
+                    mine = order
+                elif order.id in self.events:
+                    self.pushed[order.id] = order
+                    woken.append(self.events[order.id])
+        for ev in woken:
+            ev.set()
+        return mine
+
+    def wait_flow(self, order_id, placed_utc, qty, symbol="", timeout=FILL_TIMEOUT_SEC, account_id=None):
+        t0 = time.perf_counter()
+        result = {"order_id": order_id, "status": "timeout", "fill_price": None,
+                  "filled_qty": 0, "time_to_fill_ms": None, "polls": 0, "order": None}
+        if order_id is None:
+            result["status"] = "unknown"
+            return result
+        ev = yield NewWaker()
+        with self.lock:
+            self.events[order_id] = ev
+        try:
+            step = 0
+            while True:
+                elapsed = time.perf_counter() - t0
+                if elapsed >= timeout:
+                    break
+                delay = FILL_POLL_SCHEDULE[min(step, len(FILL_POLL_SCHEDULE) - 1)]
+                yield Sleep(min(delay, timeout - elapsed), ev)
+                step += 1
+
+                with self.lock:
+                    order = self.pushed.pop(order_id, None)
+                if order is None:
+                    try:
+                        result["polls"] += 1
+                        orders = yield from self.source.orders_flow(placed_utc, account_id)
+                    except Exception as e:
+                        logging.warning(f"Fill lookup failed for {order_id}: {e}")
+                        continue
+                    order = self.share(order_id, orders)
+                if not order:
+                    continue
+
+                if fill_progress(result, order, qty):
+                    break
+        finally:
+            with self.lock:
+                self.events.pop(order_id, None)
+                self.pushed.pop(order_id, None)
+
+        if result["filled_qty"]:
+            result["time_to_fill_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        self.recent.append((order_id, symbol, result["status"], result["time_to_fill_ms"]))
+        return result
+
+    def stats(self):
+        times = [r[3] for r in list(self.recent) if r[3] is not None]
+        return {
+            "tracked": len(self.recent),
+            "avg_time_to_fill_ms": round(sum(times) / len(times), 1) if times else None,
+            "max_time_to_fill_ms": max(times) if times else None,
+        }
+
+fill_watcher = FillWatcher(PollingFillSource())
+
+# ================== ORDER JOURNAL ==================
+JOURNAL_COLUMNS = ("id, account_id, contract_id, side, size, fill_volume, filled_price,"
+                   " status, type, limit_price, stop_price, created_epoch, update_epoch")
+
+class OrderJournal:
+    """Append/upsert-only SQLite copy of broker orders, indexed by update time.
+
+    Written by the execution path and by a periodic delta sync that only asks
+    the broker for orders since the last synced updateTimestamp (minus a small
+    overlap, since the broker window is keyed on creation time). Orders that
+    were created earlier and are still working (a resting limit, a bracket
+    leg) are tracked through searchOpen; once one leaves the open list the
+    window reaches back to its creation, so its fill is not missed.
+    """
+
+    SYNC_OVERLAP = datetime.timedelta(minutes=15)
+    # working orders older than this are not chased any more
+    WORKING_LOOKBACK = datetime.timedelta(days=7)
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.thread = None
+        self.last_sync_utc = None
+        self.listeners = []  # called with each batch of recorded orders
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS order_records ("
+            " id INTEGER PRIMARY KEY, account_id INTEGER, contract_id TEXT, side INTEGER,"
+            " size INTEGER, fill_volume INTEGER, filled_price REAL, status INTEGER, type INTEGER,"
+            " limit_price REAL, stop_price REAL, created_epoch REAL, update_epoch REAL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS order_records_time ON order_records(account_id, update_epoch)"
+        )
+        # our own signal executions: the only place planned entry (and so slippage) is known
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS executions ("
+            " order_id INTEGER PRIMARY KEY, account_id INTEGER, exec_epoch REAL, symbol TEXT,"
+            " side INTEGER, qty INTEGER, planned_entry REAL, fill_price REAL, slippage REAL,"
+            " time_to_fill_ms REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS executions_time ON executions(exec_epoch)")
+        # open stop/target pairs (BracketManager), so OCO survives a restart
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS brackets ("
+            " id INTEGER PRIMARY KEY, account_id INTEGER, contract_id TEXT, symbol TEXT,"
+            " entry_side INTEGER, placed_epoch REAL, legs TEXT)"
+        )
+
+    def record(self, records):
+        """Upsert OrderRecords (see ingest_orders) and notify listeners."""
+        rows = [
+            (r.id, r.account_id, r.contract_id, r.side, r.size, r.fill_volume, r.filled_price,
+             r.status, r.type, r.limit_price, r.stop_price, r.created,
+             r.updated if r.updated is not None else r.created)
+            for r in records if r.id is not None
+        ]
+        if not rows:
+            return 0
+        with self.lock:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO order_records ({JOURNAL_COLUMNS}) VALUES ({', '.join('?' * 13)})",
+                rows,
+            )
+        for fn in self.listeners:
+            try:
+                fn(records)
+            except Exception as e:
+                logging.error(f"Journal listener error: {e}")
+        return len(rows)
+
+    def record_execution(self, order_id, symbol, side, qty, planned_entry, fill_price, slippage,
+                         time_to_fill_ms, exec_utc=None, account_id=None):
+        if order_id is None:
+            return
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO executions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (order_id, account_id or cached_account_id, to_epoch(exec_utc or utc_now()), symbol,
+                 side, qty, planned_entry, fill_price, slippage, time_to_fill_ms),
+            )
+
+    def save_bracket(self, b):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO brackets VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (b["id"], b["account_id"], b["contract_id"], b["symbol"], b["entry_side"],
+                 to_epoch(b["placed_utc"]), json.dumps(b["legs"])),
+            )
+
+    def drop_bracket(self, bracket_id):
+        """Forget a bracket; False if it was already gone (another worker handled it)."""
+        with self.lock:
+            return self.db.execute("DELETE FROM brackets WHERE id = ?", (bracket_id,)).rowcount > 0
+
+    def open_brackets(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, account_id, contract_id, symbol, entry_side, placed_epoch, legs FROM brackets"
+            ).fetchall()
+        return [
+            {"id": r[0], "account_id": r[1], "contract_id": r[2], "symbol": r[3], "entry_side": r[4],
+             "placed_utc": from_epoch(r[5]), "legs": json.loads(r[6])}
+            for r in rows
+        ]
+
+    def last_update(self, account_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT MAX(update_epoch) FROM order_records WHERE account_id = ?", (account_id,)
+            ).fetchone()
+        return from_epoch(row[0]) if row and row[0] else None
+
+    def working_since(self, account_id, open_ids, not_before):
+        """Creation time of the oldest journaled order still working here but no longer open at the broker."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, created_epoch FROM order_records WHERE account_id = ? AND created_epoch >= ?"
+                f" AND (status IS NULL OR status NOT IN ({', '.join('?' * len(ORDER_TERMINAL))}))",
+                (account_id, to_epoch(not_before), *ORDER_TERMINAL),
+            ).fetchall()
+        created = [c for oid, c in rows if oid not in open_ids and c is not None]
+        return from_epoch(min(created)) if created else None
+
+    def sync(self):
+        """Fetch only what changed since the last synced updateTimestamp, per trading account."""
+        if not cached_account_id:
+            return 0
+        with self.sync_lock:
+            now = utc_now()
+            n = 0
+            for acc in trading_accounts():
+                last = self.last_update(acc["id"])
+                if last is None:
+                    start = now - datetime.timedelta(hours=JOURNAL_BACKFILL_HOURS)
+                else:
+                    start = min(last, now) - self.SYNC_OVERLAP
+                open_orders = ingest_orders(search_open_orders(acc["id"]).get("orders", []))
+                n += self.record(open_orders)
+                finished = self.working_since(acc["id"], {o.id for o in open_orders}, now - self.WORKING_LOOKBACK)
+                if finished is not None:
+                    start = min(start, finished - self.SYNC_OVERLAP)
+                resp = search_orders_window(start, now, account_id=acc["id"])
+                n += self.record(ingest_orders(resp.get("orders", [])))
+            self.last_sync_utc = now
+            return n
+
+    def orders_between(self, start_utc, end_utc, account_id=None):
+        """OrderRecords updated in [start_utc, end_utc], oldest first."""
+        account_id = account_id or cached_account_id
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {JOURNAL_COLUMNS} FROM order_records"
+                " WHERE account_id = ? AND update_epoch >= ? AND update_epoch <= ?"
+                " ORDER BY update_epoch, id",
+                (account_id, to_epoch(start_utc), to_epoch(end_utc)),
+            ).fetchall()
+        return [
+            OrderRecord(r[0], r[1], intern_contract(r[2] or ""), r[3], r[4], r[5], r[6],
+                        r[7], r[8], r[9], r[10], r[11], r[12])
+            for r in rows
+        ]
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="journal-sync", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if tokens.valid() and cached_account_id:
+                    self.sync()
+            except Exception as e:
+                logging.error(f"Journal sync error: {e}")
+            time.sleep(JOURNAL_SYNC_SEC)
+
+journal = OrderJournal(JOURNAL_DB_PATH)
+
+# ================== EXECUTION STATS ==================
+class QuantileSketch:
+    """Mergeable quantile sketch with relative error alpha (DDSketch).
+
+    Values fall into log-spaced buckets, one store per sign. Each store has
+    at most max_bins buckets; past that the smallest magnitudes are folded
+    together. Quantiles are within alpha (relative) while a store's values
+    span less than gamma ** max_bins; past that the folded low end loses
+    accuracy first. Two sketches merge by adding bucket counts.
+    """
+
+    MIN_VALUE = 1e-9
+
+    def __init__(self, alpha=EXEC_STATS_ALPHA, max_bins=EXEC_STATS_MAX_BINS):
+        self.alpha = alpha
+        self.max_bins = max_bins
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.pos = {}  # bucket index -> count
+        self.neg = {}
+        self.zero = 0
+        self.count = 0
+
+    def _index(self, x):
+        return math.ceil(math.log(x) / self.log_gamma)
+
+    def _value(self, i):
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def _collapse(self, store):
+        keys = sorted(store)
+        excess = len(keys) - self.max_bins
+        if excess <= 0:
+            return
+        folded = sum(store.pop(k) for k in keys[:excess])
+        store[keys[excess]] += folded
+
+    def add(self, x):
+        if x > self.MIN_VALUE:
+            store, i = self.pos, self._index(x)
+        elif x < -self.MIN_VALUE:
+            store, i = self.neg, self._index(-x)
+        else:
+            self.zero += 1
+            self.count += 1
+            return
+        store[i] = store.get(i, 0) + 1
+        if len(store) > self.max_bins:
+            self._collapse(store)
+        self.count += 1
+
+    def merge(self, other):
+        for mine, theirs in ((self.pos, other.pos), (self.neg, other.neg)):
+            for i, c in theirs.items():
+                mine[i] = mine.get(i, 0) + c
+            self._collapse(mine)
+        self.zero += other.zero
+        self.count += other.count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for i in sorted(self.neg, reverse=True):  # most negative first
+            seen += self.neg[i]
+            if seen > rank:
+                return -self._value(i)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for i in sorted(self.pos):
+            seen += self.pos[i]
+            if seen > rank:
+                return self._value(i)
+        return self._value(max(self.pos)) if self.pos else 0.0
+
+    def to_dict(self):
+        return {"pos": {str(i): c for i, c in self.pos.items()},
+                "neg": {str(i): c for i, c in self.neg.items()}, "zero": self.zero}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls()
+        sketch.pos = {int(i): c for i, c in d.get("pos", {}).items()}
+        sketch.neg = {int(i): c for i, c in d.get("neg", {}).items()}
+        sketch.zero = d.get("zero", 0)
+        sketch.count = sketch.zero + sum(sketch.pos.values()) + sum(sketch.neg.values())
+        return sketch
+
+class StreamingStat:
+    """Welford running mean/variance plus a quantile sketch; O(1) add, mergeable."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch()
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+        self.sketch.add(x)
+
+    def merge(self, other):
+        if not other.n:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.n = n
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    def summary(self):
+        std = math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+        out = {"n": self.n, "mean": round(self.mean, 4), "std": round(std, 4),
+               "min": self.min, "max": self.max}
+        for q in (50, 90, 99):
+            p = self.sketch.quantile(q / 100)
+            # bucket midpoints can land just outside what was actually seen
+            out[f"p{q}"] = round(min(max(p, self.min), self.max), 4) if p is not None else None
+        return out
+
+    def to_dict(self):
+        return {"n": self.n, "mean": self.mean, "m2": self.m2, "min": self.min, "max": self.max,
+                "sketch": self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, d):
+        stat = cls()
+        stat.n, stat.mean, stat.m2 = d["n"], d["mean"], d["m2"]
+        stat.min, stat.max = d.get("min"), d.get("max")
+        stat.sketch = QuantileSketch.from_dict(d.get("sketch", {}))
+        return stat
+
+EXEC_STAT_FIELDS = ("slippage", "time_to_fill_ms")
+EXEC_STAT_KEYS = ("symbol", "side", "hour")
+
+class ExecutionStats:
+    """Slippage and time-to-fill per (symbol, side, NY hour), in constant memory.
+
+    Slippage is in points, signed so that positive is adverse (paid above
+    plan on a buy, below plan on a sell). Groups merge on query, so any
+    roll-up (per symbol, per side, all hours) comes from the same state.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.groups = {}  # (symbol, side, hour) -> {field: StreamingStat}
+        self.dirty = False
+        self.saved_utc = None
+        self.thread = None
+        self.load()
+
+    def record(self, symbol, side_code, exec_utc, slippage, time_to_fill_ms):
+        side = "BUY" if side_code == 0 else "SELL"
+        values = {
+            "slippage": (slippage if side_code == 0 else -slippage) if slippage is not None else None,
+            "time_to_fill_ms": time_to_fill_ms,
+        }
+        key = (symbol, side, to_ny(exec_utc).hour)
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = {f: StreamingStat() for f in EXEC_STAT_FIELDS}
+            for field, value in values.items():
+                if value is not None:
+                    group[field].add(value)
+            self.dirty = True
+
+    def query(self, symbol=None, side=None, hour=None, by=EXEC_STAT_KEYS):
+        """Summaries for matching groups, merged down to the `by` keys."""
+        merged = {}
+        with self.lock:
+            for key, group in self.groups.items():
+                labels = dict(zip(EXEC_STAT_KEYS, key))
+                if ((symbol and labels["symbol"] != symbol) or (side and labels["side"] != side)
+                        or (hour is not None and labels["hour"] != hour)):
+                    continue
+                out_key = tuple(labels[k] for k in by)
+                target = merged.get(out_key)
+                if target is None:
+                    target = merged[out_key] = {f: StreamingStat() for f in EXEC_STAT_FIELDS}
+                for field in EXEC_STAT_FIELDS:
+                    target[field].merge(group[field])
+            return [
+                dict(zip(by, key), **{f: stats[f].summary() for f in EXEC_STAT_FIELDS})
+                for key, stats in sorted(merged.items())
+            ]
+
+    def checkpoint(self):
+        with self.lock:
+            if not self.dirty:
+                return False
+            data = {
+                "alpha": EXEC_STATS_ALPHA,
+                "groups": [
+                    dict(zip(EXEC_STAT_KEYS, key), **{f: group[f].to_dict() for f in EXEC_STAT_FIELDS})
+                    for key, group in self.groups.items()
+                ],
+            }
+            self.dirty = False
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+        self.saved_utc = utc_now()
+        return True
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.error(f"Execution stats checkpoint unreadable ({self.path}): {e}")
+            return
+        if data.get("alpha") != EXEC_STATS_ALPHA:
+            logging.warning("Execution stats checkpoint uses a different EXEC_STATS_ALPHA; starting fresh")
+            return
+        for g in data.get("groups", []):
+            key = (g["symbol"], g["side"], int(g["hour"]))
+            self.groups[key] = {f: StreamingStat.from_dict(g[f]) for f in EXEC_STAT_FIELDS}
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="exec-stats", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(EXEC_STATS_CHECKPOINT_SEC)
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logging.error(f"Execution stats checkpoint failed: {e}")
+
+exec_stats = ExecutionStats(EXEC_STATS_PATH)
+
+# ================== POSITION BOOK ==================
+class PositionBook:
+    """Net position, average price and realized PnL per symbol.
+
+    Each fill is applied once in O(1): scale-ins average the entry, opposite
+    fills realize PnL on the closed portion, and an oversized opposite fill
+    flips the position at the fill price.
+    pos_qty is signed (long +, short -).
+    """
+
+    def __init__(self):
+        self.state = {sym: {"pos_qty": 0, "avg_price": 0.0} for sym in registry.roots}
+        self.realized_events = []  # dicts: symbol, time_dt, action, qty, entry, exit, pnl
+        self.total_pnl = 0.0
+        self.fills = 0
+        self.applied = set()  # order ids
+        self.last_ts = None   # epoch seconds of the newest applied fill
+
+    def apply(self, sym, side, qty, price, tdt=None):
+        """Apply one fill (side 0 buy, 1 sell). Returns the realized event, if any."""
+        pv = registry.point_value(sym)
+        if not pv or qty <= 0:
+            return None
+        st = self.state.setdefault(sym, {"pos_qty": 0, "avg_price": 0.0})
+        pos_qty = int(st["pos_qty"])
+        avg = float(st["avg_price"])
+        event = None
+
+        if side == 0:
+            # BUY
+            if pos_qty >= 0:
+                # increase / open long (scale-in)
+                new_qty = pos_qty + qty
+                if new_qty != 0:
+                    avg = (avg * pos_qty + price * qty) / new_qty if pos_qty != 0 else price
+                pos_qty = new_qty
+                st["pos_qty"], st["avg_price"] = pos_qty, avg
+            else:
+                # buy to cover short (realize pnl on closed portion)
+                close_qty = min(qty, abs(pos_qty))
+                pnl = (avg - price) * pv * close_qty  # short profit if price down
+                event = {"symbol": sym, "time_dt": tdt, "action": "COVER", "qty": close_qty,
+                         "entry": avg, "exit": price, "pnl": pnl}
+                pos_qty = pos_qty + close_qty  # pos_qty is negative
+                remaining_buy = qty - close_qty
+                if remaining_buy > 0:
+                    # flips to long with remaining
+                    pos_qty = remaining_buy
+                    avg = price
+                # if still short, avg unchanged
+                st["pos_qty"], st["avg_price"] = pos_qty, avg if pos_qty != 0 else 0.0
+        else:
+            # SELL
+            if pos_qty <= 0:
+                # increase / open short
+                new_qty_abs = abs(pos_qty) + qty
+                if new_qty_abs != 0:
+                    # avg for short kept as avg entry price
+                    avg = (avg * abs(pos_qty) + price * qty) / new_qty_abs if pos_qty != 0 else price
+                pos_qty = -(new_qty_abs)
+                st["pos_qty"], st["avg_price"] = pos_qty, avg
+            else:
+                # sell to close long
+                close_qty = min(qty, pos_qty)
+                pnl = (price - avg) * pv * close_qty  # long profit if price up
+                event = {"symbol": sym, "time_dt": tdt, "action": "SELL", "qty": close_qty,
+                         "entry": avg, "exit": price, "pnl": pnl}
+                pos_qty = pos_qty - close_qty
+                remaining_sell = qty - close_qty
+                if remaining_sell > 0:
+                    # flips to short with remaining
+                    pos_qty = -remaining_sell
+                    avg = price
+                st["pos_qty"], st["avg_price"] = pos_qty, avg if pos_qty != 0 else 0.0
+
+        if event:
+            self.total_pnl += event["pnl"]
+            self.realized_events.append(event)
+        return event
+
+    def apply_order(self, rec):
+        """Apply a filled OrderRecord once (keyed by order id)."""
+        if not rec.filled:
+            return None
+        if rec.id is not None:
+            if rec.id in self.applied:
+                return None
+            self.applied.add(rec.id)
+        self.fills += 1
+        if rec.updated is not None and (self.last_ts is None or rec.updated > self.last_ts):
+            self.last_ts = rec.updated
+        sym = rec.symbol
+        if sym not in self.state:
+            return None
+        return self.apply(sym, rec.side, rec.size, rec.filled_price, rec.updated_dt)
+
+    @classmethod
+    def replay(cls, orders):
+        """Build a book from OrderRecords already sorted by update time."""
+        book = cls()
+        for o in orders:
+            book.apply_order(o)
+        return book
+
+class DailyBook:
+    """PositionBook per trading account for the current NY trading day, fed by journal writes.
+
+    Each account's book is replayed from the journal the first time it is
+    used in a day (the account id is only known after login), then kept
+    current from journal writes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.day_start = None
+        self.books = {}  # account_id -> PositionBook
+
+    def _roll(self):
+        day_start = ny_today_start_utc().replace(tzinfo=None)
+        if day_start != self.day_start:
+            self.day_start = day_start
+            self.books = {}
+            return True
+        return False
+
+    def _book(self, account_id):
+        if not account_id:
+            return PositionBook()  # not logged in yet: nothing to replay
+        book = self.books.get(account_id)
+        if book is None:
+            book = self.books[account_id] = PositionBook.replay(
+                journal.orders_between(self.day_start, utc_now(), account_id))
+        return book
+
+    def on_orders(self, records):
+        with self.lock:
+            self._roll()
+            day_start = to_epoch(self.day_start)
+            by_account = {}
+            for r in records:
+                if r.filled and r.updated is not None and r.updated >= day_start:
+                    by_account.setdefault(r.account_id, []).append(r)
+            for account_id, recs in by_account.items():
+                book = self._book(account_id)
+                fresh = sorted((r for r in recs if r.id not in book.applied), key=record_sort_key)
+                if fresh and book.last_ts and fresh[0].updated < book.last_ts:
+                    # arrived out of order: replay the account's day from the journal
+                    self.books[account_id] = PositionBook.replay(
+                        journal.orders_between(self.day_start, utc_now(), account_id))
+                    continue
+                for r in fresh:
+                    book.apply_order(r)
+
+    def snapshot(self, account_id=None):
+        with self.lock:
+            self._roll()
+            return self.day_start, self._book(account_id or cached_account_id)
+
+    def snapshot_all(self):
+        """(day_start, [(account, book)]) for every trading account."""
+        with self.lock:
+            self._roll()
+            return self.day_start, [(acc, self._book(acc["id"])) for acc in trading_accounts()]
+
+today_book = DailyBook()
+journal.listeners.append(today_book.on_orders)
+
+# ================== NET POSITIONS ==================
+# Topstep position types
+POSITION_LONG = 1
+POSITION_SHORT = 2
+
+class NetPositions:
+    """Signed net position per contract, kept from our own fills.
+
+    Lets CLOSE signals size the flattening order without a broker query.
+    A background reconciler compares against /api/Position/searchOpen,
+    alerts on drift and adopts the broker's numbers.
+    """
+
+    def __init__(self, account_id=None):
+        self.account_id = account_id  # None: the TARGET_ACCOUNT
+        self.lock = threading.Lock()
+        self.net = {}          # contract_id -> signed qty
+        self.touched = {}      # contract_id -> monotonic time of last local change
+        self.in_flight = {}    # contract_id -> orders being placed
+        self.synced_utc = None
+        self.drifts = 0
+        self.thread = None
+
+    def get(self, contract_id):
+        """Net qty, or None if we have never synced with the broker."""
+        with self.lock:
+            if self.synced_utc is None:
+                return None
+            return self.net.get(contract_id, 0)
+
+    def held(self, root):
+        """[(contract_id, net)] with a non-zero position in this root, or None if never synced."""
+        with self.lock:
+            if self.synced_utc is None:
+                return None
+            return [(cid, n) for cid, n in self.net.items() if n and contract_to_symbol(cid) == root]
+
+    def begin(self, contract_id):
+        with self.lock:
+            self.in_flight[contract_id] = self.in_flight.get(contract_id, 0) + 1
+
+    def end(self, contract_id):
+        with self.lock:
+            self.in_flight[contract_id] = max(0, self.in_flight.get(contract_id, 0) - 1)
+            self.touched[contract_id] = time.monotonic()
+
+    def apply_fill(self, contract_id, side, qty):
+        if not qty:
+            return
+        with self.lock:
+            delta = qty if side == 0 else -qty
+            self.net[contract_id] = self.net.get(contract_id, 0) + delta
+            self.touched[contract_id] = time.monotonic()
+
+    def _broker_net(self):
+        resp = search_open_positions(self.account_id)
+        if not resp.get("success", True):
+            raise Exception(f"Position search failed: {resp}")
+        broker_net = {}
+        for p in resp.get("positions", []) or []:
+            size = int(p.get("size", 0) or 0)
+            signed = size if p.get("type") == POSITION_LONG else -size
+            broker_net[p.get("contractId")] = broker_net.get(p.get("contractId"), 0) + signed
+        return broker_net
+
+    def refresh(self, contract_id):
+        """Take one contract's net from the broker, e.g. after a bracket leg closed it.
+
+        Absolute, not a delta: the reconciler may already have seen the exit.
+        Skipped while one of our orders is in flight there; the reconciler settles it.
+        """
+        broker_net = self._broker_net()
+        with self.lock:
+            if self.in_flight.get(contract_id):
+                return
+            self.net[contract_id] = broker_net.get(contract_id, 0)
+            self.touched[contract_id] = time.monotonic()
+
+    def reconcile(self, alert=True):
+        broker_net = self._broker_net()
+        drift = []
+        with self.lock:
+            first = self.synced_utc is None
+            cutoff = time.monotonic() - POSITION_RECONCILE_GRACE_SEC
+            for cid in set(self.net) | set(broker_net):
+                if self.in_flight.get(cid) or self.touched.get(cid, 0) > cutoff:
+                    continue
+                local, remote = self.net.get(cid, 0), broker_net.get(cid, 0)
+                if local != remote:
+                    if not first:
+                        drift.append((cid, local, remote))
+                    self.net[cid] = remote
+            self.synced_utc = utc_now()
+            self.drifts += len(drift)
+
+        if drift and alert:
+            lines = ["⚠️ POSITION DRIFT (broker wins)"]
+            if self.account_id:
+                lines.append(f"Account: {account_name(self.account_id)}")
+            for cid, local, remote in drift:
+                lines.append(f"{cid}: local {local} | broker {remote}")
+            tg_send(TG_CHAT_ID, "\n".join(lines))
+        return drift
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        name = f"position-reconcile-{self.account_id}" if self.account_id else "position-reconcile"
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if tokens.valid() and cached_account_id:
+                    self.reconcile()
+            except Exception as e:
+                logging.error(f"Position reconcile error: {e}")
+            time.sleep(POSITION_RECONCILE_SEC)
+
+positions = NetPositions()
+copy_positions = {}  # copy account_id -> NetPositions, created on first signal
+_copy_positions_lock = threading.Lock()
+
+def positions_for(account_id):
+    if not account_id or account_id == cached_account_id:
+        return positions
+    with _copy_positions_lock:
+        book = copy_positions.get(account_id)
+        if book is None:
+            book = copy_positions[account_id] = NetPositions(account_id)
+            book.start()
+        return book
+
+# ================== BULK OPERATIONS ==================
+bulk_pool = ThreadPoolExecutor(max_workers=BULK_WORKERS, thread_name_prefix="bulk")
+
+def bulk_run(items, fn, ok=lambda r: bool(r.get("success")), retries=BULK_RETRIES):
+    """Run fn(item) for every item on the bulk pool.
+
+    Only failed items are retried (up to `retries` more rounds). Returns one
+    result dict per item, in input order:
+    {item, ok, result, error, ms, attempts}.
+    """
+    def _one(item):
+        t0 = time.perf_counter()
+        try:
+            res = fn(item)
+            return {"item": item, "ok": bool(ok(res)), "result": res, "error": None,
+                    "ms": (time.perf_counter() - t0) * 1000}
+        except Exception as e:
+            return {"item": item, "ok": False, "result": None, "error": str(e),
+                    "ms": (time.perf_counter() - t0) * 1000}
+
+    results = [None] * len(items)
+    pending = list(range(len(items)))
+    attempt = 0
+    while pending and attempt <= retries:
+        attempt += 1
+        outs = list(bulk_pool.map(lambda i: _one(items[i]), pending))
+        for i, out in zip(pending, outs):
+            out["attempts"] = attempt
+            results[i] = out
+        pending = [i for i in pending if not results[i]["ok"]]
+        if pending and attempt <= retries:
+            metrics.inc("broker_retries_total", len(pending), endpoint="bulk", reason="bulk")
+    return results
+
+def bulk_summary(results, started):
+    ok = sum(1 for r in results if r["ok"])
+    slowest = max((r["ms"] for r in results), default=0.0)
+    retried = sum(1 for r in results if r["attempts"] > 1)
+    return {
+        "requested": len(results),
+        "ok": ok,
+        "failed": len(results) - ok,
+        "retried": retried,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "slowest_ms": round(slowest, 1),
+    }
+
+def cancel_orders(orders):
+    """Cancel broker order dicts concurrently, each on its own accountId."""
+    started = time.perf_counter()
+    results = bulk_run(orders, lambda o: cancel_order(int(o["id"]), o.get("accountId")))
+    return results, bulk_summary(results, started)
+
+def open_orders_all_accounts():
+    """Working orders on every trading account, plus per-account search errors."""
+    accounts = trading_accounts()
+    searches = bulk_run(accounts, lambda acc: search_open_orders(acc["id"]))
+    orders, errors = [], []
+    for acc, res in zip(accounts, searches):
+        if not res["ok"]:
+            errors.append(f"{acc['name']}: search failed {res['error'] or res['result']}")
+            continue
+        for o in res["result"].get("orders", []) or []:
+            orders.append(dict(o, accountId=o.get("accountId") or acc["id"]))
+    return orders, errors
+
+# ================== BRACKETS ==================
+# Topstep order types
+ORDER_TYPE_LIMIT = 1
+ORDER_TYPE_MARKET = 2
+ORDER_TYPE_STOP = 4
+
+def round_to_tick(price, tick):
+    return round(round(price / tick) * tick, 10) if tick else round(price, 6)
+
+def bracket_orders(sig, plan, fill):
+    """{"stop": payload, "target": payload} around the entry fill, or None without a bracket."""
+    if not (sig.get("stop") or sig.get("target")) or not fill["filled_qty"] or fill["fill_price"] is None:
+        return None
+    sign = 1 if plan["side"] == 0 else -1  # long: stop below, target above
+    tick = registry.tick_size(sig["symbol"])
+    base = {
+        "accountId": plan["account"]["id"],
+        "contractId": plan["contract_id"],
+        "side": 1 - plan["side"],
+        "size": fill["filled_qty"],
+    }
+    legs = {}
+    if sig.get("stop"):
+        legs["stop"] = dict(base, type=ORDER_TYPE_STOP,
+                            stopPrice=round_to_tick(fill["fill_price"] - sign * sig["stop"], tick))
+    if sig.get("target"):
+        legs["target"] = dict(base, type=ORDER_TYPE_LIMIT,
+                              limitPrice=round_to_tick(fill["fill_price"] + sign * sig["target"], tick))
+    return legs
+
+def _place_bracket_leg(payload):
+    try:
+        return (yield Call("/api/Order/place", payload, PRIORITY_ORDER))
+    except Exception as e:
+        return {"success": False, "errorMessage": str(e)}
+
+def protect(sig, plan, fill, timer):
+    """Flow: place the stop and target legs in parallel once the entry has filled."""
+    legs = bracket_orders(sig, plan, fill)
+    if not legs:
+        if (sig.get("stop") or sig.get("target")) and fill["status"] != "cancelled":
+            # not seen filling in time: the entry may still fill, with nothing around it
+            return brackets.skipped(sig, plan, fill)
+        return None
+    t0 = time.perf_counter()
+    with timer.stage("protect"):
+        acks = yield Gather([_place_bracket_leg(payload) for payload in legs.values()], bulk_pool)
+    snapshots.invalidate("open_orders")
+    return brackets.opened(sig, plan, fill["order_id"], legs, dict(zip(legs, acks)), time.perf_counter() - t0)
+
+def fmt_bracket(b):
+    if b["status"] == "unprotected":
+        return f"❌ UNPROTECTED ({b['reason']})"
+    parts = [f"{name.upper()} {b[name]['price']}" + ("" if b[name]["orderId"] else " ❌")
+             for name in ("stop", "target") if name in b]
+    return " / ".join(parts) + f" | protected in {b['time_to_protected_ms']} ms"
+
+class BracketManager:
+    """Stop/target pairs placed after entry fills, kept one-cancels-other.
+
+    A poller watches the working legs; when one fills, the sibling is
+    cancelled and the account's net position is re-read from the broker. A
+    CLOSE or reversing signal releases the contract's brackets first.
+    Open brackets are kept in the journal DB and resumed at startup.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}  # bracket id (entry order id) -> bracket
+        self.wake = threading.Event()
+        self.thread = None
+        self.protected = 0
+        self.incomplete = 0
+        self.triggered = 0
+        self.unprotected = 0
+
+    def opened(self, sig, plan, entry_id, legs, acks, seconds):
+        """Record placement acks; returns the bracket summary for the response/report."""
+        summary = {"time_to_protected_ms": round(seconds * 1000, 1)}
+        bracket = {
+            "id": entry_id, "symbol": sig["symbol"],
+            "account_id": plan["account"]["id"], "contract_id": plan["contract_id"],
+            "entry_side": plan["side"], "placed_utc": utc_now(), "legs": {},
+        }
+        failed = []
+        for name, payload in legs.items():
+            ack = acks[name]
+            order_id = ack.get("orderId") if ack.get("success") else None
+            summary[name] = {"orderId": order_id, "price": payload.get("stopPrice", payload.get("limitPrice"))}
+            if order_id is None:
+                failed.append(f"{name}: {ack.get('errorMessage') or ack}")
+            else:
+                bracket["legs"][name] = order_id
+
+        metrics.observe("time_to_protected_seconds", seconds, symbol=sig["symbol"])
+        with self.lock:
+            if failed:
+                self.incomplete += 1
+            else:
+                self.protected += 1
+            if bracket["legs"]:
+                self.active[bracket["id"]] = bracket
+        if bracket["legs"]:
+            self._save(bracket)
+            self.wake.set()
+        if failed:
+            metrics.inc("broker_errors_total", endpoint="/api/Order/place", reason="bracket")
+            tg_send(TG_CHAT_ID, f"⚠️ BRACKET INCOMPLETE\n{sig['symbol']} ({account_name(plan['account']['id'])})\n"
+                                + "\n".join(failed))
+        summary["status"] = "incomplete" if failed else "protected"
+        return summary
+
+    def skipped(self, sig, plan, fill):
+        """The entry had no confirmed fill, so no legs were placed; alert and return the summary."""
+        reason = f"entry {fill['status']}, no fill seen" if not fill["filled_qty"] else "entry fill price unknown"
+        with self.lock:
+            self.unprotected += 1
+        metrics.inc("brackets_unprotected_total", symbol=sig["symbol"])
+        tg_send(TG_CHAT_ID, f"⚠️ UNPROTECTED\n{sig['symbol']} ({account_name(plan['account']['id'])})\n"
+                            f"Order: {fill['order_id']}\n{reason}: stop/target NOT placed, check the position")
+        return {"status": "unprotected", "reason": reason}
+
+    def release(self, account_id, contract_id, keep_side=None):
+        """Cancel this contract's brackets, except those protecting an entry on keep_side."""
+        with self.lock:
+            done = [b for b in self.active.values()
+                    if b["account_id"] == account_id and b["contract_id"] == contract_id
+                    and b["entry_side"] != keep_side]
+            for b in done:
+                self.active.pop(b["id"], None)
+        for b in done:
+            self._drop(b["id"])
+            for order_id in b["legs"].values():
+                try:
+                    cancel_order(order_id, account_id)
+                except Exception as e:
+                    logging.error(f"Bracket cancel failed for {order_id}: {e}")
+        return len(done)
+
+    def poll(self):
+        """One order search per account with open brackets, over its brackets' placement times."""
+        with self.lock:
+            by_account = {}
+            for b in self.active.values():
+                by_account.setdefault(b["account_id"], []).append(b)
+        for account_id, items in by_account.items():
+            # legs are created right after their bracket is recorded; the window only has to cover that
+            start = min(b["placed_utc"] for b in items) - PollingFillSource.SKEW
+            end = max(b["placed_utc"] for b in items) + PollingFillSource.SKEW
+            # the sibling cancel is what keeps the account from a second position: fill priority
+            resp = search_orders_window(start, end, priority=PRIORITY_FILL, account_id=account_id)
+            orders = {r.id: r for r in ingest_orders(resp.get("orders", []))}
+            for b in items:
+                self._check(b, orders)
+
+    def _check(self, b, orders):
+        legs = {name: orders.get(order_id) for name, order_id in b["legs"].items()}
+        hit = next((name for name, o in legs.items() if o is not None and o.status == ORDER_STATUS_FILLED), None)
+        if hit is None:
+            if all(o is not None and o.status in ORDER_TERMINAL for o in legs.values()):
+                # cancelled elsewhere (manually, or by the broker)
+                with self.lock:
+                    self.active.pop(b["id"], None)
+                self._drop(b["id"])
+            return
+        with self.lock:
+            if self.active.pop(b["id"], None) is None:
+                return  # released meanwhile
+        if not self._drop(b["id"]):
+            return  # another worker triggered it
+        with self.lock:
+            self.triggered += 1
+
+        exit_order = legs[hit]
+        cancelled = None
+        for name, order_id in b["legs"].items():
+            if name != hit:
+                cancelled = bool(cancel_order(order_id, b["account_id"]).get("success"))
+        try:
+            positions_for(b["account_id"]).refresh(b["contract_id"])
+        except Exception as e:
+            logging.error(f"Position refresh after bracket exit failed: {e}")
+        journal.record([exit_order])
+        snapshots.invalidate()
+        metrics.inc("brackets_triggered_total", symbol=b["symbol"], leg=hit)
+
+        lines = [
+            "🛑 STOP HIT" if hit == "stop" else "🎯 TARGET HIT",
+            f"Symbol: {b['symbol']}",
+            f"Qty: {exit_order.fill_volume}",
+            f"Fill: {exit_order.filled_price}",
+        ]
+        if copy_accounts:
+            lines.insert(1, f"Account: {account_name(b['account_id'])}")
+        if cancelled is not None:
+            lines.append(f"Sibling cancelled: {'yes' if cancelled else '❌ FAILED'}")
+        tg_send(TG_CHAT_ID, "\n".join(lines))
+
+    def _save(self, b):
+        try:
+            journal.save_bracket(b)
+        except Exception as e:
+            logging.error(f"Bracket save failed for {b['id']}: {e}")
+
+    def _drop(self, bracket_id):
+        try:
+            return journal.drop_bracket(bracket_id)
+        except Exception as e:
+            logging.error(f"Bracket drop failed for {bracket_id}: {e}")
+            return True
+
+    def load(self):
+        """Pick up the brackets a previous run left open; the poller settles exits filled meanwhile."""
+        saved = journal.open_brackets()
+        with self.lock:
+            for b in saved:
+                self.active.setdefault(b["id"], b)
+        if saved:
+            logging.info(f"Resumed {len(saved)} open bracket(s)")
+            self.wake.set()
+        return len(saved)
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        try:
+            self.load()
+        except Exception as e:
+            logging.error(f"Bracket load failed: {e}")
+        self.thread = threading.Thread(target=self._run, name="brackets", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            if not self.active:
+                self.wake.wait()
+                self.wake.clear()
+            try:
+                if tokens.valid():
+                    self.poll()
+            except Exception as e:
+                logging.error(f"Bracket poll error: {e}")
+            time.sleep(BRACKET_POLL_SEC)
+
+    def stats(self):
+        with self.lock:
+            return {"active": len(self.active), "protected": self.protected,
+                    "incomplete": self.incomplete, "unprotected": self.unprotected,
+                    "triggered": self.triggered}
+
+brackets = BracketManager()
+
+# ================== HISTORY FETCH ==================
+history_pool = ThreadPoolExecutor(max_workers=HISTORY_WORKERS, thread_name_prefix="history")
+
+def history_slices(start_utc, end_utc, slice_hours=HISTORY_SLICE_HOURS):
+    step = datetime.timedelta(hours=slice_hours)
+    out = []
+    t = start_utc
+    while t < end_utc:
+        out.append((t, min(t + step, end_utc)))
+        t += step
+    return out
+
+def _fetch_slice(start_utc, end_utc):
+    resp = search_orders_window(start_utc, end_utc)
+    if not resp.get("success", True):
+        raise Exception(f"Order search failed for {start_utc}..{end_utc}: {resp.get('errorMessage')}")
+    return ingest_orders(resp.get("orders", []))
+
+def fetch_history(start_utc, end_utc, slice_hours=HISTORY_SLICE_HOURS):
+    """Yield OrderRecords for [start_utc, end_utc] in update-time order.
+
+    The range is split into slices fetched concurrently on history_pool;
+    each slice is already sorted, so they are k-way merged lazily and
+    de-duplicated by order id (slice bounds are inclusive on both ends).
+    """
+    start_utc = start_utc.replace(tzinfo=None)
+    end_utc = end_utc.replace(tzinfo=None)
+    futures = [history_pool.submit(_fetch_slice, a, b) for a, b in history_slices(start_utc, end_utc, slice_hours)]
 
-TG_BOT_TOKEN = os.getenv("TG_BOT_TOKEN")
-TG_CHAT_ID = os.getenv("TG_CHAT_ID")
+    def _iter(fut):
+        yield from fut.result()
 
-BASE_URL = "https://api.topstepx.com"
+    seen = set()
+    for rec in heapq.merge(*[_iter(f) for f in futures], key=record_sort_key):
+        if rec.id in seen:
+            continue
+        seen.add(rec.id)
+        yield rec
 
-cached_token = None
-cached_account_id = None
+# ================== WARM-UP ==================
+class Warmup:
+    """Startup warm-up that gates /readyz.
 
-# ================== SYMBOL MAP ==================
-SYMBOL_MAP = {
-    "MGC": "CON.F.US.MGC.G26",
-    "MNQ": "CON.F.US.MNQ.H26",
-}
+    Logs in (which resolves the account), resolves every contract and opens
+    broker and Telegram connections once, retrying with backoff until it
+    succeeds, so the first signal after a deploy pays none of it.
+    """
 
-# $ per 1.0 point (not tick)
-POINT_VALUE = {
-    "MNQ": 2.0,   # Micro Nasdaq: $2 per point
-    "MGC": 10.0,  # Micro Gold: $10 per point
-}
+    def __init__(self, enabled=WARMUP_ON_START):
+        self.enabled = enabled
+        self.done = threading.Event()
+        self.steps = {}  # name -> {"ok", "ms", "error"}
+        self.attempts = 0
+        self.started_utc = None
+        self.finished_utc = None
+        self.thread = None
+        if not enabled:
+            self.done.set()
 
-def contract_to_symbol(contract_id: str):
-    if not contract_id:
-        return ""
-    c = str(contract_id).upper()
-    if ".MNQ." in c or c.endswith(".MNQ") or "MNQ" in c:
-        return "MNQ"
-    if ".MGC." in c or c.endswith(".MGC") or "MGC" in c:
-        return "MGC"
-    return ""
+    def _step(self, name, fn):
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            self.steps[name] = {"ok": False, "ms": round((time.perf_counter() - t0) * 1000, 1), "error": str(e)}
+            raise
+        self.steps[name] = {"ok": True, "ms": round((time.perf_counter() - t0) * 1000, 1), "error": None}
 
-# ================== RUNTIME STATE (Telegram utilities) ==================
-SERVER_START_UTC = utc_now()
+    def _contracts(self):
+        for root in registry.roots:
+            try:
+                registry.resolve(root)
+            except Exception:
+                # a configured fallback id is good enough to trade on
+                if registry.contracts.get(root) is None:
+                    raise
 
-LAST_SIGNAL_UTC = None
-LAST_SIGNAL = None  # dict
+    def _broker_connections(self):
+        # concurrent calls force distinct pooled sockets; the result doubles as the account snapshot
+        results = bulk_run(range(WARMUP_BROKER_CONNECTIONS), lambda _: search_accounts(), ok=lambda r: True)
+        for r in results:
+            if r["ok"]:
+                snapshots.put("accounts", r["result"])
+                break
+        else:
+            raise Exception(results[0]["error"] if results else "no broker connections")
 
-LAST_EXEC_UTC = None
-LAST_EXEC = None    # dict
+    def _telegram(self):
+        tg_http.post(f"/bot{TG_BOT_TOKEN}/getMe", label="getMe", timeout=10)
 
-# ================== TELEGRAM ==================
-def tg_send(chat_id, text, keyboard=None):
-    if not TG_BOT_TOKEN or not chat_id:
-        return
-    payload = {"chat_id": chat_id, "text": text}
-    if keyboard:
-        payload["reply_markup"] = keyboard
-    try:
-        requests.post(
-            f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMessage",
-            json=payload,
-            timeout=8
-        )
-    except Exception as e:
-        logging.error(f"Telegram error: {e}")
+    def run_once(self):
+        self._step("login", tokens.ensure)
+        self._step("contracts", self._contracts)
+        if WARMUP_BROKER_CONNECTIONS > 0:
+            self._step("broker_connections", self._broker_connections)
+        if TG_BOT_TOKEN:
+            self._step("telegram", self._telegram)
 
-def tg_menu(chat_id):
-    tg_send(
-        chat_id,
-        "🎛️ Trading Control Panel v2.0",
-        {
-            "keyboard": [
-                ["💰 Balance", "🟢 Status"],
-                ["📊 Open Orders", "📈 Trade History"],
-                ["📌 Last Trade", "💥 Last Slippage"],
-                ["📊 Today Stats", "⏱️ Uptime / Last Signal"],
-                ["🚫 Cancel ALL Open Orders", "🔄 Refresh Menu"],
-            ],
-            "resize_keyboard": True
+    def start(self):
+        if not self.enabled or (self.thread and self.thread.is_alive()):
+            return
+        self.thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        self.started_utc = utc_now()
+        delay = 1
+        while True:
+            self.attempts += 1
+            try:
+                self.run_once()
+                break
+            except Exception as e:
+                logging.error(f"Warm-up attempt {self.attempts} failed: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+        self.finished_utc = utc_now()
+        self.done.set()
+        logging.info(f"Warm-up done in {(self.finished_utc - self.started_utc).total_seconds():.2f}s: "
+                     + ", ".join(f"{k} {v['ms']}ms" for k, v in self.steps.items()))
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def ready(self):
+        if not self.done.is_set():
+            return False
+        return not self.enabled or (tokens.valid() and bool(cached_account_id))
+
+    def state(self):
+        return {
+            "ready": self.ready(),
+            "warmedUp": self.done.is_set(),
+            "attempts": self.attempts,
+            "steps": self.steps,
+            "finishedUtc": self.finished_utc.isoformat() + "Z" if self.finished_utc else None,
         }
-    )
 
-# ================== UTILS ==================
-def normalize_symbol(raw: str) -> str:
-    raw = raw.upper()
-    if raw.startswith("MGC"):
-        return "MGC"
-    if raw.startswith("MNQ"):
-        return "MNQ"
-    return ""
+warmup = Warmup()
 
-# ================== TOPSTEP ==================
-def connect_topstep():
-    global cached_token, cached_account_id
+# ================== HEALTH ==================
+@app.route("/livez", methods=["GET"])
+def livez():
+    # the process is up and serving requests; nothing else is checked
+    return jsonify({"status": "alive"}), 200
 
-    login = requests.post(
-        f"{BASE_URL}/api/Auth/loginKey",
-        json={"userName": USERNAME, "apiKey": API_KEY},
-        timeout=15
-    ).json()
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    # cached state only: warmed up and holding a valid token and account
+    body = warmup.state()
+    body["status"] = "ready" if body["ready"] else "not ready"
+    return jsonify(body), 200 if body["ready"] else 503
 
-    if not login.get("success"):
-        raise Exception("Login failed")
+@app.route("/", methods=["GET"])
+def health():
+    body, code = health_state()
+    return jsonify(body), code
 
-    validate = requests.post(
-        f"{BASE_URL}/api/Auth/validate",
-        headers={"Authorization": f"Bearer {login['token']}"},
-        timeout=15
-    ).json()
+def health_state():
+    # answers from cached token state; never logs in
+    connected = tokens.valid() and bool(cached_account_id)
+    body = {"status": "connected" if connected else "disconnected", "accountId": cached_account_id}
+    body.update(tokens.state())
+    body["telegram"] = tg_outbox.stats()
+    body["fills"] = fill_watcher.stats()
+    body["snapshots"] = dict(snapshots.stats)
+    body["idempotency"] = idempotency.stats()
+    body["rateLimits"] = broker.limiter.stats()
+    if netter.enabled:
+        body["netting"] = netter.stats()
+    body["brackets"] = brackets.stats()
+    body["positions"] = {"net": dict(positions.net), "drifts": positions.drifts}
+    if copy_accounts:
+        body["copyAccounts"] = [
+            dict(acc, net=dict(positions_for(acc["id"]).net)) for acc in copy_accounts
+        ]
+    if signal_queue is not None:
+        body["signalQueueDepth"] = signal_queue.depth()
+    return body, 200 if connected else 503
 
-    cached_token = validate["newToken"]
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
-    accounts = requests.post(
-        f"{BASE_URL}/api/Account/search",
-        headers={"Authorization": f"Bearer {cached_token}"},
-        json={"onlyActiveAccounts": True},
-        timeout=15
-    ).json().get("accounts", [])
+metrics.gauge("telegram_outbox_depth", lambda: tg_outbox.depth())
+metrics.gauge("telegram_outbox_dropped", lambda: tg_outbox.dropped)
+metrics.gauge("token_valid", lambda: 1 if tokens.valid() else 0)
+metrics.gauge("ready", lambda: 1 if warmup.ready() else 0)
 
-    match = next(
-        (a for a in accounts if a["name"].strip().lower() == TARGET_ACCOUNT_NAME.strip().lower()),
-        None
+def fmt_rate_limits():
+    return " | ".join(
+        (f"{st['sent']}/{st['limit']} per window" if name == "window" else f"{name} {st['tokens']:g} tok")
+        + (f", {st['queued']} queued" if st["queued"] else "")
+        + (f", 429 hold {st['blockedForSec']:g}s" if st["blockedForSec"] else "")
+        for name, st in broker.limiter.stats().items()
+    ) or "off"
+
+def fmt_percentiles(name):
+    p = metrics.percentiles(name)
+    return " | ".join(
+        f"p{q}: {p[q] * 1000:.0f}ms" if p[q] is not None else f"p{q}: N/A" for q in (50, 95, 99)
     )
 
-    if not match:
-        raise Exception("Target account not found")
+# ================== SIGNAL EXECUTION ==================
+class SignalError(Exception):
+    """Payload rejected before anything is sent to the broker (HTTP 400)."""
 
-    cached_account_id = match["id"]
+ACTION_MAP = {"buy": "buy", "sell": "sell", "close": "close", "exit": "close"}
 
-def ts_headers():
-    return {"Authorization": f"Bearer {cached_token}"}
-
-def search_orders_window(start_utc: datetime.datetime, end_utc: datetime.datetime):
-    return requests.post(
-        f"{BASE_URL}/api/Order/search",
-        headers=ts_headers(),
-        json={
-            "accountId": cached_account_id,
-            "startTimestamp": start_utc.isoformat() + "Z",
-            "endTimestamp": end_utc.isoformat() + "Z"
-        },
-        timeout=20
-    ).json()
+def parse_signal(data):
+    raw_symbol = str(data.get("symbol", ""))
+    action_raw = str(data.get("data", "")).lower()
+    qty = int(float(data.get("quantity", 0)))
+    planned_entry = float(data.get("entry_price", 0))
 
-def search_open_orders():
-    return requests.post(
-        f"{BASE_URL}/api/Order/searchOpen",
-        headers=ts_headers(),
-        json={"accountId": cached_account_id},
-        timeout=20
-    ).json()
+    symbol = normalize_symbol(raw_symbol)
+    if not symbol:
+        raise SignalError("Unsupported symbol")
 
-def cancel_order(order_id: int):
-    return requests.post(
-        f"{BASE_URL}/api/Order/cancel",
-        headers=ts_headers(),
-        json={"accountId": cached_account_id, "orderId": order_id},
-        timeout=20
-    ).json()
+    action = ACTION_MAP.get(action_raw)
+    if not action:
+        raise SignalError("Invalid action")
 
-# ================== HEALTH ==================
-@app.route("/", methods=["GET"])
-def health():
-    connect_topstep()
-    return jsonify({"status": "connected", "accountId": cached_account_id})
+    if action != "close" and qty <= 0:
+        raise SignalError("Invalid quantity")
 
-# ================== TRADINGVIEW WEBHOOK ==================
-@app.route("/webhook", methods=["POST"])
-def tradingview_webhook():
-    global LAST_SIGNAL_UTC, LAST_SIGNAL, LAST_EXEC_UTC, LAST_EXEC
+    sig = {
+        "symbol": symbol,
+        "action": action,
+        "qty": qty,
+        "planned_entry": planned_entry,
+        "raw": data
+    }
+    if action != "close":
+        sig.update(bracket_distances(symbol, data))
+    return sig
+
+def bracket_distances(symbol, data):
+    """Optional "stop" / "target" distances from the entry fill, in points (or ticks with bracket_unit)."""
+    unit = str(data.get("bracket_unit", "points")).lower()
+    if unit not in ("points", "ticks"):
+        raise SignalError("Invalid bracket_unit")
+    out = {}
+    for field in ("stop", "target"):
+        if data.get(field) in (None, "", 0):
+            continue
+        try:
+            dist = float(data[field])
+        except (TypeError, ValueError):
+            raise SignalError(f"Invalid {field}")
+        if dist <= 0:
+            raise SignalError(f"Invalid {field}")
+        if unit == "ticks":
+            tick = registry.tick_size(symbol)
+            if not tick:
+                raise SignalError(f"No tick size for {symbol}")
+            dist *= tick
+        out[field] = dist
+    return out
 
+def record_signal(sig):
+    # ذخیره آخرین سیگنال
+    sig.setdefault("received_ts", time.time())
+    set_last("last_signal", sig)
+
+def execute_signal(sig, on_placed=None, timer=None):
+    """Place, confirm and report one parsed signal. Returns (body, http_code)."""
+    timer = timer or StageTimer()
     try:
-        if not cached_token or not cached_account_id:
-            connect_topstep()
+        return run_flow(_execute_signal(sig, on_placed, timer))
+    finally:
+        timer.flush(sig["symbol"], sig["action"])
 
-        data = request.get_json(force=True)
-        logging.info(f"Webhook received: {data}")
+def plan_order(sig, timer, account=None):
+    """Contract, side and size for a signal on one account (default: the TARGET_ACCOUNT).
 
-        raw_symbol = str(data.get("symbol", ""))
-        action_raw = str(data.get("data", "")).lower()
-        qty = int(float(data.get("quantity", 0)))
-        planned_entry = float(data.get("entry_price", 0))
+    Returns (plan, None), or (None, (body, http_code)) when nothing is to be sent.
+    Copy-account legs (account given) stay quiet; their outcome goes in the combined report.
+    """
+    symbol = sig["symbol"]
+    action = sig["action"]
+    qty = sig["qty"]
+    quiet = account is not None
+    account = account or trading_accounts()[0]
+    book = positions_for(account["id"])
 
-        symbol = normalize_symbol(raw_symbol)
-        if not symbol:
-            return jsonify({"error": "Unsupported symbol"}), 400
+    contract_id = registry.contract_id(symbol)
 
-        action_map = {"buy": "buy", "sell": "sell", "close": "close", "exit": "close"}
-        action = action_map.get(action_raw)
-        if not action:
-            return jsonify({"error": "Invalid action"}), 400
+    # ---- CLOSE ----
+    if action == "close":
+        # size from the local net position; broker is only asked if we never synced, or
+        # always when several workers share the account (the entry may have gone through another)
+        held = book.held(symbol)
+        if held is None or SHARED_WORKERS:
+            book.reconcile(alert=False)
+            held = book.held(symbol)
+        net = 0
+        if held:
+            # prefer the front month; a pre-roll position closes on its own contract
+            contract_id, net = next(((c, n) for c, n in held if c == contract_id), held[0])
+        if not net:
+            if not quiet:
+                with timer.stage("tg_send"):
+                    tg_send(TG_CHAT_ID, "ℹ️ Already flat")
+            return None, ({"status": "already_flat"}, 200)
 
-        # ذخیره آخرین سیگنال
-        LAST_SIGNAL_UTC = utc_now()
-        LAST_SIGNAL = {
-            "symbol": symbol,
-            "action": action,
-            "qty": qty,
-            "planned_entry": planned_entry,
-            "raw": data
-        }
+        qty = abs(net)
+        side_code = 1 if net > 0 else 0  # reverse
+    else:
+        qty = int(qty * account["multiplier"] + 1e-9)
+        if qty <= 0:
+            return None, ({"status": "zero_size"}, 200)
+        side_code = 0 if action == "buy" else 1
 
-        # ---- CLOSE ----
-        if action == "close":
-            now = utc_now()
-            resp = search_orders_window(now - datetime.timedelta(hours=12), now)
-            orders = resp.get("orders", [])
-            if not orders:
-                tg_send(TG_CHAT_ID, "ℹ️ Already flat")
-                return jsonify({"status": "already_flat"}), 200
-
-            last = orders[-1]
-            qty = int(last.get("size", 0) or 0)
-            side_code = 1 if last.get("side") == 0 else 0  # reverse
-        else:
-            if qty <= 0:
-                return jsonify({"error": "Invalid quantity"}), 400
-            side_code = 0 if action == "buy" else 1
-
-        payload = {
-            "accountId": cached_account_id,
-            "contractId": SYMBOL_MAP[symbol],
-            "type": 2,  # MARKET
-            "side": side_code,
-            "size": qty
-        }
+    payload = {
+        "accountId": account["id"],
+        "contractId": contract_id,
+        "type": 2,  # MARKET
+        "side": side_code,
+        "size": qty
+    }
+    return {"contract_id": contract_id, "side": side_code, "qty": qty, "payload": payload,
+            "account": account}, None
 
-        r = requests.post(
-            f"{BASE_URL}/api/Order/place",
-            headers=ts_headers(),
-            json=payload,
-            timeout=20
-        ).json()
+def order_rejected(r, timer):
+    metrics.inc("broker_errors_total", endpoint="/api/Order/place", reason="rejected")
+    with timer.stage("tg_send"):
+        tg_send(TG_CHAT_ID, f"❌ ORDER FAILED\n{r}")
+    return r, 400
+
+def nettable(sig):
+    # closes and bracketed entries are placed as they come
+    return netter.enabled and sig["action"] != "close" and not (sig.get("stop") or sig.get("target"))
+
+def _execute_signal(sig, on_placed, timer):
+    """Flow: (body, http_code) for one parsed signal."""
+    if nettable(sig):
+        return (yield from netter.submit(sig, timer, lambda net, placed: _place_signal(net, placed, timer),
+                                         on_placed))
+    return (yield from _place_signal(sig, on_placed, timer))
+
+def _place_signal(sig, on_placed, timer):
+    if copy_accounts:
+        return (yield from execute_copies(sig, on_placed, timer))
+    plan, early = yield from _plan(sig, timer)
+    if early:
+        return early
+    r, fill = yield from place_and_confirm(sig, plan, timer, on_placed)
+    if fill is None:
+        return order_rejected(r, timer)
+    # journal / state writes
+    return (yield Blocking(finish_execution, (sig, plan, r, fill, timer)))
+
+def _plan(sig, timer, account=None):
+    if sig["action"] == "close":
+        # may reconcile against the broker before sizing
+        return (yield Blocking(plan_order, (sig, timer, account)))
+    return plan_order(sig, timer, account)
+
+def place_and_confirm(sig, plan, timer, on_placed=None):
+    """Flow: place a planned order and wait for its fill. Returns (response, fill); fill is None if rejected."""
+    contract_id = plan["contract_id"]
+    account_id = plan["account"]["id"]
+    book = positions_for(account_id)
+
+    if brackets.active:
+        # a close or reversal retires the account's open brackets on this contract first
+        keep_side = None if sig["action"] == "close" else plan["side"]
+        yield Blocking(brackets.release, (account_id, contract_id, keep_side))
+
+    book.begin(contract_id)
+    try:
+        placed_utc = utc_now()
+        with timer.stage("place"):
+            try:
+                r = yield Call("/api/Order/place", plan["payload"], PRIORITY_ORDER)
+            finally:
+                snapshots.invalidate()
 
         if not r.get("success"):
-            tg_send(TG_CHAT_ID, f"❌ ORDER FAILED\n{r}")
-            return jsonify(r), 400
+            return r, None
 
-        # ===== WAIT FOR BROKER FILL (filledPrice) =====
-        fill_price = None
-        for _ in range(3):
-            time.sleep(0.7)
-            now = utc_now()
-            resp = search_orders_window(now - datetime.timedelta(seconds=5), now)
-            orders = resp.get("orders", [])
-            if orders:
-                last = orders[-1]
-                if last.get("fillVolume", 0) and last.get("filledPrice") is not None:
-                    fill_price = last.get("filledPrice")
-                    break
+        if on_placed:
+            on_placed(r.get("orderId"))
+
+        # ===== WAIT FOR BROKER FILL (by orderId) =====
+        with timer.stage("fill_wait"):
+            fill = yield from fill_watcher.wait_flow(r.get("orderId"), placed_utc, plan["qty"], sig["symbol"],
+                                                     account_id=account_id)
+        book.apply_fill(contract_id, plan["side"], fill["filled_qty"])
+        # balance and open orders moved with the fill
+        snapshots.invalidate()
+    finally:
+        book.end(contract_id)
+    fill["bracket"] = yield from protect(sig, plan, fill, timer)
+    return r, fill
+
+# ---- copy trading: one leg per account, placed concurrently ----
+account_pool = ThreadPoolExecutor(max_workers=COPY_WORKERS, thread_name_prefix="copy")
+
+def new_leg(account):
+    return {"account": account["name"], "accountId": account["id"], "qty": 0, "orderId": None,
+            "fillPrice": None, "slippage": None, "status": None, "time_to_fill_ms": None}
+
+def leg_filled(leg, sig, plan, r, fill, timer):
+    """Fill in a leg from a confirmed order (journals it via finish_execution)."""
+    body, _ = finish_execution(sig, plan, r, fill, timer, notify=False)
+    leg.update(orderId=body["orderId"], fillPrice=body["fillPrice"], slippage=body["slippage"],
+               status=fill["status"], time_to_fill_ms=fill["time_to_fill_ms"])
+    if fill.get("bracket"):
+        leg["bracket"] = fill["bracket"]
+
+def leg_rejected(leg, r):
+    metrics.inc("broker_errors_total", endpoint="/api/Order/place", reason="rejected")
+    leg["status"] = "rejected"
+    leg["error"] = r.get("errorMessage") or str(r)
 
+def _run_leg(sig, account, timer, on_placed=None):
+    leg = new_leg(account)
+    try:
+        plan, early = yield from _plan(sig, timer, account)
+        if early:
+            leg["status"] = early[0]["status"]
+            return leg
+        leg["qty"] = plan["qty"]
+        r, fill = yield from place_and_confirm(sig, plan, timer, on_placed)
+        leg["orderId"] = r.get("orderId")
+        if fill is None:
+            leg_rejected(leg, r)
+        else:
+            yield Blocking(leg_filled, (leg, sig, plan, r, fill, timer))
+    except Exception as e:
+        logging.exception(f"Copy leg failed for {account['name']}")
+        leg["status"] = "error"
+        leg["error"] = str(e)
+    return leg
+
+def execute_copies(sig, on_placed, timer):
+    """Flow: fan a signal out to every trading account at once; one combined report."""
+    accounts = trading_accounts()
+    # the TARGET_ACCOUNT leg runs on the request's timer; copies get their own
+    legs = yield Gather([_run_leg(sig, accounts[0], timer, on_placed)]
+                        + [_run_leg(sig, acc, StageTimer()) for acc in accounts[1:]], account_pool)
+    return (yield Blocking(report_copies, (sig, legs, timer)))
+
+def report_copies(sig, legs, timer):
+    """Per-account fill/slippage message and response body for a copied signal."""
+    placed = [leg for leg in legs if leg["orderId"] is not None]
+    if not placed and all(leg["status"] == "already_flat" for leg in legs):
+        with timer.stage("tg_send"):
+            tg_send(TG_CHAT_ID, "ℹ️ Already flat")
+        return {"status": "already_flat", "accounts": legs}, 200
+
+    lines = [
+        "✅ ORDER EXECUTED" if placed else "❌ ORDER FAILED",
+        f"Symbol: {sig['symbol']}",
+        f"Side: {sig['action'].upper()}",
+        f"Time: {fmt_time_ny(utc_now())} NY",
+        f"Planned Entry: {sig['planned_entry']}",
+    ]
+    if sig.get("netted"):
+        lines.append(f"Netted: {sig['netted']} signals")
+    lines.append("")
+    for leg in legs:
+        if leg["orderId"] is not None and leg["status"] != "rejected":
+            lines.append(
+                f"{leg['account']}: x{leg['qty']} @ {leg['fillPrice']} ({leg['status']}) "
+                f"slip {leg['slippage']} | {leg['time_to_fill_ms']} ms"
+                + (f" | {fmt_bracket(leg['bracket'])}" if leg.get("bracket") else "")
+            )
+        else:
+            lines.append(f"{leg['account']}: {leg['status']} {leg.get('error', '')}".rstrip())
+    with timer.stage("tg_send"):
+        tg_send(TG_CHAT_ID, "\n".join(lines))
+
+    primary = legs[0]
+    body = {"status": "success" if placed else "failed", "orderId": primary["orderId"],
+            "fillPrice": primary["fillPrice"], "slippage": primary["slippage"], "accounts": legs}
+    return body, 200 if placed else 400
+
+def finish_execution(sig, plan, r, fill, timer, notify=True):
+    """Journal, slippage, last-exec state and the ✅ message for a placed order."""
+    symbol = sig["symbol"]
+    action = sig["action"]
+    planned_entry = sig["planned_entry"]
+    side_code = plan["side"]
+    qty = plan["qty"]
+
+    fill_price = fill["fill_price"]
+    if fill["order"]:
+        journal.record([fill["order"]])
+
+    with timer.stage("slippage"):
         slippage = None
         if fill_price is not None:
             slippage = round(fill_price - planned_entry, 4)
+            if sig.get("received_ts"):
+                metrics.observe("signal_to_fill_seconds", time.time() - sig["received_ts"],
+                                symbol=symbol, action=action)
 
-        # ذخیره آخرین اجرا
-        LAST_EXEC_UTC = utc_now()
-        LAST_EXEC = {
+    account_id = plan["account"]["id"]
+    journal.record_execution(r.get("orderId"), symbol, side_code, qty, planned_entry,
+                             fill_price, slippage, fill["time_to_fill_ms"], account_id=account_id)
+
+    # ذخیره آخرین اجرا
+    exec_utc = utc_now()
+    # CLOSE alerts without an entry_price have no planned price to measure slippage against
+    exec_stats.record(symbol, side_code, exec_utc, slippage if planned_entry else None,
+                      fill["time_to_fill_ms"])
+    if account_id == cached_account_id:
+        set_last("last_exec", {
             "symbol": symbol,
             "side": action.upper(),
             "qty": qty,
             "planned_entry": planned_entry,
             "fill_price": fill_price,
-            "slippage": slippage
+            "slippage": slippage,
+            "order_id": r.get("orderId"),
+            "fill_status": fill["status"],
+            "filled_qty": fill["filled_qty"],
+            "time_to_fill_ms": fill["time_to_fill_ms"],
+        }, exec_utc)
+
+    if notify:
+        with timer.stage("tg_send"):
+            tg_send(
+                TG_CHAT_ID,
+                f"✅ ORDER EXECUTED\n"
+                f"Symbol: {symbol}\n"
+                f"Side: {action.upper()}\n"
+                f"Qty: {qty}\n"
+                f"Time: {fmt_time_ny(exec_utc)} NY\n\n"
+                f"Planned Entry: {planned_entry}\n"
+                f"Broker Fill: {fill_price} ({fill['status']}, {fill['filled_qty']}/{qty})\n"
+                f"Slippage: {slippage}\n"
+                f"Time to fill: {fill['time_to_fill_ms']} ms"
+                + (f"\nNetted: {sig['netted']} signals" if sig.get("netted") else "")
+                + (f"\nBracket: {fmt_bracket(fill['bracket'])}" if fill.get("bracket") else "")
+            )
+
+    body = {"status": "success", "orderId": r.get("orderId"), "fillPrice": fill_price, "slippage": slippage}
+    if fill.get("bracket"):
+        body["bracket"] = fill["bracket"]
+    return body, 200
+
+# ================== NETTING WINDOW ==================
+class SignalNetter:
+    """Per-symbol micro-batching of buy/sell signals.
+
+    The first signal for a symbol opens a batch and holds it for
+    NETTING_WINDOW_MS; signals arriving meanwhile join it. The batch is then
+    netted into one order (or none when it cancels out) and every
+    contributor gets that order's fill, with slippage against its own
+    planned entry.
+    """
+
+    def __init__(self, window_ms):
+        self.window = window_ms / 1000.0
+        self.enabled = self.window > 0
+        self.lock = threading.Lock()
+        self.open = {}  # symbol -> batch still collecting
+        self.batches = 0
+        self.signals = 0
+        self.orders = 0
+
+    def join(self, sig, on_placed=None):
+        """Add a signal to its symbol's open batch. Returns (batch, is_leader)."""
+        with self.lock:
+            batch = self.open.get(sig["symbol"])
+            leader = batch is None
+            if leader:
+                batch = {"id": uuid.uuid4().hex[:8], "signals": [], "on_placed": [], "future": Future()}
+                self.open[sig["symbol"]] = batch
+            batch["signals"].append(sig)
+            if on_placed:
+                batch["on_placed"].append(on_placed)
+            return batch, leader
+
+    @staticmethod
+    def placed_callback(batch):
+        """on_placed for the net order: tells every contributor (e.g. its signal-queue row)."""
+        def _placed(order_id):
+            for fn in batch["on_placed"]:
+                try:
+                    fn(order_id)
+                except Exception as e:
+                    logging.error(f"on_placed failed for batch {batch['id']}: {e}")
+        return _placed
+
+    def seal(self, batch):
+        """Close the batch to newcomers; the net signal to place, or None if it nets to zero."""
+        signals = batch["signals"]
+        with self.lock:
+            self.open.pop(signals[0]["symbol"], None)
+            self.batches += 1
+            self.signals += len(signals)
+
+        net = sum(s["qty"] if s["action"] == "buy" else -s["qty"] for s in signals)
+        batch["net_qty"] = net
+        if net:
+            with self.lock:
+                self.orders += 1
+        if len(signals) == 1:
+            return signals[0]
+        metrics.inc("netting_batches_total", symbol=signals[0]["symbol"], outcome="order" if net else "flat")
+        if not net:
+            return None
+        action = "buy" if net > 0 else "sell"
+        # the net order's own slippage is measured against the winning side's average entry
+        side = [s for s in signals if s["action"] == action]
+        side_qty = sum(s["qty"] for s in side)
+        planned = sum(s["planned_entry"] * s["qty"] for s in side) / side_qty
+        return {
+            "symbol": signals[0]["symbol"],
+            "action": action,
+            "qty": abs(net),
+            "planned_entry": round(planned, 4),
+            "received_ts": min(s.get("received_ts") or time.time() for s in signals),
+            "netted": len(signals),
+            "raw": {"netted": [s.get("raw") for s in signals]},
         }
 
+    def netted_out(self, batch):
+        signals = batch["signals"]
+        buys = sum(s["qty"] for s in signals if s["action"] == "buy")
+        sells = sum(s["qty"] for s in signals if s["action"] == "sell")
         tg_send(
             TG_CHAT_ID,
-            f"✅ ORDER EXECUTED\n"
-            f"Symbol: {symbol}\n"
-            f"Side: {action.upper()}\n"
-            f"Qty: {qty}\n"
-            f"Time: {fmt_time_ny(LAST_EXEC_UTC)} NY\n\n"
-            f"Planned Entry: {planned_entry}\n"
-            f"Broker Fill: {fill_price}\n"
-            f"Slippage: {slippage}"
+            f"⚖️ SIGNALS NETTED OUT\n"
+            f"Symbol: {signals[0]['symbol']}\n"
+            f"Signals: {len(signals)} (buy {buys} / sell {sells})\n"
+            f"No order sent"
+        )
+        return {"status": "netted_out"}, 200
+
+    def attribute(self, batch, sig):
+        """One contributor's share of the batch result as (body, http_code)."""
+        body, code = batch["future"].result()
+        if len(batch["signals"]) == 1:
+            return body, code
+        fill_price = body.get("fillPrice")
+        mine = {
+            "status": body.get("status", "failed" if code >= 400 else "success"),
+            "orderId": body.get("orderId"),
+            "fillPrice": fill_price,
+            "slippage": round(fill_price - sig["planned_entry"], 4) if fill_price is not None else None,
+            "netting": {"batch": batch["id"], "signals": len(batch["signals"]), "netQty": batch["net_qty"]},
+        }
+        if "accounts" in body:
+            mine["accounts"] = [
+                dict(leg, slippage=round(leg["fillPrice"] - sig["planned_entry"], 4)
+                     if leg["fillPrice"] is not None else None)
+                for leg in body["accounts"]
+            ]
+        if code >= 400 and "errorMessage" in body:
+            mine["errorMessage"] = body["errorMessage"]
+        return mine, code
+
+    def submit(self, sig, timer, execute, on_placed=None):
+        """Flow: wait out the window (leader) or the batch result (others).
+
+        execute(net, on_placed) is the flow that places the net order;
+        on_placed fans out to every contributor's own callback.
+        """
+        batch, leader = self.join(sig, on_placed)
+        if leader:
+            with timer.stage("netting_window"):
+                yield Sleep(self.window)
+            net = self.seal(batch)
+            try:
+                if net is not None:
+                    result = yield from execute(net, self.placed_callback(batch))
+                else:
+                    result = self.netted_out(batch)
+            except Exception as e:
+                batch["future"].set_exception(e)
+                raise
+            batch["future"].set_result(result)
+        else:
+            with timer.stage("netting_wait"):
+                exception = yield Await(batch["future"])
+            if exception is not None:
+                return {"error": str(exception)}, 500
+        return self.attribute(batch, sig)
+
+    def stats(self):
+        with self.lock:
+            return {"windowMs": self.window * 1000, "batches": self.batches,
+                    "signals": self.signals, "orders": self.orders}
+
+netter = SignalNetter(NETTING_WINDOW_MS)
+
+# ================== SIGNAL QUEUE (async ack mode) ==================
+class SignalQueue:
+    """Durable SQLite-backed queue of accepted signals plus a worker pool.
+
+    Status flow: queued -> running -> placed -> done | failed.
+    On restart, queued/running rows are replayed; placed rows are not re-sent
+    (the order may already be live) and are flagged as interrupted instead.
+    """
+
+    def __init__(self, path, workers=4):
+        self.path = path
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.q = queue.Queue()
+        self.threads = []
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS signals ("
+            " id TEXT PRIMARY KEY, received_utc TEXT, updated_utc TEXT, status TEXT,"
+            " payload TEXT, order_id INTEGER, http_code INTEGER, result TEXT)"
         )
+        self.db.execute("CREATE INDEX IF NOT EXISTS signals_status ON signals(status)")
+
+    def _update(self, signal_id, **cols):
+        cols["updated_utc"] = utc_now().isoformat() + "Z"
+        assigns = ", ".join(f"{k} = ?" for k in cols)
+        with self.lock:
+            self.db.execute(f"UPDATE signals SET {assigns} WHERE id = ?", (*cols.values(), signal_id))
+
+    def submit(self, sig):
+        signal_id = uuid.uuid4().hex[:16]
+        now = utc_now().isoformat() + "Z"
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO signals (id, received_utc, updated_utc, status, payload) VALUES (?, ?, ?, 'queued', ?)",
+                (signal_id, now, now, json.dumps(sig)),
+            )
+        self.q.put(signal_id)
+        return signal_id
+
+    def get(self, signal_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, received_utc, updated_utc, status, payload, order_id, http_code, result"
+                " FROM signals WHERE id = ?", (signal_id,)
+            ).fetchone()
+        if not row:
+            return None
+        return {
+            "signal_id": row[0],
+            "received_utc": row[1],
+            "updated_utc": row[2],
+            "status": row[3],
+            "signal": json.loads(row[4]) if row[4] else None,
+            "order_id": row[5],
+            "http_code": row[6],
+            "result": json.loads(row[7]) if row[7] else None,
+        }
+
+    def depth(self):
+        return self.q.qsize()
+
+    def start(self):
+        if self.threads:
+            return
+        self.replay()
+        for i in range(max(1, self.workers)):
+            t = threading.Thread(target=self._run, name=f"signal-worker-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def replay(self):
+        cutoff = (utc_now() - datetime.timedelta(seconds=SIGNAL_REPLAY_MAX_AGE_SEC)).isoformat() + "Z"
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, received_utc, status FROM signals"
+                " WHERE status IN ('queued', 'running', 'placed') ORDER BY received_utc"
+            ).fetchall()
+        for signal_id, received_utc, status in rows:
+            if status == "placed":
+                self._update(signal_id, status="interrupted")
+                tg_send(TG_CHAT_ID, f"⚠️ Signal {signal_id} was interrupted after order placement; check positions")
+            elif received_utc < cutoff:
+                self._update(signal_id, status="expired")
+                tg_send(TG_CHAT_ID, f"⚠️ Signal {signal_id} expired before execution (received {received_utc})")
+            else:
+                self._update(signal_id, status="queued")
+                self.q.put(signal_id)
+                logging.info(f"Replaying signal {signal_id}")
+
+    def _run(self):
+        while True:
+            signal_id = self.q.get()
+            try:
+                self._execute(signal_id)
+            finally:
+                self.q.task_done()
+
+    def _execute(self, signal_id):
+        entry = self.get(signal_id)
+        if not entry or entry["status"] != "queued":
+            return
+        self._update(signal_id, status="running")
+        try:
+            timer = StageTimer()
+            with timer.stage("token"):
+                tokens.ensure()
+            body, code = execute_signal(
+                entry["signal"],
+                timer=timer,
+                on_placed=lambda order_id: self._update(signal_id, status="placed", order_id=order_id),
+            )
+            status = "done" if code < 400 else "failed"
+            self._update(signal_id, status=status, http_code=code, result=json.dumps(body, default=str))
+        except Exception as e:
+            logging.exception(f"Signal {signal_id} error")
+            tg_send(TG_CHAT_ID, f"🔥 SYSTEM ERROR\n{str(e)}")
+            self._update(signal_id, status="failed", http_code=500, result=json.dumps({"error": str(e)}))
+
+signal_queue = SignalQueue(SIGNAL_DB_PATH, workers=SIGNAL_WORKERS) if WEBHOOK_ASYNC else None
+
+# ================== IDEMPOTENCY ==================
+# TradingView placeholders that identify the bar an alert belongs to. De-duplication
+# needs one of them (or an alert_id) in the alert message, e.g.
+#   {"symbol": "{{ticker}}", "data": "buy", "quantity": 1, "entry_price": {{close}}, "time": "{{time}}"}
+# Without either, every delivery is executed: two CLOSEs (or two buys at a fixed
+# entry_price) minutes apart are different alerts, not re-deliveries.
+BAR_TIME_FIELDS = ("bar_time", "time")
+
+def idempotency_key(sig):
+    """Client alert_id if given, else a hash of what the alert asks for on which bar.
+
+    None (no de-duplication) when the payload carries neither.
+    """
+    raw = sig.get("raw") or {}
+    alert_id = raw.get("alert_id")
+    if alert_id:
+        return f"id:{alert_id}"
+    bar_time = next((raw[f] for f in BAR_TIME_FIELDS if raw.get(f)), None)
+    if bar_time is None:
+        return None
+    text = f"{sig['symbol']}|{sig['action']}|{sig['qty']}|{sig['planned_entry']}|{bar_time}"
+    return "h:" + hashlib.sha256(text.encode()).hexdigest()[:32]
+
+class IdempotencyCache:
+    """Recent webhook keys -> original response; bounded LRU with a TTL.
+
+    claim() returns None for a first delivery (the caller executes it and
+    calls complete() or release()); a re-delivery gets the existing entry,
+    whose result wait() hands back once the original finishes. With persist,
+    keys are also claimed in the shared state backend. A None key (alert
+    without alert_id or bar time) is never de-duplicated.
+    """
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL_SEC, max_keys=IDEMPOTENCY_MAX_KEYS, persist=IDEMPOTENCY_PERSIST):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> {"done", "result", "expires", "remote"}
+        self.duplicates = 0
+
+    def claim(self, key):
+        if key is None:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            while self.entries:
+                oldest = next(iter(self.entries.values()))
+                if oldest["expires"] > now and len(self.entries) < self.max_keys:
+                    break
+                self.entries.popitem(last=False)
+            entry = self.entries.get(key)
+            if entry is not None and entry["expires"] > now:
+                self.entries.move_to_end(key)
+                self.duplicates += 1
+                return entry
+            entry = {"done": threading.Event(), "result": None, "expires": now + self.ttl, "remote": False}
+            self.entries[key] = entry
+        if self.persist and not state.setnx(f"idem:{key}", {"result": None}, ttl=self.ttl):
+            # another worker (or this one before a restart) owns the key
+            shared = state.get(f"idem:{key}") or {}
+            entry["remote"] = True
+            if shared.get("result") is not None:
+                entry["result"] = tuple(shared["result"])
+                entry["done"].set()
+            with self.lock:
+                self.duplicates += 1
+            return entry
+        return None
+
+    def wait(self, key, entry, timeout=IDEMPOTENCY_WAIT_SEC):
+        """The original (body, code), or None if it is still running after timeout."""
+        if not entry["remote"]:
+            entry["done"].wait(timeout)
+            return entry["result"]
+        deadline = time.monotonic() + timeout
+        while not entry["done"].is_set() and time.monotonic() < deadline:
+            shared = state.get(f"idem:{key}") or {}
+            if shared.get("result") is not None:
+                entry["result"] = tuple(shared["result"])
+                entry["done"].set()
+                break
+            time.sleep(0.05)
+        return entry["result"]
+
+    def complete(self, key, body, code):
+        if key is None:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            entry["result"] = (body, code)
+            entry["done"].set()
+        if self.persist:
+            state.set(f"idem:{key}", {"result": [body, code]}, ttl=self.ttl)
+
+    def release(self, key):
+        """Forget a key whose delivery failed before a result, so a retry can run."""
+        if key is None:
+            return
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry["done"].set()
+        if self.persist:
+            state.delete(f"idem:{key}")
+
+    def stats(self):
+        with self.lock:
+            return {"keys": len(self.entries), "duplicates": self.duplicates}
 
-        return jsonify({"status": "success"})
+idempotency = IdempotencyCache()
+metrics.describe("webhook_duplicates_total", "Re-delivered alerts answered from the idempotency cache")
 
+def duplicate_response(key, entry, sig):
+    """(body, code) for a re-delivered alert, without touching the broker."""
+    metrics.inc("webhook_duplicates_total", symbol=sig["symbol"], source=key.split(":", 1)[0])
+    logging.info(f"Duplicate alert {key} suppressed")
+    result = idempotency.wait(key, entry)
+    if result is None:
+        return {"status": "in_progress", "duplicate": True}, 409
+    return result
+
+# ================== TRADINGVIEW WEBHOOK ==================
+def webhook_flow(data, timer, hold):
+    """Flow: everything /webhook does with a decoded alert. Returns (body, http_code, headers).
+
+    The parsed signal is left in hold["signal"] for the ack-latency metric.
+    """
+    logging.info(f"Webhook received: {data}")
+
+    try:
+        with timer.stage("normalize"):
+            sig = parse_signal(data)
+    except SignalError as e:
+        timer.flush()
+        return {"error": str(e)}, 400, {}
+
+    hold["signal"] = sig
+    key = idempotency_key(sig)
+    entry = yield Blocking(idempotency.claim, (key,))
+    if entry is not None:
+        body, code = yield Blocking(duplicate_response, (key, entry, sig))
+        return body, code, {"Idempotent-Replayed": "true"}
+
+    try:
+        yield Blocking(record_signal, (sig,))
+
+        if signal_queue is not None:
+            with timer.stage("enqueue"):
+                signal_id = yield Blocking(signal_queue.submit, (sig,))
+            timer.flush(sig["symbol"], sig["action"])
+            body, code = {"status": "queued", "signal_id": signal_id}, 202
+        else:
+            try:
+                with timer.stage("token"):
+                    if not (tokens.valid() and cached_account_id):
+                        yield Blocking(tokens.ensure)
+                body, code = yield from _execute_signal(sig, None, timer)
+            finally:
+                timer.flush(sig["symbol"], sig["action"])
+    except Exception:
+        idempotency.release(key)
+        raise
+    idempotency.complete(key, body, code)
+    return body, code, {}
+
+def webhook_failed(e):
+    logging.exception("Webhook error")
+    tg_send(TG_CHAT_ID, f"🔥 SYSTEM ERROR\n{str(e)}")
+    return {"error": str(e)}, 500
+
+@app.route("/webhook", methods=["POST"])
+def tradingview_webhook():
+    timer = StageTimer()
+    hold = {}
+    try:
+        with timer.stage("parse"):
+            data = request.get_json(force=True)
+        body, code, headers = run_flow(webhook_flow(data, timer, hold))
+        return jsonify(body), code, headers
     except Exception as e:
-        logging.exception("Webhook error")
-        tg_send(TG_CHAT_ID, f"🔥 SYSTEM ERROR\n{str(e)}")
-        return jsonify({"error": str(e)}), 500
+        body, code = webhook_failed(e)
+        return jsonify(body), code
+    finally:
+        g.signal = hold.get("signal")
+
+@app.before_request
+def _start_ack_timer():
+    if request.endpoint == "tradingview_webhook":
+        g.t0 = time.perf_counter()
+
+@app.after_request
+def _observe_ack(response):
+    t0 = g.get("t0")
+    if t0 is not None:
+        sig = g.get("signal") or {}
+        metrics.observe(
+            "signal_to_ack_seconds", time.perf_counter() - t0,
+            symbol=sig.get("symbol", "unknown"), action=sig.get("action", "unknown"),
+            code=response.status_code,
+        )
+    return response
+
+@app.route("/signal/<signal_id>", methods=["GET"])
+def signal_status(signal_id):
+    if signal_queue is None:
+        return jsonify({"error": "Async mode disabled"}), 404
+    entry = signal_queue.get(signal_id)
+    if not entry:
+        return jsonify({"error": "Unknown signal"}), 404
+    return jsonify(entry)
+
+@app.route("/stats/execution", methods=["GET"])
+def execution_stats_endpoint():
+    body, code = execution_stats_query(request.args)
+    return jsonify(body), code
+
+def execution_stats_query(args):
+    """GET /stats/execution?symbol=MNQ&side=BUY&hour=9&by=symbol,side"""
+    by = tuple(k for k in str(args.get("by", ",".join(EXEC_STAT_KEYS))).split(",") if k)
+    if not by or any(k not in EXEC_STAT_KEYS for k in by):
+        return {"error": f"by must be a subset of {','.join(EXEC_STAT_KEYS)}"}, 400
+    try:
+        hour = int(args["hour"]) if args.get("hour") not in (None, "") else None
+    except ValueError:
+        return {"error": "Invalid hour"}, 400
+    side = str(args.get("side", "")).upper() or None
+    groups = exec_stats.query(args.get("symbol", "").upper() or None, side, hour, by)
+    return {
+        "slippageUnit": "points, positive = adverse",
+        "checkpointUtc": exec_stats.saved_utc.isoformat() + "Z" if exec_stats.saved_utc else None,
+        "groups": groups,
+    }, 200
+
+# ================== REPORTS ==================
+def format_fill_quality():
+    groups = exec_stats.query(by=("symbol", "side"))
+    if not groups:
+        return "📉 Fill Quality\nNo executions recorded yet"
+    hour = to_ny(utc_now()).hour
+    lines = ["📉 Fill Quality (slippage in points, + = adverse)"]
+    for g in groups:
+        slip, ttf = g["slippage"], g["time_to_fill_ms"]
+        lines.append("")
+        lines.append(f"{g['symbol']} {g['side']} (n={max(slip['n'], ttf['n'])})")
+        if slip["n"]:
+            lines.append(f"Slip: mean {slip['mean']} ±{slip['std']} | "
+                         f"p50 {slip['p50']} | p90 {slip['p90']} | p99 {slip['p99']}")
+        if ttf["n"]:
+            lines.append(f"Fill ms: mean {ttf['mean']:.0f} | "
+                         f"p50 {ttf['p50']:.0f} | p90 {ttf['p90']:.0f} | p99 {ttf['p99']:.0f}")
+        now = exec_stats.query(g["symbol"], g["side"], hour, by=("hour",))
+        if now and now[0]["slippage"]["n"]:
+            s = now[0]["slippage"]
+            lines.append(f"{hour:02d}h NY: slip mean {s['mean']} | p90 {s['p90']} (n={s['n']})")
+    return "\n".join(lines)
+
+def format_pnl_report(title, start_utc, end_utc, book, fmt_ts=fmt_time_ny):
+    lines = []
+    lines.append(title)
+    lines.append(f"Window: {fmt_ts(start_utc)} → {fmt_ts(end_utc)} NY")
+    lines.append(f"Filled Orders: {book.fills}")
+    lines.append("")
+
+    realized_events = book.realized_events
+    if not realized_events:
+        lines.append("No realized PnL yet (open position only).")
+    else:
+        # limit spam: show up to last 12 realized events
+        max_rows = 12
+        shown = realized_events[-max_rows:]
+        for i, ev in enumerate(shown, 1):
+            sign = "+" if ev["pnl"] >= 0 else "-"
+            pnl_abs = abs(ev["pnl"])
+            tstr = fmt_ts(ev["time_dt"])
+            lines.append(
+                f"{i}) {ev['symbol']} {ev['action']} x{ev['qty']} @ {tstr}  "
+                f"Entry:{round(ev['entry'], 4)} Exit:{round(ev['exit'], 4)}  "
+                f"PNL:{sign}${pnl_abs:,.2f}"
+            )
+
+        if len(realized_events) > max_rows:
+            lines.append(f"... ({len(realized_events) - max_rows} more)")
+
+    lines.append("")
+    total_pnl = book.total_pnl
+    sign_total = "+" if total_pnl >= 0 else "-"
+    lines.append(f"💰 Total Realized PnL: {sign_total}${abs(total_pnl):,.2f}")
+
+    # show open positions (if any)
+    open_bits = []
+    for sym, st in book.state.items():
+        if st["pos_qty"] != 0:
+            side_txt = "LONG" if st["pos_qty"] > 0 else "SHORT"
+            open_bits.append(f"{sym} {side_txt} x{abs(st['pos_qty'])} avg:{round(st['avg_price'], 4)}")
+    if open_bits:
+        lines.append("Open Position(s): " + " | ".join(open_bits))
+
+    return "\n".join(lines)
+
+def format_accounts_report(title, books):
+    """Realized PnL and fills per trading account plus the combined total."""
+    lines = [f"{title} — all accounts"]
+    total = 0.0
+    fills = 0
+    for account, book in books:
+        pnl = book.total_pnl
+        total += pnl
+        fills += book.fills
+        sign = "+" if pnl >= 0 else "-"
+        lines.append(f"{account['name']} (x{account['multiplier']:g}): {book.fills} fills | {sign}${abs(pnl):,.2f}")
+    sign = "+" if total >= 0 else "-"
+    lines.append(f"Σ {fills} fills | {sign}${abs(total):,.2f}")
+    return "\n".join(lines)
+
+def period_stats(title, start_utc):
+    """Realized PnL over a multi-day window, fetched as concurrent slices."""
+    now = utc_now()
+    records = list(fetch_history(start_utc, now))
+    journal.record(records)
+    book = PositionBook.replay(records)
+    if not book.fills:
+        return f"{title}\nNo filled trades"
+    return format_pnl_report(title, start_utc, now, book, fmt_ts=fmt_date_time_ny)
 
 # ================== TELEGRAM WEBHOOK ==================
 @app.route("/telegram", methods=["POST"])
 def telegram_webhook():
-    global cached_token, cached_account_id
+    handle_telegram_update(request.get_json())
+    return "ok"
 
-    if not cached_token or not cached_account_id:
-        connect_topstep()
+def handle_telegram_update(data):
+    """Answer one Telegram update (menu buttons and commands)."""
+    tokens.ensure()
 
-    data = request.get_json()
     msg = data.get("message", {})
     text = msg.get("text", "")
     chat_id = msg.get("chat", {}).get("id")
 
     if not chat_id:
-        return "ok"
+        return
 
     if text in ["/menu", "🔄 Refresh Menu"]:
         tg_menu(chat_id)
 
     elif text == "💰 Balance":
-        accs = requests.post(
-            f"{BASE_URL}/api/Account/search",
-            headers=ts_headers(),
-            json={"onlyActiveAccounts": True},
-            timeout=20
-        ).json().get("accounts", [])
-
-        acc = next(a for a in accs if a["id"] == cached_account_id)
-        balance = acc.get("balance", "N/A")
-        tg_send(chat_id, f"💰 ACCOUNT BALANCE\nBalance: {balance}")
+        if not copy_accounts:
+            acc = account_snapshot() or {}
+            balance = acc.get("balance", "N/A")
+            tg_send(chat_id, f"💰 ACCOUNT BALANCE\nBalance: {balance}")
+            return
+        lines = ["💰 ACCOUNT BALANCE"]
+        total = 0.0
+        for account in trading_accounts():
+            balance = (account_snapshot(account["id"]) or {}).get("balance")
+            lines.append(f"{account['name']}: {balance if balance is not None else 'N/A'}")
+            total += balance or 0
+        lines.append(f"Total: {round(total, 2)}")
+        tg_send(chat_id, "\n".join(lines))
 
     elif text == "🟢 Status":
         tg_send(
             chat_id,
             f"🟢 SYSTEM STATUS\n"
-            f"Token: {'OK' if cached_token else '❌'}\n"
+            f"Token: {'OK' if tokens.valid() else '❌'} (expires {fmt_time_ny(tokens.expires_utc)} NY)\n"
             f"AccountID: {cached_account_id}\n"
-            f"Started: {fmt_time_ny(SERVER_START_UTC)} NY"
+            f"Started: {fmt_time_ny(SERVER_START_UTC)} NY\n"
+            f"{broker.summary()}\n"
+            f"{snapshots.summary()}\n"
+            f"Rate limits: {fmt_rate_limits()}\n"
+            f"Duplicate alerts suppressed: {idempotency.duplicates}\n"
+            + (f"Netting: {netter.signals} signals → {netter.orders} orders\n" if netter.enabled else "")
+            + f"TG outbox: depth {tg_outbox.depth()} | dropped {tg_outbox.dropped}"
         )
 
     elif text == "📊 Open Orders":
-        resp = search_open_orders()
+        resp = open_orders_snapshot()
         orders = resp.get("orders", [])
         if not orders:
             tg_send(chat_id, "📊 Open Orders\nNo open orders")
@@ -400,49 +4200,51 @@ def telegram_webhook():
 
     elif text == "📈 Trade History":
         now = utc_now()
-        resp = search_orders_window(now - datetime.timedelta(hours=24), now)
-        orders = resp.get("orders", [])
+        journal.sync()
+        orders = journal.orders_between(now - datetime.timedelta(hours=24), now)
         if not orders:
             tg_send(chat_id, "📈 Trade History\nNo trades found")
         else:
             msg_txt = "📈 Trade History (24h):\n"
             for o in orders:
-                if o.get("fillVolume", 0) and o.get("filledPrice") is not None:
-                    side = "BUY" if o.get("side") == 0 else "SELL"
-                    ts = parse_ts(o.get("updateTimestamp", ""))
+                if o.filled:
+                    side = "BUY" if o.side == 0 else "SELL"
                     msg_txt += (
-                        f"- {o.get('contractId')} | {side} | "
-                        f"Qty:{o.get('size')} | Fill:{o.get('filledPrice')} | "
-                        f"Time:{fmt_time_ny(ts)} NY\n"
+                        f"- {o.contract_id} | {side} | "
+                        f"Qty:{o.size} | Fill:{o.filled_price} | "
+                        f"Time:{fmt_time_ny(o.updated_dt)} NY\n"
                     )
             tg_send(chat_id, msg_txt)
 
     elif text == "📌 Last Trade":
-        if not LAST_EXEC:
+        last_exec_utc, last_exec = get_last("last_exec")
+        if not last_exec:
             tg_send(chat_id, "📌 Last Trade\nNo executions recorded yet")
         else:
             tg_send(
                 chat_id,
                 "📌 Last Trade\n"
-                f"Time: {fmt_time_ny(LAST_EXEC_UTC)} NY\n"
-                f"Symbol: {LAST_EXEC.get('symbol')}\n"
-                f"Side: {LAST_EXEC.get('side')}\n"
-                f"Qty: {LAST_EXEC.get('qty')}\n"
-                f"Fill: {LAST_EXEC.get('fill_price')}"
+                f"Time: {fmt_time_ny(last_exec_utc)} NY\n"
+                f"Symbol: {last_exec.get('symbol')}\n"
+                f"Side: {last_exec.get('side')}\n"
+                f"Qty: {last_exec.get('qty')}\n"
+                f"Fill: {last_exec.get('fill_price')}\n"
+                f"Time to fill: {last_exec.get('time_to_fill_ms')} ms"
             )
 
     elif text == "💥 Last Slippage":
-        if not LAST_EXEC:
+        last_exec_utc, last_exec = get_last("last_exec")
+        if not last_exec:
             tg_send(chat_id, "💥 Last Slippage\nNo executions recorded yet")
         else:
             tg_send(
                 chat_id,
                 "💥 Last Slippage\n"
-                f"Time: {fmt_time_ny(LAST_EXEC_UTC)} NY\n"
-                f"Symbol: {LAST_EXEC.get('symbol')}\n"
-                f"Planned: {LAST_EXEC.get('planned_entry')}\n"
-                f"Fill: {LAST_EXEC.get('fill_price')}\n"
-                f"Slippage: {LAST_EXEC.get('slippage')}"
+                f"Time: {fmt_time_ny(last_exec_utc)} NY\n"
+                f"Symbol: {last_exec.get('symbol')}\n"
+                f"Planned: {last_exec.get('planned_entry')}\n"
+                f"Fill: {last_exec.get('fill_price')}\n"
+                f"Slippage: {last_exec.get('slippage')}"
             )
 
     elif text == "📊 Today Stats":
@@ -450,164 +4252,24 @@ def telegram_webhook():
         # Realized PnL for NY day
         # (supports scale-in / partial closes by maintaining avg price & position)
         # ---------------------------
-        start_utc = ny_today_start_utc()
+        journal.sync()  # new fills flow into today_book
         now = utc_now()
-        resp = search_orders_window(start_utc, now)
-        orders = resp.get("orders", [])
+        start_utc, book = today_book.snapshot()
 
-        filled = [
-            o for o in orders
-            if o.get("fillVolume", 0) and o.get("filledPrice") is not None
-        ]
+        if copy_accounts:
+            tg_send(chat_id, format_accounts_report("📊 Today Stats (NY)", today_book.snapshot_all()[1]))
 
-        if not filled:
+        if not book.fills:
             tg_send(chat_id, "📊 Today Stats (NY)\nNo filled trades")
-            return "ok"
-
-        # sort by timestamp
-        def _key(o):
-            dt = parse_ts(o.get("updateTimestamp", "")) or datetime.datetime.min
-            return dt
-        filled.sort(key=_key)
-
-        # position state per symbol
-        # pos_qty: signed int (long +, short -)
-        # avg_price: float
-        state = {
-            "MNQ": {"pos_qty": 0, "avg_price": 0.0},
-            "MGC": {"pos_qty": 0, "avg_price": 0.0},
-        }
-
-        realized_events = []  # list of dict: symbol, time_dt, action, qty, entry, exit, pnl
-
-        total_pnl = 0.0
-
-        for o in filled:
-            contract_id = o.get("contractId", "")
-            sym = contract_to_symbol(contract_id)
-            if sym not in state:
-                continue
+            return
 
-            pv = POINT_VALUE.get(sym)
-            if not pv:
-                continue
-
-            side = o.get("side")  # 0 buy, 1 sell
-            qty = int(o.get("size", 0) or 0)
-            price = float(o.get("filledPrice"))
-            tdt = parse_ts(o.get("updateTimestamp", ""))
-
-            if qty <= 0:
-                continue
-
-            st = state[sym]
-            pos_qty = int(st["pos_qty"])
-            avg = float(st["avg_price"])
-
-            if side == 0:
-                # BUY
-                if pos_qty >= 0:
-                    # increase / open long (scale-in)
-                    new_qty = pos_qty + qty
-                    if new_qty != 0:
-                        avg = (avg * pos_qty + price * qty) / new_qty if pos_qty != 0 else price
-                    pos_qty = new_qty
-                    st["pos_qty"], st["avg_price"] = pos_qty, avg
-                else:
-                    # buy to cover short (realize pnl on closed portion)
-                    close_qty = min(qty, abs(pos_qty))
-                    pnl = (avg - price) * pv * close_qty  # short profit if price down
-                    total_pnl += pnl
-                    realized_events.append({
-                        "symbol": sym,
-                        "time_dt": tdt,
-                        "action": "COVER",
-                        "qty": close_qty,
-                        "entry": avg,
-                        "exit": price,
-                        "pnl": pnl,
-                    })
-                    pos_qty = pos_qty + close_qty  # pos_qty is negative
-                    remaining_buy = qty - close_qty
-                    if remaining_buy > 0:
-                        # flips to long with remaining
-                        pos_qty = remaining_buy
-                        avg = price
-                    # if still short, avg unchanged
-                    st["pos_qty"], st["avg_price"] = pos_qty, avg if pos_qty != 0 else 0.0
-
-            else:
-                # SELL
-                if pos_qty <= 0:
-                    # increase / open short
-                    new_qty_abs = abs(pos_qty) + qty
-                    if new_qty_abs != 0:
-                        # avg for short kept as avg entry price
-                        avg = (avg * abs(pos_qty) + price * qty) / new_qty_abs if pos_qty != 0 else price
-                    pos_qty = -(new_qty_abs)
-                    st["pos_qty"], st["avg_price"] = pos_qty, avg
-                else:
-                    # sell to close long
-                    close_qty = min(qty, pos_qty)
-                    pnl = (price - avg) * pv * close_qty  # long profit if price up
-                    total_pnl += pnl
-                    realized_events.append({
-                        "symbol": sym,
-                        "time_dt": tdt,
-                        "action": "SELL",
-                        "qty": close_qty,
-                        "entry": avg,
-                        "exit": price,
-                        "pnl": pnl,
-                    })
-                    pos_qty = pos_qty - close_qty
-                    remaining_sell = qty - close_qty
-                    if remaining_sell > 0:
-                        # flips to short with remaining
-                        pos_qty = -remaining_sell
-                        avg = price
-                    st["pos_qty"], st["avg_price"] = pos_qty, avg if pos_qty != 0 else 0.0
-
-        # Build message
-        lines = []
-        lines.append("📊 Today Stats (NY)")
-        lines.append(f"Window: {fmt_time_ny(start_utc)} → {fmt_time_ny(now)} NY")
-        lines.append(f"Filled Orders: {len(filled)}")
-        lines.append("")
-
-        if not realized_events:
-            lines.append("No realized PnL yet (open position only).")
-        else:
-            # limit spam: show up to last 12 realized events
-            max_rows = 12
-            shown = realized_events[-max_rows:]
-            for i, ev in enumerate(shown, 1):
-                sign = "+" if ev["pnl"] >= 0 else "-"
-                pnl_abs = abs(ev["pnl"])
-                tstr = fmt_time_ny(ev["time_dt"])
-                lines.append(
-                    f"{i}) {ev['symbol']} {ev['action']} x{ev['qty']} @ {tstr}  "
-                    f"Entry:{round(ev['entry'], 4)} Exit:{round(ev['exit'], 4)}  "
-                    f"PNL:{sign}${pnl_abs:,.2f}"
-                )
+        tg_send(chat_id, format_pnl_report("📊 Today Stats (NY)", start_utc, now, book))
 
-            if len(realized_events) > max_rows:
-                lines.append(f"... ({len(realized_events) - max_rows} more)")
-
-        lines.append("")
-        sign_total = "+" if total_pnl >= 0 else "-"
-        lines.append(f"💰 Total Realized PnL: {sign_total}${abs(total_pnl):,.2f}")
-
-        # show open positions (if any)
-        open_bits = []
-        for sym, st in state.items():
-            if st["pos_qty"] != 0:
-                side_txt = "LONG" if st["pos_qty"] > 0 else "SHORT"
-                open_bits.append(f"{sym} {side_txt} x{abs(st['pos_qty'])} avg:{round(st['avg_price'], 4)}")
-        if open_bits:
-            lines.append("Open Position(s): " + " | ".join(open_bits))
+    elif text == "📅 Week Stats":
+        tg_send(chat_id, period_stats("📅 Week Stats (NY)", ny_week_start_utc()))
 
-        tg_send(chat_id, "\n".join(lines))
+    elif text == "🗓️ Month Stats":
+        tg_send(chat_id, period_stats("🗓️ Month Stats (NY)", ny_month_start_utc()))
 
     elif text == "⏱️ Uptime / Last Signal":
         uptime = utc_now() - SERVER_START_UTC
@@ -615,13 +4277,14 @@ def telegram_webhook():
         uptime_h = uptime_s // 3600
         uptime_m = (uptime_s % 3600) // 60
 
-        if not LAST_SIGNAL:
+        last_signal_utc, last_signal = get_last("last_signal")
+        if not last_signal:
             signal_txt = "No signals yet"
         else:
             signal_txt = (
-                f"{LAST_SIGNAL.get('symbol')} {LAST_SIGNAL.get('action', '').upper()} x{LAST_SIGNAL.get('qty')}\n"
-                f"Planned Entry: {LAST_SIGNAL.get('planned_entry')}\n"
-                f"Time: {fmt_time_ny(LAST_SIGNAL_UTC)} NY ({fmt_ago(LAST_SIGNAL_UTC)})"
+                f"{last_signal.get('symbol')} {last_signal.get('action', '').upper()} x{last_signal.get('qty')}\n"
+                f"Planned Entry: {last_signal.get('planned_entry')}\n"
+                f"Time: {fmt_time_ny(last_signal_utc)} NY ({fmt_ago(last_signal_utc)})"
             )
 
         tg_send(
@@ -633,39 +4296,76 @@ def telegram_webhook():
         )
 
     elif text == "🚫 Cancel ALL Open Orders":
-        resp = search_open_orders()
-        orders = resp.get("orders", [])
+        # every trading account: copy accounts and bracket legs included
+        orders, errors = open_orders_all_accounts()
 
         if not orders:
-            tg_send(chat_id, "🚫 Cancel ALL Open Orders\nNo open orders to cancel")
+            tg_send(chat_id, "\n".join(["🚫 Cancel ALL Open Orders\nNo open orders to cancel"] + errors))
         else:
-            ok = 0
-            fail = 0
-            for o in orders:
-                oid = o.get("id")
-                if oid is None:
-                    fail += 1
-                    continue
-                cr = cancel_order(int(oid))
-                if cr.get("success"):
-                    ok += 1
-                else:
-                    fail += 1
+            valid = [o for o in orders if o.get("id") is not None]
+            results, summary = cancel_orders(valid)
+            fail = summary["failed"] + (len(orders) - len(valid))
 
-            tg_send(
-                chat_id,
+            msg_txt = (
                 "🚫 Cancel ALL Open Orders\n"
                 f"Requested: {len(orders)}\n"
-                f"Cancelled OK: {ok}\n"
-                f"Failed: {fail}"
+                f"Cancelled OK: {summary['ok']}\n"
+                f"Failed: {fail}\n"
+                f"Retried: {summary['retried']}\n"
+                f"Took: {summary['elapsed_ms']:.0f} ms (slowest {summary['slowest_ms']:.0f} ms)"
             )
+            for r in results:
+                if not r["ok"]:
+                    msg_txt += (f"\n- ID:{r['item']['id']} ({account_name(r['item']['accountId'])}) "
+                                f"{r['error'] or r['result']}")
+            for e in errors:
+                msg_txt += f"\n- {e}"
+            tg_send(chat_id, msg_txt)
+
+    elif text == "📉 Fill Quality":
+        tg_send(chat_id, format_fill_quality())
+
+    elif text == "⏱️ Latency":
+        with metrics.lock:
+            n_ack = len(metrics.recent.get("signal_to_ack_seconds", ()))
+            n_fill = len(metrics.recent.get("signal_to_fill_seconds", ()))
+        tg_send(
+            chat_id,
+            "⏱️ Latency (recent signals)\n"
+            f"Signal→Ack ({n_ack}): {fmt_percentiles('signal_to_ack_seconds')}\n"
+            f"Signal→Fill ({n_fill}): {fmt_percentiles('signal_to_fill_seconds')}\n"
+            f"Order/place: {fmt_percentiles('webhook_stage_seconds.place')}\n"
+            f"Fill wait: {fmt_percentiles('webhook_stage_seconds.fill_wait')}\n"
+            f"Fill→Protected: {fmt_percentiles('time_to_protected_seconds')}\n"
+            f"Queue wait order: {fmt_percentiles('broker_queue_wait_seconds.order')}\n"
+            f"Queue wait fill: {fmt_percentiles('broker_queue_wait_seconds.fill')}\n"
+            f"Queue wait report: {fmt_percentiles('broker_queue_wait_seconds.report')}"
+        )
 
     else:
         tg_send(chat_id, "❓ Unknown command\n/menu")
 
-    return "ok"
-    
+
+# ================== STARTUP ==================
+tg_outbox.start()
+if signal_queue is not None:
+    signal_queue.start()
+registry.start()
+journal.start()
+positions.start()
+brackets.start()
+exec_stats.start()
+atexit.register(exec_stats.checkpoint)
+warmup.start()
+threading.Thread(target=state_heartbeat, name="state-heartbeat", daemon=True).start()
+if TOKEN_BACKGROUND_REFRESH:
+    tokens.start()
 
 # ================== RUN ==================
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
+    if SERVER_MODE == "async":
+        import sys
+        import async_server
+        async_server.run(sys.modules[__name__], host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
+    else:
+        app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
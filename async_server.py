@@ -0,0 +1,281 @@
+"""Optional asyncio server mode (aiohttp).
+
+    SERVER_MODE=async python app.py
+    gunicorn async_server:create_app --worker-class aiohttp.GunicornWebWorker
+
+/webhook and /telegram run as coroutines on one event loop. The webhook runs
+app.py's execution flows (webhook_flow and everything under it) with an
+aiohttp client, asyncio.sleep and the rate limiter's non-blocking take(), so
+simultaneous alerts (several strategies closing the same bar) run in parallel
+in one process instead of holding one blocked thread each.
+
+Everything else is app.py: signal parsing, the rate limiter, token manager,
+positions, journal, shared state and the Telegram outbox. Blocking pieces
+(logins, SQLite/state writes, Telegram menu reports) are handed to worker
+threads so the loop never waits on them. Needs the aiohttp package; the
+default Flask mode does not.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+
+# ================== BROKER CLIENT ==================
+class AsyncBroker:
+    """aiohttp counterpart of PooledClient + ts_post.
+
+    Same rate-limit families and priorities, 401 refresh-and-retry-once,
+    429/Retry-After backoff and http_request_seconds metrics.
+    """
+
+    def __init__(self, core):
+        self.core = core
+        self.session = None
+
+    async def start(self):
+        core = self.core
+        self.session = ClientSession(
+            connector=TCPConnector(limit=core.BROKER_POOL_SIZE, keepalive_timeout=60),
+            headers={"Accept": "application/json", "Content-Type": "application/json"},
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def ensure_token(self):
+        core = self.core
+        if not core.tokens.valid() or not core.cached_account_id:
+            await asyncio.to_thread(core.tokens.ensure)
+
+    async def _send(self, path, payload, timeout):
+        core = self.core
+        t0 = time.perf_counter()
+        try:
+            async with self.session.post(
+                f"{core.BASE_URL}{path}",
+                json=payload,
+                headers={"Authorization": f"Bearer {core.tokens.token}"},
+                timeout=ClientTimeout(total=timeout),
+            ) as resp:
+                text = await resp.text()
+        except Exception:
+            core.metrics.inc("broker_errors_total", endpoint=path, reason="exception")
+            raise
+        core.metrics.observe("http_request_seconds", time.perf_counter() - t0, client="broker_async", endpoint=path)
+        if resp.status >= 400:
+            core.metrics.inc("broker_errors_total", endpoint=path, reason=str(resp.status))
+        try:
+            body = json.loads(text) if text else {}
+        except ValueError:
+            body = {}
+        return resp, body
+
+    async def acquire(self, path, priority):
+        """RateLimiter.acquire with asyncio.sleep in place of the condition wait."""
+        limiter = self.core.broker.limiter
+        ticket = limiter.enqueue(path, priority)
+        if ticket is None:
+            return
+        try:
+            while True:
+                delay = limiter.take(ticket)
+                if not delay:
+                    return
+                await asyncio.sleep(delay)
+        except BaseException:
+            limiter.abandon(ticket)
+            raise
+
+    async def post(self, path, payload, priority=None, timeout=20):
+        """Authenticated broker call; returns the decoded JSON body."""
+        core = self.core
+        limiter = core.broker.limiter
+        await self.ensure_token()
+        refreshed = False
+        attempt = 0
+        while True:
+            if limiter.enabled:
+                await self.acquire(path, priority)
+            sent_token = core.tokens.token
+            resp, body = await self._send(path, payload, timeout)
+            if resp.status == 401 and not refreshed:
+                logging.warning(f"401 on {path}, refreshing token and retrying")
+                core.metrics.inc("broker_retries_total", endpoint=path, reason="401")
+                await asyncio.to_thread(core.tokens.refresh, sent_token)
+                refreshed = True
+                continue
+            if resp.status == 429 and attempt < core.BROKER_429_RETRIES:
+                delay = core.retry_after_sec(resp)
+                if delay is None:
+                    delay = core.BROKER_429_BACKOFF_SEC * 2 ** attempt
+                attempt += 1
+                logging.warning(f"429 on {path}, backing off {delay:.1f}s")
+                core.metrics.inc("broker_retries_total", endpoint=path, reason="429")
+                limiter.backoff(path, delay)
+                continue
+            return body
+
+# ================== FLOWS ==================
+class Waker:
+    """threading.Event stand-in for fill_watcher.events: notify() may set it from any thread."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:  # loop already closed
+            pass
+
+class FlowRunner:
+    """Drives app.py's execution flows on the event loop (core.run_flow's counterpart)."""
+
+    def __init__(self, core, broker):
+        self.core = core
+        self.broker = broker
+
+    async def run(self, flow):
+        value, error = None, None
+        while True:
+            try:
+                effect = flow.send(value) if error is None else flow.throw(error)
+            except StopIteration as done:
+                return done.value
+            value, error = None, None
+            try:
+                value = await self.perform(effect)
+            except Exception as e:
+                error = e
+
+    async def perform(self, effect):
+        core = self.core
+        if isinstance(effect, core.Call):
+            return await self.broker.post(effect.path, effect.payload, effect.priority, effect.timeout)
+        if isinstance(effect, core.Sleep):
+            if effect.waker is None:
+                await asyncio.sleep(effect.seconds)
+                return None
+            try:
+                await asyncio.wait_for(effect.waker.event.wait(), effect.seconds)
+            except asyncio.TimeoutError:
+                pass
+            effect.waker.event.clear()
+            return None
+        if isinstance(effect, core.NewWaker):
+            return Waker(asyncio.get_running_loop())
+        if isinstance(effect, core.Blocking):
+            return await asyncio.to_thread(effect.fn, *effect.args)
+        if isinstance(effect, core.Gather):
+            return list(await asyncio.gather(*(self.run(f) for f in effect.flows)))
+        if isinstance(effect, core.Await):
+            try:
+                await asyncio.wrap_future(effect.future)
+            except Exception as e:
+                return e
+            return None
+        raise TypeError(f"Unknown effect {effect!r}")
+
+# ================== HANDLERS ==================
+class AsyncGateway:
+    """The /webhook and /telegram coroutines plus the read-only probes."""
+
+    def __init__(self, core):
+        self.core = core
+        self.broker = AsyncBroker(core)
+        self.flows = FlowRunner(core, self.broker)
+
+    async def tradingview_webhook(self, request):
+        core = self.core
+        t0 = time.perf_counter()
+        timer = core.StageTimer()
+        hold = {}
+        code = 500
+        try:
+            with timer.stage("parse"):
+                data = json.loads(await request.text())
+            body, code, headers = await self.flows.run(core.webhook_flow(data, timer, hold))
+            return web.json_response(body, status=code, headers=headers)
+        except Exception as e:
+            body, code = core.webhook_failed(e)
+            return web.json_response(body, status=code)
+        finally:
+            sig = hold.get("signal") or {}
+            core.metrics.observe(
+                "signal_to_ack_seconds", time.perf_counter() - t0,
+                symbol=sig.get("symbol", "unknown"), action=sig.get("action", "unknown"), code=code,
+            )
+
+    async def telegram_webhook(self, request):
+        data = json.loads(await request.text() or "{}")
+        # menu reports share the sync handlers (journal, history pool, bulk cancels)
+        await asyncio.to_thread(self.core.handle_telegram_update, data)
+        return web.Response(text="ok")
+
+    async def health(self, request):
+        body, code = self.core.health_state()
+        return web.json_response(body, status=code)
+
+    async def livez(self, request):
+        return web.json_response({"status": "alive"})
+
+    async def readyz(self, request):
+        body = self.core.warmup.state()
+        body["status"] = "ready" if body["ready"] else "not ready"
+        return web.json_response(body, status=200 if body["ready"] else 503)
+
+    async def metrics(self, request):
+        return web.Response(body=self.core.metrics.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4"})
+
+    async def signal_status(self, request):
+        core = self.core
+        if core.signal_queue is None:
+            return web.json_response({"error": "Async mode disabled"}, status=404)
+        entry = core.signal_queue.get(request.match_info["signal_id"])
+        if not entry:
+            return web.json_response({"error": "Unknown signal"}, status=404)
+        return web.json_response(entry)
+
+    async def execution_stats(self, request):
+        body, code = self.core.execution_stats_query(request.query)
+        return web.json_response(body, status=code)
+
+    def make_app(self):
+        web_app = web.Application()
+        web_app.router.add_post("/webhook", self.tradingview_webhook)
+        web_app.router.add_post("/telegram", self.telegram_webhook)
+        web_app.router.add_get("/", self.health)
+        web_app.router.add_get("/livez", self.livez)
+        web_app.router.add_get("/readyz", self.readyz)
+        web_app.router.add_get("/metrics", self.metrics)
+        web_app.router.add_get("/signal/{signal_id}", self.signal_status)
+        web_app.router.add_get("/stats/execution", self.execution_stats)
+
+        async def _startup(_):
+            await self.broker.start()
+
+        async def _cleanup(_):
+            await self.broker.close()
+
+        web_app.on_startup.append(_startup)
+        web_app.on_cleanup.append(_cleanup)
+        return web_app
+
+# ================== RUN ==================
+async def create_app():
+    """App factory for external runners (gunicorn's aiohttp worker)."""
+    import app as core
+    return AsyncGateway(core).make_app()
+
+def run(core, host="0.0.0.0", port=10000):
+    web.run_app(AsyncGateway(core).make_app(), host=host, port=port)
+
+if __name__ == "__main__":
+    import os
+    import app as core
+    run(core, port=int(os.environ.get("PORT", 10000)))
@@ -0,0 +1,234 @@
+"""End-to-end /webhook load and latency benchmark.
+
+Starts fake_services.py stand-ins, points app.py at them, serves the Flask
+app on a local threaded server (or async_server.py with SERVER_MODE=async) and fires TradingView-style payloads at it
+concurrently. Reports throughput, ack latency percentiles and broker calls
+per signal.
+
+    python bench.py --signals 200 --concurrency 16 --latency-ms 40 --fill-delay-ms 150
+    python bench.py --payloads recorded_alerts.jsonl --json
+    python bench.py --signals 200 --concurrency 64 --env SERVER_MODE=async
+    python bench.py --signals 100 --copy-accounts C1:2,C2
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import fake_services
+
+# ================== PAYLOADS ==================
+def load_payloads(path):
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                out.append(json.loads(line))
+    return out
+
+def synthetic_payloads(n, symbols=("MNQ1!", "MGC1!")):
+    out = []
+    for i in range(n):
+        out.append({
+            "symbol": symbols[i % len(symbols)],
+            "data": "buy" if (i // len(symbols)) % 2 == 0 else "sell",
+            "quantity": 1,
+            "entry_price": 21000.0 if symbols[i % len(symbols)].startswith("MNQ") else 2650.0,
+            "alert_id": f"bench-{i}",
+        })
+    return out
+
+def percentile(sorted_vals, q):
+    if not sorted_vals:
+        return None
+    return sorted_vals[min(len(sorted_vals) - 1, int(round(q / 100 * (len(sorted_vals) - 1))))]
+
+# ================== HARNESS ==================
+def start_app(fake_url, extra_env):
+    """Import app.py against the fake services and serve it on a random port."""
+    env = {
+        "TOPSTEP_BASE_URL": fake_url,
+        "TG_API_URL": fake_url,
+        "TOPSTEP_USER": "bench",
+        "TOPSTEP_KEY": "bench",
+        "TARGET_ACCOUNT": "BENCH",
+        "TG_BOT_TOKEN": "bench",
+        "TG_CHAT_ID": "1",
+        "TG_CHAT_MIN_INTERVAL_SEC": "0",
+        "TOKEN_BACKGROUND_REFRESH": "0",
+        # the fake broker has no limits; measure the app, not the client-side throttle
+        "BROKER_RATE_LIMITS": "",
+        "BROKER_RATE_WINDOW": "",
+    }
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    env.setdefault("JOURNAL_DB_PATH", os.path.join(tmp, "journal.db"))
+    env.setdefault("SIGNAL_DB_PATH", os.path.join(tmp, "signals.db"))
+    env.setdefault("EXEC_STATS_PATH", os.path.join(tmp, "exec_stats.json"))
+    env.update(extra_env)
+    os.environ.update(env)
+
+    import app as webapp
+    if webapp.SERVER_MODE == "async":
+        return webapp, AsyncServer(webapp)
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, webapp.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+    return webapp, server
+
+class AsyncServer:
+    """async_server.py on its own event loop thread, shaped like werkzeug's server."""
+
+    def __init__(self, webapp):
+        import asyncio
+        import async_server
+        from aiohttp import web
+
+        self.loop = asyncio.new_event_loop()
+        self.runner = web.AppRunner(async_server.AsyncGateway(webapp).make_app())
+        threading.Thread(target=self.loop.run_forever, name="bench-app", daemon=True).start()
+
+        async def _start():
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, "127.0.0.1", 0)
+            await site.start()
+            return site._server.sockets[0].getsockname()[1]
+
+        self.server_port = asyncio.run_coroutine_threadsafe(_start(), self.loop).result()
+
+    def shutdown(self):
+        import asyncio
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+def fire(session, url, payload):
+    t0 = time.perf_counter()
+    try:
+        r = session.post(url, json=payload, timeout=60)
+        code = r.status_code
+    except Exception:
+        code = "error"
+    return code, time.perf_counter() - t0
+
+def run(args):
+    # COPY_ACCOUNTS spec ("NAME[:multiplier],...") -> the fake broker's extra accounts
+    copy_names = [part.split(":", 1)[0].strip() for part in args.copy_accounts.split(",") if part.strip()]
+    state = fake_services.FakeState(args.latency_ms, args.jitter_ms, args.fill_delay_ms, copy_accounts=copy_names)
+    fake = fake_services.start(state)
+    fake_url = f"http://127.0.0.1:{fake.server_port}"
+
+    extra_env = dict(kv.split("=", 1) for kv in args.env)
+    if copy_names:
+        extra_env["COPY_ACCOUNTS"] = args.copy_accounts
+    webapp, server = start_app(fake_url, extra_env)
+    url = f"http://127.0.0.1:{server.server_port}/webhook"
+
+    payloads = load_payloads(args.payloads) if args.payloads else synthetic_payloads(args.signals)
+    if args.payloads and args.signals:
+        payloads = (payloads * (args.signals // max(1, len(payloads)) + 1))[:args.signals]
+    if args.shuffle:
+        random.shuffle(payloads)
+
+    # warm up login/account/contracts outside the measured window
+    webapp.warmup.wait(30)
+    webapp.tokens.ensure()
+    state.reset_counters()
+
+    local = threading.local()
+
+    def one(payload):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return fire(local.session, url, payload)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one, payloads))
+    wall = time.perf_counter() - t0
+
+    # let async workers / outbox finish so broker call counts are complete
+    if webapp.signal_queue is not None:
+        webapp.signal_queue.q.join()
+    deadline = time.time() + 10
+    while webapp.tg_outbox.depth() and time.time() < deadline:
+        time.sleep(0.05)
+
+    lat = sorted(r[1] for r in results)
+    codes = Counter(str(r[0]) for r in results)
+    n = len(results)
+    broker_calls = {k: v for k, v in state.calls.items() if not k.startswith("telegram:")}
+    report = {
+        "signals": n,
+        "concurrency": args.concurrency,
+        "fake_latency_ms": args.latency_ms,
+        "fake_jitter_ms": args.jitter_ms,
+        "fake_fill_delay_ms": args.fill_delay_ms,
+        "wall_s": round(wall, 3),
+        "throughput_per_s": round(n / wall, 2) if wall else None,
+        "ack_ms": {
+            "p50": round(percentile(lat, 50) * 1000, 1),
+            "p90": round(percentile(lat, 90) * 1000, 1),
+            "p99": round(percentile(lat, 99) * 1000, 1),
+            "max": round(lat[-1] * 1000, 1),
+        } if lat else {},
+        "status_codes": dict(codes),
+        "broker_calls_total": sum(broker_calls.values()),
+        "broker_calls_per_signal": round(sum(broker_calls.values()) / n, 2) if n else None,
+        "broker_calls_by_endpoint": dict(sorted(broker_calls.items())),
+        "telegram_calls": state.calls.get("telegram:sendMessage", 0),
+    }
+    fill = webapp.metrics.percentiles("signal_to_fill_seconds")
+    if fill.get(50) is not None:
+        report["signal_to_fill_ms"] = {f"p{q}": round(v * 1000, 1) for q, v in fill.items()}
+    server.shutdown()
+    fake.shutdown()
+    return report
+
+def print_report(report):
+    print(f"signals: {report['signals']}  concurrency: {report['concurrency']}  "
+          f"fake latency: {report['fake_latency_ms']}±{report['fake_jitter_ms']}ms  "
+          f"fill delay: {report['fake_fill_delay_ms']}ms")
+    print(f"wall: {report['wall_s']}s  throughput: {report['throughput_per_s']}/s")
+    a = report["ack_ms"]
+    if a:
+        print(f"ack latency ms  p50 {a['p50']}  p90 {a['p90']}  p99 {a['p99']}  max {a['max']}")
+    if "signal_to_fill_ms" in report:
+        f = report["signal_to_fill_ms"]
+        print("signal->fill ms  " + "  ".join(f"{k} {v}" for k, v in f.items()))
+    print(f"status codes: {report['status_codes']}")
+    print(f"broker calls: {report['broker_calls_total']} ({report['broker_calls_per_signal']}/signal)")
+    for k, v in report["broker_calls_by_endpoint"].items():
+        print(f"  {k}: {v}")
+    print(f"telegram sends: {report['telegram_calls']}")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--signals", type=int, default=100, help="number of webhook calls")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--payloads", help="JSONL file of recorded TradingView payloads to replay")
+    p.add_argument("--shuffle", action="store_true")
+    p.add_argument("--latency-ms", type=float, default=40.0)
+    p.add_argument("--jitter-ms", type=float, default=10.0)
+    p.add_argument("--fill-delay-ms", type=float, default=150.0)
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                   help="extra app environment, e.g. --env WEBHOOK_ASYNC=1")
+    p.add_argument("--copy-accounts", default="", metavar="NAME[:MULT],...",
+                   help="copy every signal to these fake accounts (COPY_ACCOUNTS syntax)")
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = p.parse_args()
+
+    rep = run(args)
+    if args.json:
+        json.dump(rep, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(rep)
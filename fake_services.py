@@ -0,0 +1,221 @@
+"""Local stand-ins for the Topstep and Telegram HTTP APIs.
+
+Used by bench.py to drive app.py end to end without touching real
+accounts. Every endpoint sleeps for latency +/- jitter; market orders
+fill after fill_delay seconds.
+
+    python fake_services.py --port 18080 --latency-ms 40 --jitter-ms 10 --fill-delay-ms 150
+"""
+import argparse
+import datetime
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ================== STATE ==================
+class FakeState:
+    def __init__(self, latency_ms=40.0, jitter_ms=10.0, fill_delay_ms=150.0,
+                 account_name="BENCH", balance=50000.0, copy_accounts=()):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.fill_delay_ms = fill_delay_ms
+        self.account = {"id": 1001, "name": account_name, "balance": balance, "canTrade": True}
+        # extra accounts for copy trading, ids 1002, 1003, ...
+        self.accounts = [self.account] + [
+            {"id": 1002 + i, "name": name, "balance": balance, "canTrade": True}
+            for i, name in enumerate(copy_accounts)
+        ]
+        self.lock = threading.Lock()
+        self.order_ids = itertools.count(500000)
+        self.orders = {}  # id -> order dict (fill applied lazily)
+        self.calls = Counter()
+        self.telegram = []
+
+    def delay(self):
+        ms = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.telegram.clear()
+
+def iso(dt):
+    return dt.isoformat(timespec="milliseconds") + "Z"
+
+def parse_iso(ts):
+    if not ts:
+        return None
+    s = ts.strip().rstrip("Z")
+    if "+" in s[10:]:
+        s = s[:10] + s[10:].split("+")[0]
+    return datetime.datetime.fromisoformat(s)
+
+PRICES = {"MNQ": 21000.0, "MGC": 2650.0, "ES": 6000.0, "NQ": 21000.0, "CL": 70.0, "GC": 2650.0}
+
+def price_for(contract_id):
+    for root, px in PRICES.items():
+        if f".{root}." in contract_id:
+            return px + random.choice((-0.5, -0.25, 0.0, 0.25, 0.5))
+    return 100.0
+
+# ================== HANDLERS ==================
+def settle(state, o, now):
+    # fill a working market order once its fill delay has passed
+    if o["status"] == 1 and now >= o["_fill_at"]:
+        o["status"] = 2
+        o["fillVolume"] = o["size"]
+        o["filledPrice"] = o["_fill_price"]
+        o["updateTimestamp"] = iso(o["_fill_at"])
+
+def handle(state, path, body):
+    now = datetime.datetime.utcnow()
+    acc = state.account
+
+    if path == "/api/Auth/loginKey":
+        return {"success": True, "token": "bench-login", "errorCode": 0}
+    if path == "/api/Auth/validate":
+        return {"success": True, "newToken": "bench-session", "errorCode": 0}
+    if path == "/api/Account/search":
+        return {"success": True, "accounts": [dict(a) for a in state.accounts]}
+
+    if path == "/api/Contract/search":
+        text = str(body.get("searchText", "")).upper()
+        return {"success": True, "contracts": [
+            {"id": f"CON.F.US.{root}.Z26", "name": f"{root}Z6", "activeContract": True,
+             "tickSize": 0.25, "tickValue": 0.5}
+            for root in PRICES if root == text
+        ]}
+
+    if path == "/api/Order/place":
+        oid = next(state.order_ids)
+        o = {
+            "id": oid, "accountId": body.get("accountId", acc["id"]), "contractId": body.get("contractId"),
+            "creationTimestamp": iso(now), "updateTimestamp": iso(now),
+            "status": 1, "type": body.get("type", 2), "side": body.get("side"),
+            "size": int(body.get("size") or 0), "limitPrice": body.get("limitPrice"),
+            "stopPrice": body.get("stopPrice"), "fillVolume": 0, "filledPrice": None,
+            "_fill_at": now + datetime.timedelta(milliseconds=state.fill_delay_ms),
+            "_fill_price": price_for(str(body.get("contractId", ""))),
+        }
+        if o["type"] != 2:
+            o["_fill_at"] = datetime.datetime.max  # resting limit/stop orders never fill here
+        with state.lock:
+            state.orders[oid] = o
+        return {"success": True, "orderId": oid, "errorCode": 0}
+
+    if path == "/api/Order/search":
+        start = parse_iso(body.get("startTimestamp")) or datetime.datetime.min
+        end = parse_iso(body.get("endTimestamp")) or datetime.datetime.max
+        account_id = body.get("accountId", acc["id"])
+        out = []
+        with state.lock:
+            for o in state.orders.values():
+                settle(state, o, now)
+                created = parse_iso(o["creationTimestamp"])
+                if o["accountId"] == account_id and start <= created <= end:
+                    out.append({k: v for k, v in o.items() if not k.startswith("_")})
+        return {"success": True, "orders": out}
+
+    if path == "/api/Order/searchOpen":
+        account_id = body.get("accountId", acc["id"])
+        with state.lock:
+            for o in state.orders.values():
+                settle(state, o, now)
+            out = [{k: v for k, v in o.items() if not k.startswith("_")}
+                   for o in state.orders.values() if o["status"] == 1 and o["accountId"] == account_id]
+        return {"success": True, "orders": out}
+
+    if path == "/api/Order/cancel":
+        with state.lock:
+            o = state.orders.get(body.get("orderId"))
+            if not o or o["status"] != 1:
+                return {"success": False, "errorCode": 1, "errorMessage": "Order not open"}
+            o["status"] = 3
+            o["updateTimestamp"] = iso(now)
+        return {"success": True, "errorCode": 0}
+
+    if path == "/api/Position/searchOpen":
+        account_id = body.get("accountId", acc["id"])
+        net = {}
+        with state.lock:
+            for o in state.orders.values():
+                settle(state, o, now)
+                if o["fillVolume"] and o["accountId"] == account_id:
+                    signed = o["fillVolume"] if o["side"] == 0 else -o["fillVolume"]
+                    net[o["contractId"]] = net.get(o["contractId"], 0) + signed
+        return {"success": True, "positions": [
+            {"accountId": account_id, "contractId": cid, "type": 1 if n > 0 else 2, "size": abs(n)}
+            for cid, n in net.items() if n
+        ]}
+
+    if path.endswith("/sendMessage"):
+        with state.lock:
+            state.telegram.append(body)
+        return {"ok": True, "result": {"message_id": len(state.telegram)}}
+
+    return None
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            n = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(n) if n else b""
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                body = {}
+            path = self.path
+            key = "telegram:sendMessage" if path.endswith("/sendMessage") else path
+            with state.lock:
+                state.calls[key] += 1
+            state.delay()
+            out = handle(state, path, body)
+            code = 200 if out is not None else 404
+            data = json.dumps(out if out is not None else {"success": False}).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+def start(state, host="127.0.0.1", port=0):
+    """Serve in a daemon thread; returns the server (server.server_port is the bound port)."""
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-services", daemon=True).start()
+    return server
+
+# ================== CLI ==================
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=18080)
+    p.add_argument("--latency-ms", type=float, default=40.0)
+    p.add_argument("--jitter-ms", type=float, default=10.0)
+    p.add_argument("--fill-delay-ms", type=float, default=150.0)
+    p.add_argument("--copy-accounts", default="", metavar="NAME,...", help="extra accounts (ids 1002, ...)")
+    args = p.parse_args()
+
+    st = FakeState(args.latency_ms, args.jitter_ms, args.fill_delay_ms,
+                   copy_accounts=[n.strip() for n in args.copy_accounts.split(",") if n.strip()])
+    srv = start(st, args.host, args.port)
+    print(f"Fake Topstep/Telegram on http://{args.host}:{srv.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,78 @@
+"""Accuracy of the streaming fill-quality stats against exact values."""
+import math
+import os
+import random
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+@pytest.fixture(scope="module")
+def app():
+    tmp = tempfile.mkdtemp(prefix="test-exec-stats-")
+    # importing app starts its background threads; keep them offline
+    os.environ.setdefault("WARMUP_ON_START", "0")
+    os.environ.setdefault("TOKEN_BACKGROUND_REFRESH", "0")
+    os.environ.setdefault("JOURNAL_DB_PATH", os.path.join(tmp, "journal.db"))
+    os.environ.setdefault("SIGNAL_DB_PATH", os.path.join(tmp, "signals.db"))
+    os.environ.setdefault("EXEC_STATS_PATH", os.path.join(tmp, "exec_stats.json"))
+    import app
+    return app
+
+def exact_quantile(values, q):
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+def assert_quantiles(app, stat, values):
+    summary = stat.summary()
+    for q in (50, 90, 99):
+        exact = exact_quantile(values, q / 100)
+        tol = app.EXEC_STATS_ALPHA * abs(exact) + 1e-6
+        assert abs(summary[f"p{q}"] - exact) <= tol, (q, summary[f"p{q}"], exact)
+
+def test_time_to_fill_quantiles_wide_range(app):
+    rng = random.Random(7)
+    # 50 ms .. several seconds, the spread that broke a 128-bucket cap
+    values = [min(6000.0, max(20.0, rng.lognormvariate(math.log(245), 1.0))) for _ in range(50000)]
+    stat = app.StreamingStat()
+    for v in values:
+        stat.add(v)
+    assert_quantiles(app, stat, values)
+
+def test_signed_slippage_quantiles_and_moments(app):
+    rng = random.Random(11)
+    values = [round(rng.gauss(0.5, 2.0) * 4) / 4 + rng.uniform(-0.01, 0.01) for _ in range(50000)]
+    stat = app.StreamingStat()
+    for v in values:
+        stat.add(v)
+    assert_quantiles(app, stat, values)
+    mean = sum(values) / len(values)
+    var = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
+    assert stat.mean == pytest.approx(mean, rel=1e-9, abs=1e-9)
+    assert stat.summary()["std"] == pytest.approx(math.sqrt(var), rel=1e-3)
+
+def test_merge_matches_single_stream(app):
+    rng = random.Random(3)
+    values = [rng.expovariate(1 / 150.0) for _ in range(20000)]
+    whole, left, right = app.StreamingStat(), app.StreamingStat(), app.StreamingStat()
+    for i, v in enumerate(values):
+        whole.add(v)
+        (left if i % 3 else right).add(v)
+    left.merge(right)
+    assert left.n == whole.n
+    assert left.mean == pytest.approx(whole.mean, rel=1e-9)
+    assert left.m2 == pytest.approx(whole.m2, rel=1e-9)
+    assert left.sketch.pos == whole.sketch.pos
+    assert_quantiles(app, left, values)
+
+def test_checkpoint_round_trip(app, tmp_path):
+    stats = app.ExecutionStats(str(tmp_path / "stats.json"))
+    now = app.utc_now()
+    for i in range(500):
+        stats.record("MNQ", i % 2, now, (i % 7 - 3) * 0.25, 50 + i)
+    assert stats.checkpoint()
+    loaded = app.ExecutionStats(str(tmp_path / "stats.json"))
+    assert loaded.query() == stats.query()